@@ -2,7 +2,9 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from defineDistances_lib import DistancesDefiner
+from networkIndex_lib import NetworkIndexCache
 from def_lib import ArgumentsManager
+from contribFile_lib import ContribFileWriter, ContribFileReader
 from plots_lib import GraphsPlotter
 import numpy as np
 import datetime
@@ -16,10 +18,14 @@ import os
 
 if '-h' in sys.argv:
     print("Usage: python barplot.py -in_contrib_dict IN_DICT -in_rvr IN_RVR -in_lengths IN_LENGTHS -out_hydrograph OUT_HYD")
-    print("  IN_DICT    : File path for input hydrograph binary file.")
+    print("  IN_DICT    : File path for input hydrograph binary file (pickle or contribution .h5 file).")
     print("  IN_RVR     : File path for .rvr describing the topology of the network.")
     print("  IN_LENGTHS : File path for .csv describing the lengths of the network.")
     print("  OUT_HYD    : File path for output hydrograph image file.")
+    print("Optional: -ini_timestamp INI_TS -end_timestamp END_TS -outlet_link_id OUTLET")
+    print("  INI_TS     : First timestamp to be plotted. Only read from contribution .h5 files.")
+    print("  END_TS     : Last timestamp to be plotted. Only read from contribution .h5 files.")
+    print("  OUTLET     : Outlet to be plotted when IN_DICT has several of them (default: the first one).")
     quit()
 
 # ###################################################### ARGS ######################################################## #
@@ -30,6 +36,9 @@ input_rvr_fpath_arg = ArgumentsManager.get_str(sys.argv, '-in_rvr')
 links_length_file_path = ArgumentsManager.get_str(sys.argv, '-in_lengths')
 output_hpict_fpath_arg = ArgumentsManager.get_str(sys.argv, '-out_hydrograph')
 y_limit_arg = ArgumentsManager.get_int(sys.argv, "-y_lim")
+ini_timestamp_arg = ArgumentsManager.get_int(sys.argv, "-ini_timestamp")
+end_timestamp_arg = ArgumentsManager.get_int(sys.argv, "-end_timestamp")
+outlet_link_id_arg = ArgumentsManager.get_int(sys.argv, "-outlet_link_id")
 
 # basic checks
 if input_hdict_fpath_arg is None:
@@ -55,6 +64,13 @@ def read_topo(rvr_fpath):
     :return: Dictionary of integers with format "link_id":[contr_link_id1, contr_link_id2, contr_link_id3, ...]
     """
 
+    # use the compiled network cache written by the tracker when it is up to date
+    network_index = NetworkIndexCache.load(rvr_fpath)
+    if network_index is None:
+        network_index = NetworkIndexCache.load(rvr_fpath, renumbered=True)
+    if network_index is not None:
+        return network_index.to_upstream_dict()
+
     return_dict = {}
     with open(rvr_fpath, "r+") as rfile:
         num_links = None
@@ -167,24 +183,64 @@ def get_color_dict(rain=False):
                 "D-Group 3 New": "#99CCCC",
                 "D-Group 4 New": "#77FF77"}
 
+def read_contributions(input_hydr_file_path, ini_timestamp=None, end_timestamp=None, outlet_link_id=None):
+    """
+    Opens a contribution file lazily or loads a pickled contribution dictionary
+    :param input_hydr_file_path:
+    :param ini_timestamp: First timestamp to be considered. Only used for contribution .h5 files.
+    :param end_timestamp: Last timestamp to be considered. Only used for contribution .h5 files.
+    :param outlet_link_id: Outlet to be read from files with several outlets. If None, the first one.
+    :return: Tuple (ContribFile object or dictionary of [timestamp]->contributions, list of timestamps), or (None, None)
+    """
+
+    if not os.path.exists(input_hydr_file_path):
+        print("File '{0}' does not exist.".format(input_hydr_file_path))
+        return None, None
+
+    if ContribFileWriter.is_contrib_file(input_hydr_file_path):
+        contrib_data = ContribFileReader.open(input_hydr_file_path, outlet_link_id=outlet_link_id,
+                                              ini_timestamp=ini_timestamp, end_timestamp=end_timestamp)
+        if contrib_data is None:
+            return None, None
+        return contrib_data, contrib_data.timestamps.tolist()
+
+    with open(input_hydr_file_path, 'rb') as rfile:
+        contrib_data = pickle.load(rfile)
+    if contrib_data is None:
+        return None, None
+
+    # several outlets: dictionary of [outlet link id]->dictionary of [timestamp]->contributions
+    first_value = next(iter(contrib_data.values()), None)
+    if isinstance(first_value, dict) and ("outlet_link_id" not in first_value):
+        outlet_link_id = min(contrib_data.keys()) if outlet_link_id is None else outlet_link_id
+        if outlet_link_id not in contrib_data:
+            print("No outlet {0} in file '{1}'.".format(outlet_link_id, input_hydr_file_path))
+            return None, None
+        contrib_data = contrib_data[outlet_link_id]
+    return contrib_data, sorted(list(contrib_data.keys()))
+
+
 def plot_it(input_hydr_file_path, input_rvr_file_path, input_links_length_file_path, output_file_path, stack_bar=True,
-            line_graph=True, y_lim=None):
+            line_graph=True, y_lim=None, ini_timestamp=None, end_timestamp=None, outlet_link_id=None):
     """
 
     :param input_hydr_file_path:
     :param input_rvr_file_path:
     :param input_links_length_file_path:
     :param output_file_path:
+    :param ini_timestamp: First timestamp to be plotted. Only used for contribution .h5 files.
+    :param end_timestamp: Last timestamp to be plotted. Only used for contribution .h5 files.
+    :param outlet_link_id: Outlet to be plotted from files with several outlets. If None, the first one.
     :return:
     """
 
     # basic check and open/read file hydro file
-    if not os.path.exists(input_hydr_file_path):
-        print("File '{0}' does not exist.".format(input_hydr_file_path))
+    data_dict, all_timestamps = read_contributions(input_hydr_file_path, ini_timestamp=ini_timestamp,
+                                                   end_timestamp=end_timestamp, outlet_link_id=outlet_link_id)
+    if data_dict is None:
+        print("Some problem reading '{0}'.".format(input_hydr_file_path))
         return False
-    with open(input_hydr_file_path, 'rb') as rfile:
-        data_dict = pickle.load(rfile)
-    print("Gotten {0} timestasmps from file {1}.".format(len(data_dict.keys()), input_hydr_file_path))
+    print("Gotten {0} timestasmps from file {1}.".format(len(all_timestamps), input_hydr_file_path))
 
     # basic check and open/read topology file
     if not os.path.exists(input_rvr_file_path):
@@ -199,19 +255,18 @@ def plot_it(input_hydr_file_path, input_rvr_file_path, input_links_length_file_p
     link_lengths = read_lengths(input_links_length_file_path)
 
     # basic check - some info
-    if data_dict is None:
-        print("Some problem reading '{0}'.".format(input_hydr_file_path))
-        return False
-    if len(data_dict.keys()) == 0:
+    if len(all_timestamps) == 0:
         print("Not enough info in '{0}'.".format(input_hydr_file_path))
         return False
 
-    # extract all timestamps and link id
-    all_timestamps = sorted(list(data_dict.keys()))
-    if "outlet_link_id" not in data_dict[all_timestamps[0]]:
+    # extract link id
+    if not isinstance(data_dict, dict):
+        outlet_linkid = data_dict.outlet_link_id
+    elif "outlet_link_id" not in data_dict[all_timestamps[0]]:
         print("Missing 'outlet_link_id' in data file.")
         return False
-    outlet_linkid = data_dict[all_timestamps[0]]["outlet_link_id"]
+    else:
+        outlet_linkid = data_dict[all_timestamps[0]]["outlet_link_id"]
 
     # define distances from all links to outlet and set up classes for links
     links_dist = DistancesDefiner.calculate_links_distances(outlet_linkid, topo_data, link_lengths)
@@ -223,8 +278,9 @@ def plot_it(input_hydr_file_path, input_rvr_file_path, input_links_length_file_p
     links_classes_width = DistancesDefiner.classify_links_width(links_widths)
 
     # debug
-    last_timestamp = all_timestamps[-1]
-    print("Last state in outlet link {0} : {1}.".format(outlet_linkid, data_dict[last_timestamp]))
+    last_state = data_dict[all_timestamps[-1]] if isinstance(data_dict, dict) else \
+        data_dict.get_step_dict(len(all_timestamps) - 1)
+    print("Last state in outlet link {0} : {1}.".format(outlet_linkid, last_state))
     for cur_class in range(1, 6):
         counter = 0
         for cur_class_dict in list(links_classes.values()):
@@ -265,11 +321,14 @@ def plot_it(input_hydr_file_path, input_rvr_file_path, input_links_length_file_p
     export_links_classification(links_classes, output_file_path.replace(".png", "_links_distclass.csv"))
     export_links_classification(links_classes_width, output_file_path.replace(".png", "_links_widthclass.csv"))
 
+    if not isinstance(data_dict, dict):
+        data_dict.close()
     return True
 
 
 if plot_it(input_hdict_fpath_arg, input_rvr_fpath_arg, links_length_file_path, output_hpict_fpath_arg,
-           y_lim=y_limit_arg):
+           y_lim=y_limit_arg, ini_timestamp=ini_timestamp_arg, end_timestamp=end_timestamp_arg,
+           outlet_link_id=outlet_link_id_arg):
     print("Done creating '{0}'.".format(output_hpict_fpath_arg))
 else:
     print("Execution failed.")
@@ -0,0 +1,183 @@
+from traceOutputs_lib import GblVars, DomainSnapshot, HillslopeLinkState, Particle, ParticleStore, ParticleBuckets, \
+    LayerCounters
+import numpy as np
+import os
+
+
+# Static Class - Writes and reads binary dumps of the whole tracking state, so that long runs can be resumed
+class CheckpointFile:
+    FILE_SUFFIX = "_checkpoint.npz"
+    FORMAT_VERSION = 1
+
+    # compartments of the Particle objects lists of a HillslopeLinkState, in the order they are dumped
+    _STATE_LISTS = ((ParticleStore.COMP_CHANNEL, "parts_chnl_frnt"),
+                    (ParticleStore.COMP_POND, "parts_pond_frnt"),
+                    (ParticleStore.COMP_TOPLAYER, "parts_topl_frnt"),
+                    (ParticleStore.COMP_SUBSURFACE, "parts_subs_frnt"))
+
+    @staticmethod
+    def get_file_path(hydrograph_fpath):
+        """
+
+        :param hydrograph_fpath: Path of the output hydrograph file of the run
+        :return: Path of the checkpoint file of the run
+        """
+        return os.path.splitext(hydrograph_fpath)[0] + CheckpointFile.FILE_SUFFIX
+
+    @staticmethod
+    def write(file_path, snapshot, last_file_position, particles=None, worker_random_states=None):
+        """
+        Dumps the particles of a snapshot, its accumulated rained particles and the global random state. The file is
+        replaced only once completely written.
+        :param file_path:
+        :param snapshot: DomainSnapshot after moving the particles of the file at 'last_file_position'
+        :param last_file_position: Position of the last processed file in the list of h5 files
+        :param particles: ParticleStore to be dumped instead of the particles of the snapshot (e.g. gathered from
+                          worker processes)
+        :param worker_random_states: List of random states of worker processes (as given by RandomState.get_state())
+        :return:
+        """
+
+        link_idx, comp, src_link_idx, src_layer, counts = CheckpointFile._get_particle_columns(snapshot, particles)
+        rdm_name, rdm_keys, rdm_pos, rdm_has_gauss, rdm_cached_gauss = np.random.get_state()
+        content = {"version": np.int64(CheckpointFile.FORMAT_VERSION),
+                   "last_file_position": np.int64(last_file_position),
+                   "timestamp": np.int64(snapshot.timestamp),
+                   "link_ids": GblVars.network_index.link_ids,
+                   "cummulative_rained_parts": snapshot.hl_cummulative_rained_parts,
+                   "link": link_idx, "comp": comp, "src_link": src_link_idx, "src_layer": src_layer,
+                   "rdm_keys": rdm_keys, "rdm_pos": np.int64(rdm_pos), "rdm_has_gauss": np.int64(rdm_has_gauss),
+                   "rdm_cached_gauss": np.float64(rdm_cached_gauss)}
+        if counts is not None:
+            content["counts"] = counts
+        if worker_random_states is not None:
+            content["workers_rdm_keys"] = np.array([s[1] for s in worker_random_states], dtype=np.uint32)
+            content["workers_rdm_scalars"] = np.array([(s[2], s[3], s[4]) for s in worker_random_states],
+                                                      dtype=np.float64)
+
+        tmp_file_path = file_path + ".tmp"
+        with open(tmp_file_path, "wb") as wfile:
+            np.savez(wfile, **content)
+        os.replace(tmp_file_path, file_path)
+        print("Wrote checkpoint '{0}' ({1} particles, file {2}).".format(
+            file_path, len(link_idx) if counts is None else int(counts.sum()), last_file_position))
+
+    @staticmethod
+    def read(file_path):
+        """
+        Reads a checkpoint file, checking it was written over the current GblVars.network_index
+        :param file_path:
+        :return: Dictionary with the content of the file, None if it could not be used
+        """
+
+        if not os.path.exists(file_path):
+            print("File '{0}' does not exist.".format(file_path))
+            return None
+
+        with np.load(file_path) as content:
+            ret_dict = dict(content.items())
+        if int(ret_dict["version"]) != CheckpointFile.FORMAT_VERSION:
+            print("Unsupported checkpoint version {0} in '{1}'.".format(int(ret_dict["version"]), file_path))
+            return None
+        if not np.array_equal(ret_dict["link_ids"], GblVars.network_index.link_ids):
+            print("Checkpoint '{0}' was written for other network or links order.".format(file_path))
+            return None
+        return ret_dict
+
+    @staticmethod
+    def restore_random_state(checkpoint):
+        """
+        Sets numpy global random state as it was when the checkpoint was written
+        :param checkpoint: Dictionary as given by 'read'
+        :return:
+        """
+        np.random.set_state(("MT19937", checkpoint["rdm_keys"], int(checkpoint["rdm_pos"]),
+                             int(checkpoint["rdm_has_gauss"]), float(checkpoint["rdm_cached_gauss"])))
+
+    @staticmethod
+    def get_worker_random_states(checkpoint):
+        """
+
+        :param checkpoint: Dictionary as given by 'read'
+        :return: List of random states of worker processes, None if the checkpoint has none
+        """
+        if "workers_rdm_keys" not in checkpoint:
+            return None
+        return [("MT19937", cur_keys, int(cur_scalars[0]), int(cur_scalars[1]), float(cur_scalars[2]))
+                for cur_keys, cur_scalars in zip(checkpoint["workers_rdm_keys"], checkpoint["workers_rdm_scalars"])]
+
+    @staticmethod
+    def build_snapshot(checkpoint, particle_store=False, particle_buckets=False):
+        """
+        Rebuilds the snapshot dumped in a checkpoint
+        :param checkpoint: Dictionary as given by 'read'
+        :param particle_store: If True, particles are held in a ParticleStore instead of Particle objects
+        :param particle_buckets: If True, particles are counted in a ParticleBuckets instead of Particle objects
+        :return: A new DomainSnapshot object
+        """
+
+        all_link_ids = GblVars.network_index.link_ids.tolist()
+        counts = checkpoint.get("counts")
+        ret_obj = DomainSnapshot(hillslopelink_ids=all_link_ids, the_timestamp=int(checkpoint["timestamp"]))
+        ret_obj.hl_cummulative_rained_parts = checkpoint["cummulative_rained_parts"].astype(np.int64)
+        ret_obj.layer_counters = LayerCounters(len(all_link_ids))
+        ret_obj.layer_counters.add(checkpoint["src_link"], checkpoint["src_layer"], 1 if counts is None else counts)
+
+        if particle_buckets:
+            ret_obj.particles = ParticleBuckets(GblVars.network_index)
+            ret_obj.particles.set_columns(checkpoint["link"], checkpoint["comp"], checkpoint["src_link"],
+                                          checkpoint["src_layer"],
+                                          np.ones(len(checkpoint["link"]), dtype=np.int64) if counts is None else
+                                          counts)
+            return ret_obj
+
+        link_idx, comp, src_link_idx, src_layer = checkpoint["link"], checkpoint["comp"], checkpoint["src_link"], \
+            checkpoint["src_layer"]
+        if counts is not None:
+            link_idx, comp, src_link_idx, src_layer = [np.repeat(c, counts) for c in (link_idx, comp, src_link_idx,
+                                                                                      src_layer)]
+        if particle_store:
+            ret_obj.particles = ParticleStore(GblVars.network_index)
+            ret_obj.particles.set_columns(link_idx, comp, src_link_idx, src_layer)
+            return ret_obj
+
+        comp_lists = dict(CheckpointFile._STATE_LISTS)
+        for cur_link_idx, cur_comp, cur_src_idx, cur_layer in zip(link_idx.tolist(), comp.tolist(),
+                                                                  src_link_idx.tolist(), src_layer.tolist()):
+            cur_state = ret_obj.hl_states[all_link_ids[cur_link_idx]]
+            getattr(cur_state, comp_lists[cur_comp]).append(Particle(all_link_ids[cur_src_idx], cur_layer))
+        return ret_obj
+
+    @staticmethod
+    def _get_particle_columns(snapshot, particles=None):
+        """
+
+        :param snapshot: DomainSnapshot with particles held in any way
+        :param particles: ParticleStore to be used instead of the particles of the snapshot
+        :return: Tuple of arrays (link index, compartment, source link index, source layer, counts or None)
+        """
+
+        if particles is not None:
+            return particles.link, particles.comp, particles.src_link, particles.src_layer, None
+        if isinstance(snapshot.particles, ParticleBuckets):
+            return snapshot.particles.link, snapshot.particles.comp, snapshot.particles.src_link, \
+                   snapshot.particles.src_layer, snapshot.particles.counts
+        if snapshot.particles is not None:
+            return snapshot.particles.link, snapshot.particles.comp, snapshot.particles.src_link, \
+                   snapshot.particles.src_layer, None
+
+        # Particle objects, dumped link by link keeping the order of each list
+        link_idx, comp, src_link_idx, src_layer = [], [], [], []
+        for cur_link_idx, cur_link_id in enumerate(GblVars.network_index.link_ids.tolist()):
+            cur_state = snapshot.hl_states.get(cur_link_id, HillslopeLinkState())
+            for cur_comp, cur_list_name in CheckpointFile._STATE_LISTS:
+                for cur_particle in getattr(cur_state, cur_list_name):
+                    link_idx.append(cur_link_idx)
+                    comp.append(cur_comp)
+                    src_link_idx.append(GblVars.network_index.get_index(cur_particle.get_linkid()))
+                    src_layer.append(cur_particle.get_layer_source())
+        return np.array(link_idx, dtype=np.int32), np.array(comp, dtype=np.int8), \
+            np.array(src_link_idx, dtype=np.int32), np.array(src_layer, dtype=np.int64), None
+
+    def __init__(self):
+        return
@@ -12,6 +12,8 @@ class ConfigFile:
     PART_METH_EQUL = "all_equal"
     PART_METH_PROP = "volume_proportional"
     PART_METH_NONE = "none"
+    PART_NUMB = "number_particles"
+    PART_VOLU = "volume_per_parts"
     WATE = "watershed"
     WATE_LINK = "outlet_link_id"
     WATE_RVRF = "rvr_file_path"
@@ -44,11 +46,27 @@ class ConfigFile:
     def get_particles_raindist_method(self):
         return self._get(lvl_1=ConfigFile.PART, lvl_2=ConfigFile.PART_RAIN, lvl_3=ConfigFile.PART_METH)
 
+    def get_particles_initdist_number(self):
+        return self._get(lvl_1=ConfigFile.PART, lvl_2=ConfigFile.PART_INIT, lvl_3=ConfigFile.PART_NUMB)
+
+    def get_particles_raindist_volume(self):
+        return self._get(lvl_1=ConfigFile.PART, lvl_2=ConfigFile.PART_RAIN, lvl_3=ConfigFile.PART_VOLU)
+
     # ### watershed ### #
 
     def get_outlet_link_id(self):
         return self._get(lvl_1=ConfigFile.WATE, lvl_2=ConfigFile.WATE_LINK)
 
+    def get_outlet_link_ids(self):
+        """
+        The outlet link id tag may hold a single link id or a list of them
+        :return: List of link ids, None if missing
+        """
+        outlet_link_ids = self.get_outlet_link_id()
+        if outlet_link_ids is None:
+            return None
+        return [int(v) for v in outlet_link_ids] if isinstance(outlet_link_ids, list) else [int(outlet_link_ids)]
+
     def get_rvr_file_path(self):
         return self._get(lvl_1=ConfigFile.WATE, lvl_2=ConfigFile.WATE_RVRF)
 
@@ -77,7 +95,7 @@ class ConfigFile:
         all_ok = all_ok if ConfigFile._check_file_exists(self.get_first_h5_file_path()) else False
 
         # mandatory tags - input file references
-        all_ok = all_ok if ConfigFile._check_integer(self.get_outlet_link_id()) else False
+        all_ok = all_ok if ConfigFile._check_integers(self.get_outlet_link_id()) else False
         all_ok = all_ok if ConfigFile._check_file_exists(self.get_rvr_file_path()) else False
         all_ok = all_ok if ConfigFile._check_file_exists(self.get_prm_file_path()) else False
 
@@ -138,6 +156,21 @@ class ConfigFile:
             print("CHECK FAIL: '{0}' is not a integer.".format(tag_value))
             return False
 
+    @staticmethod
+    def _check_integers(tag_value):
+        """
+
+        :param tag_value: A single value or a non-empty list of values
+        :return:
+        """
+
+        if isinstance(tag_value, list):
+            if len(tag_value) == 0:
+                print("CHECK FAIL: Empty list.")
+                return False
+            return all([ConfigFile._check_integer(v) for v in tag_value])
+        return ConfigFile._check_integer(tag_value)
+
     @staticmethod
     def _check_str_value(tag_value, valid_values, mandatory):
         """
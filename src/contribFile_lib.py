@@ -0,0 +1,561 @@
+import numpy as np
+import threading
+import queue
+import h5py
+import os
+
+
+# Dynamic Class - Appends the outlet contributions of each time step into an HDF5 file from a background thread
+class ContribFileWriter:
+    FILE_EXT = ".h5"
+    FORMAT_NAME = "asynch_parttrack_contrib"
+    FORMAT_VERSION = 1
+    CHUNK_ROWS = 4096             # rows per HDF5 chunk of the extendable datasets
+    AGE_DATASET = "age_count"     # dataset of the age histograms of each step
+    GROUPS_PREFIX = "group_count_"  # prefix of the datasets of the contributions by group of each step
+    QUEUE_SIZE = 8                # time steps waiting to be written before 'append' blocks
+
+    _file_path = None             # path of the HDF5 file being written
+    _hdf_file = None              # h5py File object, only used by the writer thread
+    _queue = None                 # queue of (timestamp, contributions, ages, groups), None ends the writer thread
+    _thread = None                # writer thread
+    _error = None                 # exception raised in the writer thread, if any
+
+    @staticmethod
+    def is_contrib_file(file_path):
+        """
+
+        :param file_path:
+        :return: True if the given path is expected to be written as a contribution HDF5 file, False otherwise
+        """
+        return file_path.lower().endswith(ContribFileWriter.FILE_EXT)
+
+    def append(self, timestamp, contrib_links, ages=None, groups=None):
+        """
+        Schedules the writing of the contributions of one time step. Blocks only if too many steps are waiting.
+        :param timestamp: Integer timestamp of the step
+        :param contrib_links: OutletContributions object as given by DomainSnapshot.get_contributions() or dictionary
+                              as given by DomainSnapshot.get_contributing_links(). None for no particles.
+        :param ages: OutletAges object of the step, None if ages are not tracked
+        :param groups: List of GroupContributions objects of the step, one for each mapping of links into groups
+        :return: True if scheduled, False if the writer already failed
+        """
+        if self._error is not None:
+            return False
+        self._queue.put((timestamp, contrib_links, ages, groups))
+        return True
+
+    def flush(self):
+        """
+        Waits for all scheduled steps to be written, e.g. before checkpointing
+        :return: True if all steps were written, False otherwise
+        """
+        if self._thread is None:
+            return self._error is None
+        self._queue.join()
+        return self._error is None
+
+    def close(self):
+        """
+        Waits for all scheduled steps to be written and closes the file
+        :return: True if all steps were written, False otherwise
+        """
+        if self._thread is None:
+            return self._error is None
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            print("Failed writing '{0}': {1}".format(self._file_path, self._error))
+            return False
+        print("Wrote file '{0}'.".format(self._file_path))
+        return True
+
+    def _write_loop(self):
+        """
+        Main function of the writer thread
+        :return:
+        """
+        try:
+            while True:
+                cur_item = self._queue.get()
+                if cur_item is None:
+                    self._queue.task_done()
+                    break
+                try:
+                    self._write_step(*cur_item)
+                finally:
+                    self._queue.task_done()
+        except Exception as e:
+            self._error = e
+            # keep consuming so that the tracking loop never gets blocked
+            while True:
+                cur_item = self._queue.get()
+                self._queue.task_done()
+                if cur_item is None:
+                    break
+        finally:
+            self._hdf_file.close()
+
+    def _write_step(self, timestamp, contrib_links, ages, groups):
+        """
+        Appends one time step to the group of its outlet
+        :param timestamp:
+        :param contrib_links:
+        :param ages:
+        :param groups:
+        :return:
+        """
+
+        if (contrib_links is None) or isinstance(contrib_links, dict):
+            outlet_link_id = None if contrib_links is None else contrib_links.get("outlet_link_id")
+            discharge = None if contrib_links is None else contrib_links.get("discharge")
+        else:
+            outlet_link_id, discharge = contrib_links.outlet_link_id, contrib_links.discharge
+        src_link_ids, src_layers, counts = ContribFileWriter.flatten(contrib_links)
+        outlet_group = self._get_outlet_group(-1 if outlet_link_id is None else outlet_link_id)
+
+        num_steps = outlet_group["timestamp"].shape[0]
+        num_rows = outlet_group["count"].shape[0]
+        ContribFileWriter._append_values(outlet_group["timestamp"], [timestamp])
+        ContribFileWriter._append_values(outlet_group["discharge"], [np.nan if discharge is None else discharge])
+        ContribFileWriter._append_values(outlet_group["row_ptr"], [num_rows + len(counts)])
+        ContribFileWriter._append_values(outlet_group["src_link_id"], src_link_ids)
+        ContribFileWriter._append_values(outlet_group["src_layer"], src_layers)
+        ContribFileWriter._append_values(outlet_group["count"], counts)
+
+        # one array per step, zeros for the steps that did not give it
+        step_arrays = [] if ages is None else [(ContribFileWriter.AGE_DATASET, ages.counts,
+                                                {"bin_width": ages.bin_width})]
+        for cur_groups in ([] if groups is None else groups):
+            step_arrays.append((ContribFileWriter.GROUPS_PREFIX + cur_groups.name, cur_groups.counts,
+                                {"labels": list(cur_groups.labels)}))
+        for cur_name, cur_values, cur_attrs in step_arrays:
+            ContribFileWriter._get_step_dataset(outlet_group, cur_name, cur_values.shape, cur_attrs)
+        for cur_name in ContribFileWriter.get_step_dataset_names(outlet_group):
+            outlet_group[cur_name].resize(num_steps + 1, axis=0)
+        for cur_name, cur_values, _ in step_arrays:
+            outlet_group[cur_name][num_steps] = cur_values
+        outlet_group.attrs["num_steps"] = num_steps + 1
+        self._hdf_file.flush()
+
+    def _get_outlet_group(self, outlet_link_id):
+        """
+        Gets the group of an outlet, creating its empty datasets if needed
+        :param outlet_link_id:
+        :return: h5py Group object
+        """
+
+        group_name = ContribFileWriter.get_group_name(outlet_link_id)
+        if group_name in self._hdf_file:
+            return self._hdf_file[group_name]
+
+        outlet_group = self._hdf_file.create_group(group_name)
+        outlet_group.attrs["outlet_link_id"] = outlet_link_id
+        outlet_group.attrs["num_steps"] = 0
+        for cur_name, cur_dtype in (("timestamp", np.int64), ("discharge", np.float64), ("src_link_id", np.int64),
+                                    ("src_layer", np.int64), ("count", np.int64)):
+            outlet_group.create_dataset(cur_name, shape=(0, ), maxshape=(None, ), dtype=cur_dtype,
+                                        chunks=(ContribFileWriter.CHUNK_ROWS, ), compression="gzip", shuffle=True)
+        outlet_group.create_dataset("row_ptr", data=np.zeros(1, dtype=np.int64), maxshape=(None, ),
+                                    chunks=(ContribFileWriter.CHUNK_ROWS, ), compression="gzip", shuffle=True)
+        self._hdf_file.attrs["outlet_link_ids"] = np.append(self._hdf_file.attrs["outlet_link_ids"],
+                                                            np.int64(outlet_link_id))
+        return outlet_group
+
+    @staticmethod
+    def get_step_dataset_names(outlet_group):
+        """
+
+        :param outlet_group: h5py Group of an outlet
+        :return: List with the names of the datasets holding one array per step (ages and groups)
+        """
+        return [n for n in outlet_group.keys() if (n == ContribFileWriter.AGE_DATASET) or
+                n.startswith(ContribFileWriter.GROUPS_PREFIX)]
+
+    @staticmethod
+    def _get_step_dataset(outlet_group, dataset_name, step_shape, attrs):
+        """
+        Gets a dataset holding one array per step, creating it (with zeros for the steps already written) if needed
+        :param outlet_group: h5py Group of the outlet
+        :param dataset_name:
+        :param step_shape: Shape of the array of each step
+        :param attrs: Dictionary of attributes of the dataset, set when created
+        :return: h5py Dataset of shape (steps, ) + 'step_shape'
+        """
+
+        if dataset_name in outlet_group:
+            return outlet_group[dataset_name]
+        step_dataset = outlet_group.create_dataset(dataset_name, shape=(outlet_group.attrs["num_steps"], ) +
+                                                   tuple(step_shape), maxshape=(None, ) + tuple(step_shape),
+                                                   dtype=np.int64, chunks=(16, ) + tuple(step_shape),
+                                                   compression="gzip", shuffle=True)
+        for cur_key, cur_value in attrs.items():
+            step_dataset.attrs[cur_key] = cur_value
+        return step_dataset
+
+    def _truncate(self, num_steps):
+        """
+        Drops the steps of all outlets after the first 'num_steps' ones, e.g. written after the resumed checkpoint
+        :param num_steps:
+        :return:
+        """
+
+        for cur_outlet_link_id in self._hdf_file.attrs["outlet_link_ids"].tolist():
+            outlet_group = self._hdf_file[ContribFileWriter.get_group_name(cur_outlet_link_id)]
+            cur_num_steps = min(int(outlet_group.attrs["num_steps"]), num_steps)
+            num_rows = int(outlet_group["row_ptr"][cur_num_steps])
+            outlet_group["timestamp"].resize((cur_num_steps, ))
+            outlet_group["discharge"].resize((cur_num_steps, ))
+            outlet_group["row_ptr"].resize((cur_num_steps + 1, ))
+            for cur_name in ("src_link_id", "src_layer", "count"):
+                outlet_group[cur_name].resize((num_rows, ))
+            for cur_name in ContribFileWriter.get_step_dataset_names(outlet_group):
+                outlet_group[cur_name].resize(cur_num_steps, axis=0)
+            outlet_group.attrs["num_steps"] = cur_num_steps
+        self._hdf_file.flush()
+
+    @staticmethod
+    def get_group_name(outlet_link_id):
+        return "outlet_{0}".format(outlet_link_id)
+
+    @staticmethod
+    def flatten(contrib_links):
+        """
+        Converts a contributions dictionary into rows of (source link id, source layer, number of particles)
+        :param contrib_links: Dictionary as given by DomainSnapshot.get_contributing_links(). None for no particles.
+                              An OutletContributions object already holds the rows.
+        :return: Three arrays of int64
+        """
+
+        if (contrib_links is not None) and (not isinstance(contrib_links, dict)):
+            return contrib_links.src_link_ids, contrib_links.src_layers, contrib_links.counts
+
+        src_link_ids, src_layers, counts = [], [], []
+        if contrib_links is not None:
+            for cur_key, cur_layers in contrib_links.items():
+                if isinstance(cur_key, str):
+                    continue                                          # "discharge", "outlet_link_id", "ages"...
+                for cur_layer, cur_count in cur_layers.items():
+                    src_link_ids.append(cur_key)
+                    src_layers.append(cur_layer)
+                    counts.append(cur_count)
+        return (np.array(src_link_ids, dtype=np.int64), np.array(src_layers, dtype=np.int64),
+                np.array(counts, dtype=np.int64))
+
+    @staticmethod
+    def _append_values(dataset, values):
+        """
+
+        :param dataset: Resizable 1D h5py Dataset
+        :param values: Sequence of values to be appended
+        :return:
+        """
+        if len(values) == 0:
+            return
+        cur_size = dataset.shape[0]
+        dataset.resize((cur_size + len(values), ))
+        dataset[cur_size:] = values
+
+    def __init__(self, file_path, queue_size=None, resume_steps=None):
+        """
+        Creates (or overwrites) the file and starts the writer thread
+        :param file_path:
+        :param queue_size: Maximum number of steps waiting to be written. If None, QUEUE_SIZE is used.
+        :param resume_steps: If given, an existing contribution file is kept with only its first 'resume_steps' steps
+                             and new steps are appended after them
+        """
+
+        self._file_path = file_path
+        folder_path = os.path.dirname(file_path)
+        if (folder_path != "") and (not os.path.exists(folder_path)):
+            os.makedirs(folder_path)
+        if (resume_steps is not None) and os.path.exists(file_path):
+            self._hdf_file = h5py.File(file_path, "a")
+            if self._hdf_file.attrs.get("format") == ContribFileWriter.FORMAT_NAME:
+                self._truncate(resume_steps)
+            else:
+                print("File '{0}' is not a contribution file, overwriting it.".format(file_path))
+                self._hdf_file.close()
+                self._hdf_file = None
+        if self._hdf_file is None:
+            self._hdf_file = h5py.File(file_path, "w")
+            self._hdf_file.attrs["format"] = ContribFileWriter.FORMAT_NAME
+            self._hdf_file.attrs["version"] = ContribFileWriter.FORMAT_VERSION
+            self._hdf_file.attrs["outlet_link_ids"] = np.zeros(0, dtype=np.int64)
+        self._queue = queue.Queue(maxsize=ContribFileWriter.QUEUE_SIZE if queue_size is None else queue_size)
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# Dynamic Class - Lazy view over the time steps of one outlet in a contribution file
+class ContribFile:
+    LAYERS = (-1, -2, -3, -4, 1)  # source layer of the ages and group counts arrays, as in LayerCounters.LAYERS
+
+    outlet_link_id = None         # link id of the outlet
+    timestamps = None             # array of timestamps of the steps in the view
+    discharges = None             # array of outlet discharges of the steps in the view
+    _hdf_file = None              # open h5py File object
+    _outlet_group = None          # h5py Group of the outlet
+    _row_ptr = None               # CSR row pointers of the steps in the view (absolute rows in the file)
+    _first_step = None            # position of the first step of the view in the file
+
+    @property
+    def age_bin_width(self):
+        """
+
+        :return: Seconds per bin of the age histograms, None if the file has no ages
+        """
+        if ContribFileWriter.AGE_DATASET not in self._outlet_group:
+            return None
+        return int(self._outlet_group[ContribFileWriter.AGE_DATASET].attrs["bin_width"])
+
+    @property
+    def group_names(self):
+        """
+
+        :return: List with the names of the mappings of links into groups in the file
+        """
+        return [n[len(ContribFileWriter.GROUPS_PREFIX):]
+                for n in ContribFileWriter.get_step_dataset_names(self._outlet_group)
+                if n.startswith(ContribFileWriter.GROUPS_PREFIX)]
+
+    @property
+    def num_steps(self):
+        return len(self.timestamps)
+
+    def get_rows(self, first_step=0, end_step=None):
+        """
+        Reads the particle counts of a range of steps. Only the file chunks holding these rows are read.
+        :param first_step: First step of the range (position in 'timestamps')
+        :param end_step: Step after the last one of the range. If None, the last step of the view.
+        :return: Tuple of arrays (step of each row relative to 'first_step', source link id, source layer, count)
+        """
+
+        end_step = self.num_steps if end_step is None else end_step
+        first_row, end_row = int(self._row_ptr[first_step]), int(self._row_ptr[end_step])
+        rows_per_step = np.diff(self._row_ptr[first_step:end_step + 1])
+        return (np.repeat(np.arange(end_step - first_step, dtype=np.int64), rows_per_step),
+                self._outlet_group["src_link_id"][first_row:end_row],
+                self._outlet_group["src_layer"][first_row:end_row],
+                self._outlet_group["count"][first_row:end_row])
+
+    def get_age_counts(self, first_step=0, end_step=None):
+        """
+        Reads the age histograms of a range of steps
+        :param first_step: First step of the range (position in 'timestamps')
+        :param end_step: Step after the last one of the range. If None, the last step of the view.
+        :return: Array (steps x LayerCounters.LAYERS x bins), None if the file has no ages
+        """
+
+        if ContribFileWriter.AGE_DATASET not in self._outlet_group:
+            return None
+        end_step = self.num_steps if end_step is None else end_step
+        return self._outlet_group[ContribFileWriter.AGE_DATASET][self._first_step + first_step:
+                                                                 self._first_step + end_step]
+
+    def get_group_counts(self, group_name, first_step=0, end_step=None):
+        """
+        Reads the contributions by group of source links of a range of steps
+        :param group_name: Name of the mapping of links into groups
+        :param first_step: First step of the range (position in 'timestamps')
+        :param end_step: Step after the last one of the range. If None, the last step of the view.
+        :return: Tuple (list of group labels, array (steps x groups x LayerCounters.LAYERS)), None if the file has
+                 no such mapping
+        """
+
+        dataset_name = ContribFileWriter.GROUPS_PREFIX + group_name
+        if dataset_name not in self._outlet_group:
+            return None
+        end_step = self.num_steps if end_step is None else end_step
+        return [str(v) for v in self._outlet_group[dataset_name].attrs["labels"]], \
+            self._outlet_group[dataset_name][self._first_step + first_step:self._first_step + end_step]
+
+    def get_step_dict(self, step):
+        """
+        Gets one step in the same structure as DomainSnapshot.get_contributing_links(), plus the "ages" and "groups" of
+        the pickled contributions if the file has them
+        :param step: Position in 'timestamps'
+        :return: Dictionary
+        """
+
+        ret_dict = {"discharge": float(self.discharges[step]), "outlet_link_id": self.outlet_link_id}
+        _, src_link_ids, src_layers, counts = self.get_rows(step, step + 1)
+        for cur_link_id, cur_layer, cur_count in zip(src_link_ids.tolist(), src_layers.tolist(), counts.tolist()):
+            ret_dict.setdefault(cur_link_id, {})[cur_layer] = cur_count
+        age_counts = self.get_age_counts(step, step + 1)
+        if age_counts is not None:
+            ret_dict["ages"] = ContribFile._get_ages_dict(self.age_bin_width, age_counts[0])
+        for cur_group_name in self.group_names:
+            labels, group_counts = self.get_group_counts(cur_group_name, step, step + 1)
+            ret_dict.setdefault("groups", {})[cur_group_name] = ContribFile._get_groups_dict(labels, group_counts[0])
+        return ret_dict
+
+    @staticmethod
+    def _get_ages_dict(bin_width, age_counts):
+        """
+        Same as OutletAges.to_dict
+        :param bin_width:
+        :param age_counts: Array (source layers x bins)
+        :return:
+        """
+        return {"bin_width": bin_width, "counts": dict(zip(ContribFile.LAYERS, age_counts.tolist()))}
+
+    @staticmethod
+    def _get_groups_dict(labels, group_counts):
+        """
+        Same as GroupContributions.to_dict
+        :param labels:
+        :param group_counts: Array (groups x source layers)
+        :return:
+        """
+        return {"labels": list(labels), "counts": dict(zip(ContribFile.LAYERS, group_counts.T.tolist()))}
+
+    def get_counts_by_class(self, links_classes, total_classes):
+        """
+        Sums up the particles of each step by class of their source link, separating the ones that were in the domain
+        since the beginning (negative source layers) from the ones that came from rain
+        :param links_classes: Dictionary of [link_id]->class, from 1 to 'total_classes'
+        :param total_classes:
+        :return: Tuple of arrays (old particles (steps x classes), rain particles (steps x classes), all particles by
+                 step)
+        """
+
+        classified_ids = np.array(list(links_classes.keys()), dtype=np.int64)
+        classified_vals = np.array(list(links_classes.values()), dtype=np.int64)
+        ids_order = np.argsort(classified_ids)
+        classified_ids, classified_vals = classified_ids[ids_order], classified_vals[ids_order]
+
+        rows_step, src_link_ids, src_layers, counts = self.get_rows()
+        rows_class = np.zeros(len(src_link_ids), dtype=np.int64)
+        if len(classified_ids) > 0:
+            rows_pos = np.minimum(np.searchsorted(classified_ids, src_link_ids), len(classified_ids) - 1)
+            found = classified_ids[rows_pos] == src_link_ids
+            rows_class[found] = classified_vals[rows_pos[found]]
+        in_classes = (rows_class >= 1) & (rows_class <= total_classes)
+        is_old = src_layers < 0
+
+        total_counts = np.bincount(rows_step, weights=counts, minlength=self.num_steps)
+        ret_counts = []
+        for cur_selection in (in_classes & is_old, in_classes & (~is_old)):
+            flat_idx = rows_step[cur_selection] * total_classes + (rows_class[cur_selection] - 1)
+            ret_counts.append(np.bincount(flat_idx, weights=counts[cur_selection],
+                                          minlength=self.num_steps * total_classes).reshape(self.num_steps,
+                                                                                            total_classes))
+        return ret_counts[0], ret_counts[1], total_counts
+
+    def close(self):
+        if self._hdf_file is not None:
+            self._hdf_file.close()
+            self._hdf_file = None
+
+    def __init__(self, hdf_file, outlet_group, ini_timestamp=None, end_timestamp=None):
+        """
+        Use ContribFileReader.open() instead
+        :param hdf_file: Open h5py File
+        :param outlet_group: h5py Group of the outlet
+        :param ini_timestamp: First timestamp of the view. If None, the first one of the file.
+        :param end_timestamp: Last timestamp of the view (inclusive). If None, the last one of the file.
+        """
+
+        self._hdf_file = hdf_file
+        self._outlet_group = outlet_group
+        self.outlet_link_id = int(outlet_group.attrs["outlet_link_id"])
+        num_steps = int(outlet_group.attrs["num_steps"])
+        all_timestamps = outlet_group["timestamp"][:num_steps]
+        first_step = 0 if ini_timestamp is None else int(np.searchsorted(all_timestamps, ini_timestamp, side='left'))
+        end_step = num_steps if end_timestamp is None else \
+            int(np.searchsorted(all_timestamps, end_timestamp, side='right'))
+        end_step = max(end_step, first_step)
+        self.timestamps = all_timestamps[first_step:end_step]
+        self.discharges = outlet_group["discharge"][first_step:end_step]
+        self._first_step = first_step
+        self._row_ptr = outlet_group["row_ptr"][first_step:end_step + 1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# Static Class - Reads contribution files written by ContribFileWriter
+class ContribFileReader:
+
+    @staticmethod
+    def open(file_path, outlet_link_id=None, ini_timestamp=None, end_timestamp=None):
+        """
+        Opens one outlet of a contribution file for lazy reading
+        :param file_path:
+        :param outlet_link_id: Outlet to be read. If None, the first one of the file.
+        :param ini_timestamp: First timestamp to be considered. If None, since the first one of the file.
+        :param end_timestamp: Last timestamp to be considered. If None, up to the last one of the file.
+        :return: ContribFile object (to be closed), None if file/outlet could not be read
+        """
+
+        if not os.path.exists(file_path):
+            print("File '{0}' does not exist.".format(file_path))
+            return None
+
+        hdf_file = h5py.File(file_path, "r")
+        if hdf_file.attrs.get("format") != ContribFileWriter.FORMAT_NAME:
+            print("File '{0}' is not a contribution file.".format(file_path))
+            hdf_file.close()
+            return None
+        if outlet_link_id is None:
+            if len(hdf_file.attrs["outlet_link_ids"]) == 0:
+                print("No outlet in file '{0}'.".format(file_path))
+                hdf_file.close()
+                return None
+            outlet_link_id = int(hdf_file.attrs["outlet_link_ids"][0])
+        group_name = ContribFileWriter.get_group_name(outlet_link_id)
+        if group_name not in hdf_file:
+            print("No outlet {0} in file '{1}'.".format(outlet_link_id, file_path))
+            hdf_file.close()
+            return None
+        return ContribFile(hdf_file, hdf_file[group_name], ini_timestamp=ini_timestamp, end_timestamp=end_timestamp)
+
+    @staticmethod
+    def read_as_dict(file_path, outlet_link_id=None):
+        """
+        Reads a contribution file into the dictionary structure of the pickled contribution files
+        :param file_path:
+        :param outlet_link_id: Outlet to be read. If None, the first one of the file.
+        :return: Dictionary of [timestamp]->contributions dictionary, None if file/outlet could not be read
+        """
+
+        contrib_file = ContribFileReader.open(file_path, outlet_link_id=outlet_link_id)
+        if contrib_file is None:
+            return None
+
+        with contrib_file:
+            all_timestamps = contrib_file.timestamps.tolist()
+            discharges = contrib_file.discharges.tolist()
+            rows_step, src_link_ids, src_layers, counts = contrib_file.get_rows()
+            age_bin_width, age_counts = contrib_file.age_bin_width, contrib_file.get_age_counts()
+            all_groups = dict([(n, contrib_file.get_group_counts(n)) for n in contrib_file.group_names])
+
+        ret_dict = {}
+        for cur_step, (cur_timestamp, cur_discharge) in enumerate(zip(all_timestamps, discharges)):
+            ret_dict[cur_timestamp] = {"discharge": cur_discharge, "outlet_link_id": contrib_file.outlet_link_id}
+            if age_counts is not None:
+                ret_dict[cur_timestamp]["ages"] = ContribFile._get_ages_dict(age_bin_width, age_counts[cur_step])
+            for cur_group_name, (labels, group_counts) in all_groups.items():
+                ret_dict[cur_timestamp].setdefault("groups", {})[cur_group_name] = \
+                    ContribFile._get_groups_dict(labels, group_counts[cur_step])
+        for cur_step, cur_link_id, cur_layer, cur_count in zip(rows_step.tolist(), src_link_ids.tolist(),
+                                                               src_layers.tolist(), counts.tolist()):
+            ret_dict[all_timestamps[cur_step]].setdefault(cur_link_id, {})[cur_layer] = cur_count
+        return ret_dict
+
+    def __init__(self):
+        return
@@ -57,5 +57,38 @@ class ArgumentsManager:
         else:
             return None
 
+    @staticmethod
+    def get_int_list(sys_args, arg_id):
+        """
+
+        :param sys_args:
+        :param arg_id:
+        :return: List of integers given separated by commas (e.g. "-link_id 12,34,56")
+        """
+
+        arg_value = ArgumentsManager.get_str(sys_args, arg_id)
+        if arg_value is not None:
+            try:
+                return [int(v) for v in arg_value.split(",") if v.strip() != ""]
+            except ValueError:
+                print("Argument '{0}' is not a list of integers ({1}).".format(arg_id, arg_value))
+                return None
+        else:
+            return None
+
+    @staticmethod
+    def get_str_list(sys_args, arg_id):
+        """
+
+        :param sys_args:
+        :param arg_id:
+        :return: List of strings given separated by commas (e.g. "-groups distance,width")
+        """
+
+        arg_value = ArgumentsManager.get_str(sys_args, arg_id)
+        if arg_value is None:
+            return None
+        return [v.strip() for v in arg_value.split(",") if v.strip() != ""]
+
     def __init__(self):
         return
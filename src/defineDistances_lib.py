@@ -1,3 +1,4 @@
+from networkIndex_lib import NetworkIndex
 import numpy as np
 
 
@@ -28,8 +29,9 @@ class DistancesDefiner:
         print(
         "Starting at {0} -> {1} ({2}).".format(outlet_linkid, dict_topo[outlet_linkid], dict_lengths[outlet_linkid]))
 
-        dict_cumm = {}
-        DistancesDefiner._set_cumulative_distance(outlet_linkid, 0, dict_topo, dict_lengths, dict_cumm)
+        network_index = NetworkIndex.from_upstream_dict(dict_topo)
+        dict_cumm = DistancesDefiner.calculate_links_distances_idx(network_index.get_index(outlet_linkid),
+                                                                   network_index, dict_lengths)
 
         print("Defined cumulative distances for {0} links.".format(len(dict_cumm.keys())))
         max_key = None
@@ -95,8 +97,9 @@ class DistancesDefiner:
             print("Outlet link id not found in topology list: {0}.".format(outlet_linkid))
             return None
 
-        dict_width = {}
-        DistancesDefiner._set_cumulative_width(outlet_linkid, 1, dict_topo, dict_width)
+        network_index = NetworkIndex.from_upstream_dict(dict_topo)
+        dict_width = DistancesDefiner.calculate_links_width_func_idx(network_index.get_index(outlet_linkid),
+                                                                     network_index)
 
         print("Defined width funcs. for {0} links.".format(len(dict_width.keys())))
         max_key = None
@@ -153,43 +156,34 @@ class DistancesDefiner:
 
 
     @staticmethod
-    def _set_cumulative_width(parent_link_id, cur_width, dict_topo, dict_width):
+    def calculate_links_distances_idx(outlet_idx, network_index, dict_lengths):
         """
-
-        :param parent_link_id:
-        :param dict_topo:
-        :param dict_width:
-        :return:
+        Linear-time traversal of the network index accumulating link lengths from the outlet upstream
+        :param outlet_idx: Index of the outlet link in 'network_index'
+        :param network_index: NetworkIndex object
+        :param dict_lengths: Dictionary of [link_id]->length
+        :return: Dictionary with the distances of each link id to the outlet of the watershed
         """
 
-        cur_link_accum = 1 + cur_width
-        dict_width[parent_link_id] = cur_link_accum
-        print("Width for {0} : {1}.".format(parent_link_id, cur_link_accum))
-        if dict_topo[parent_link_id] is None:
-            return
-        for cur_par_link_id in dict_topo[parent_link_id]:
-            DistancesDefiner._set_cumulative_width(cur_par_link_id, cur_link_accum, dict_topo, dict_width)
-        return
+        links_length = np.array([dict_lengths.get(cur_link_id, np.nan)
+                                 for cur_link_id in network_index.link_ids.tolist()], dtype=np.float64)
+        links_dist = network_index.accumulate_upstream(outlet_idx, links_length)
+        subbasin_idx = network_index.get_subbasin(outlet_idx)
+        return dict(zip(network_index.link_ids[subbasin_idx].tolist(), links_dist[subbasin_idx].tolist()))
 
     @staticmethod
-    def _set_cumulative_distance(parent_link_id, dist_accumulated, topo_dict, leng_dict, cumulative_dict):
+    def calculate_links_width_func_idx(outlet_idx, network_index):
         """
-
-        :param dist_accumulated:
-        :param topo_dict:
-        :param leng_dict:
-        :param cumulative_dict:
-        :return:
+        Linear-time traversal of the network index counting links from the outlet upstream
+        :param outlet_idx: Index of the outlet link in 'network_index'
+        :param network_index: NetworkIndex object
+        :return: Dictionary with the width function value (outlet is 2, each upstream link adds 1) of each link id
         """
-        cur_link_length = leng_dict[parent_link_id]
-        cur_link_accum = cur_link_length + dist_accumulated
-        cumulative_dict[parent_link_id] = cur_link_accum
-        if topo_dict[parent_link_id] is None:
-            return
-        for cur_par_link_id in topo_dict[parent_link_id]:
-            DistancesDefiner._set_cumulative_distance(cur_par_link_id, cur_link_accum, topo_dict, leng_dict,
-                                                      cumulative_dict)
-        return
+
+        links_width = network_index.accumulate_upstream(outlet_idx, np.ones(network_index.num_links), outlet_value=2)
+        subbasin_idx = network_index.get_subbasin(outlet_idx)
+        return dict(zip(network_index.link_ids[subbasin_idx].tolist(),
+                        links_width[subbasin_idx].astype(np.int64).tolist()))
 
     def __init__(self):
         return
@@ -0,0 +1,290 @@
+from traceOutputs_lib import GblVars, LayerCounters
+import multiprocessing
+import numpy as np
+import copy
+import h5py
+
+
+# Dynamic Class - Set of worker processes moving the particles of several realizations (members) in lockstep
+class EnsemblePool:
+    CMD_STEP = "step"                     # moves all members of the worker by one h5 file
+    CMD_CLOSE = "close"                   # ends the worker process
+
+    _connections = None                   # list of master-side Connection objects, one per worker
+    _processes = None                     # list of Process objects, one per worker
+    _members = None                       # list of arrays with the member numbers held by each worker
+
+    def get_num_members(self):
+        return sum(len(m) for m in self._members)
+
+    def advance(self, h5_file_path, snapshot_content):
+        """
+        Moves all members by one h5 file, the file being read only once by the caller
+        :param h5_file_path:
+        :param snapshot_content: Content of the h5 file (as given by H5Prefetcher.get_snapshot_content)
+        :return: List with, for each member, a dictionary of [outlet id]->OutletContributions before moving
+        """
+
+        for cur_conn in self._connections:
+            cur_conn.send((EnsemblePool.CMD_STEP, (h5_file_path, snapshot_content)))
+        ret_list = [None] * self.get_num_members()
+        for cur_conn, cur_members in zip(self._connections, self._members):
+            for cur_member, cur_contribs in zip(cur_members.tolist(), cur_conn.recv()):
+                ret_list[cur_member] = cur_contribs
+        return ret_list
+
+    def close(self):
+        """
+        Ends all worker processes
+        :return:
+        """
+        if self._connections is None:
+            return
+        for cur_conn in self._connections:
+            try:
+                cur_conn.send((EnsemblePool.CMD_CLOSE, None))
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+        for cur_process in self._processes:
+            cur_process.join()
+        for cur_conn in self._connections:
+            cur_conn.close()
+        self._connections = None
+
+    @staticmethod
+    def _worker_loop(conn, init_snapshot, members, step_function, outlet_link_ids, members_streams):
+        """
+        Main function of each worker process
+        :param conn: Worker-side Connection object
+        :param init_snapshot: DomainSnapshot with the initial condition, copied for each member
+        :param members: Array with the numbers of the members of the worker
+        :param step_function: Function (h5 file path, DomainSnapshot, snapshot content) -> moved DomainSnapshot
+        :param outlet_link_ids: List of link ids whose contributions are replied after each step
+        :param members_streams: List with the RandomStreams of each member of the worker
+        :return:
+        """
+
+        snapshots = [copy.deepcopy(init_snapshot) for _ in members]
+        while True:
+            command, args = conn.recv()
+
+            if command == EnsemblePool.CMD_STEP:
+                h5_file_path, snapshot_content = args
+                all_contribs = []
+                for i in range(len(snapshots)):
+                    GblVars.random_streams = members_streams[i]
+                    next_snapshot = step_function(h5_file_path, snapshots[i], snapshot_content)
+                    all_contribs.append(snapshots[i].get_outlets_contributions(outlet_link_ids, aggregate_rain=True))
+                    snapshots[i] = next_snapshot
+                conn.send(all_contribs)
+
+            elif command == EnsemblePool.CMD_CLOSE:
+                break
+
+        conn.close()
+
+    def __init__(self, init_snapshot, num_members, num_workers, step_function, outlet_link_ids, random_streams):
+        """
+
+        :param init_snapshot: DomainSnapshot with the initial condition of all members
+        :param num_members: Number of realizations
+        :param num_workers: Number of worker processes (at most 'num_members')
+        :param step_function: Function (h5 file path, DomainSnapshot, snapshot content) -> moved DomainSnapshot
+        :param outlet_link_ids: List of link ids whose contributions are wanted
+        :param random_streams: RandomStreams of the ensemble. Each member gets its own spawned streams, whatever the
+                               number of workers.
+        """
+
+        num_workers = max(min(int(num_workers), int(num_members)), 1)
+        self._members = np.array_split(np.arange(num_members), num_workers)
+        all_members_streams = random_streams.spawn(num_members)
+        self._connections = []
+        self._processes = []
+
+        # fork keeps workers from re-running the calling script and shares the domain built so far
+        mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() \
+            else multiprocessing.get_context()
+        for cur_members in self._members:
+            master_conn, worker_conn = mp_context.Pipe()
+            cur_process = mp_context.Process(target=EnsemblePool._worker_loop,
+                                             args=(worker_conn, init_snapshot, cur_members, step_function,
+                                                   list(outlet_link_ids),
+                                                   [all_members_streams[m] for m in cur_members.tolist()]))
+            cur_process.daemon = True
+            cur_process.start()
+            worker_conn.close()
+            self._connections.append(master_conn)
+            self._processes.append(cur_process)
+
+        print("Started {0} ensemble workers ({1} members).".format(len(self._processes), num_members))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Dynamic Class - Streaming statistics of the contributions of the members to one outlet at one time step
+class EnsembleStats:
+    outlet_link_id = None         # link id of the outlet
+    src_link_ids = None           # array of the link ids draining into the outlet, one row of the statistics each
+    quantiles = None              # array of the quantiles wanted, in [0, 1]
+    discharge = None              # discharge of the outlet (the same for all members)
+    _link_rows = None             # array with the row of each link index of the domain, -1 if not upstream
+    _num_members = None           # number of members added so far
+    _mean = None                  # array (links x LayerCounters.LAYERS) of running means
+    _m2 = None                    # array (links x LayerCounters.LAYERS) of running sums of squared deviations
+    _values = None                # list with the counts array of each member, for the quantiles
+
+    def add(self, contribs):
+        """
+        Adds the contributions of one member, updating mean and variance with Welford's algorithm
+        :param contribs: OutletContributions object with aggregated rain, None for no particles
+        :return:
+        """
+
+        cur_counts = np.zeros(self._mean.shape, dtype=np.float64)
+        if contribs is not None:
+            rows = self._link_rows[GblVars.network_index.get_indices(contribs.src_link_ids)]
+            np.add.at(cur_counts, (rows, LayerCounters.get_columns(contribs.src_layers)), contribs.counts)
+            self.discharge = contribs.discharge if self.discharge is None else self.discharge
+
+        self._num_members += 1
+        delta = cur_counts - self._mean
+        self._mean += delta / self._num_members
+        self._m2 += delta * (cur_counts - self._mean)
+        self._values.append(cur_counts)
+
+    def get_mean(self):
+        return self._mean
+
+    def get_std(self):
+        """
+
+        :return: Array (links x LayerCounters.LAYERS) of sample standard deviations, zeros for a single member
+        """
+        if self._num_members < 2:
+            return np.zeros(self._mean.shape, dtype=np.float64)
+        return np.sqrt(self._m2 / (self._num_members - 1))
+
+    def get_quantiles(self):
+        """
+
+        :return: Array (quantiles x links x LayerCounters.LAYERS)
+        """
+        return np.quantile(np.stack(self._values), self.quantiles, axis=0)
+
+    def reset(self):
+        """
+        Forgets all members, e.g. for the next time step
+        :return:
+        """
+        self.discharge = None
+        self._num_members = 0
+        self._mean = np.zeros((len(self.src_link_ids), len(LayerCounters.LAYERS)), dtype=np.float64)
+        self._m2 = np.zeros(self._mean.shape, dtype=np.float64)
+        self._values = []
+
+    def __init__(self, outlet_link_id, quantiles):
+        """
+
+        :param outlet_link_id: Link id of the outlet, in GblVars.network_index
+        :param quantiles: Sequence of quantiles wanted, in [0, 1]
+        """
+        outlet_idx = GblVars.network_index.get_index(outlet_link_id)
+        upstream_idx = np.sort(GblVars.network_index.get_subbasin(outlet_idx))
+        self.outlet_link_id = outlet_link_id
+        self.src_link_ids = GblVars.network_index.link_ids[upstream_idx].astype(np.int64)
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self._link_rows = np.full(GblVars.network_index.num_links, -1, dtype=np.int64)
+        self._link_rows[upstream_idx] = np.arange(len(upstream_idx))
+        self.reset()
+
+
+# Dynamic Class - Writes the statistics of the contributions of an ensemble into an HDF5 file, step by step
+class EnsembleFileWriter:
+    FORMAT_NAME = "asynch_parttrack_ensemble"
+    FORMAT_VERSION = 1
+
+    _file_path = None             # path of the HDF5 file being written
+    _hdf_file = None              # h5py File object
+
+    @staticmethod
+    def get_group_name(outlet_link_id):
+        return "outlet_{0}".format(outlet_link_id)
+
+    def append(self, timestamp, stats):
+        """
+        Appends one time step to the group of its outlet
+        :param timestamp: Integer timestamp of the step
+        :param stats: EnsembleStats object with all members added
+        :return:
+        """
+
+        outlet_group = self._get_outlet_group(stats)
+        num_steps = outlet_group["timestamp"].shape[0]
+        for cur_name, cur_value in (("timestamp", timestamp),
+                                    ("discharge", np.nan if stats.discharge is None else stats.discharge),
+                                    ("mean", stats.get_mean()), ("std", stats.get_std()),
+                                    ("quantile", stats.get_quantiles())):
+            outlet_group[cur_name].resize(num_steps + 1, axis=0)
+            outlet_group[cur_name][num_steps] = cur_value
+        outlet_group.attrs["num_steps"] = num_steps + 1
+        self._hdf_file.flush()
+
+    def close(self):
+        """
+
+        :return:
+        """
+        if self._hdf_file is None:
+            return
+        self._hdf_file.close()
+        self._hdf_file = None
+        print("Wrote file '{0}'.".format(self._file_path))
+
+    def _get_outlet_group(self, stats):
+        """
+        Gets the group of an outlet, creating its empty datasets if needed
+        :param stats: EnsembleStats object of the outlet
+        :return: h5py Group object
+        """
+
+        group_name = EnsembleFileWriter.get_group_name(stats.outlet_link_id)
+        if group_name in self._hdf_file:
+            return self._hdf_file[group_name]
+
+        num_links, num_layers = len(stats.src_link_ids), len(LayerCounters.LAYERS)
+        outlet_group = self._hdf_file.create_group(group_name)
+        outlet_group.attrs["outlet_link_id"] = stats.outlet_link_id
+        outlet_group.attrs["num_steps"] = 0
+        outlet_group.create_dataset("src_link_id", data=stats.src_link_ids)
+        outlet_group.create_dataset("src_layer", data=np.array(LayerCounters.LAYERS, dtype=np.int64))
+        outlet_group.create_dataset("quantiles", data=stats.quantiles)
+        for cur_name, cur_shape in (("timestamp", ()), ("discharge", ()), ("mean", (num_links, num_layers)),
+                                    ("std", (num_links, num_layers)),
+                                    ("quantile", (len(stats.quantiles), num_links, num_layers))):
+            outlet_group.create_dataset(cur_name, shape=(0, ) + cur_shape, maxshape=(None, ) + cur_shape,
+                                        dtype=np.int64 if cur_name == "timestamp" else np.float64,
+                                        chunks=(64 if len(cur_shape) == 0 else 1, ) + cur_shape,
+                                        compression="gzip" if len(cur_shape) > 0 else None)
+        return outlet_group
+
+    def __init__(self, file_path, num_members):
+        """
+
+        :param file_path: Path of the HDF5 file, replaced if existing
+        :param num_members: Number of members of the ensemble
+        """
+        self._file_path = file_path
+        self._hdf_file = h5py.File(file_path, "w")
+        self._hdf_file.attrs["format"] = EnsembleFileWriter.FORMAT_NAME
+        self._hdf_file.attrs["version"] = EnsembleFileWriter.FORMAT_VERSION
+        self._hdf_file.attrs["num_members"] = num_members
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
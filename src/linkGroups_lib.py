@@ -0,0 +1,164 @@
+from traceOutputs_lib import LayerCounters
+from defineDistances_lib import DistancesDefiner
+import numpy as np
+import os
+
+
+# Dynamic Class - Mapping of the links of a domain into groups (distance classes, counties...) by an integer lookup
+class LinkGroups:
+    DISTANCE = "distance"         # classes of distance to the outlet, as in the plotted hydrographs
+    WIDTH = "width"               # classes of width function, as in the plotted hydrographs
+    NUM_CLASSES = 5               # number of distance or width classes
+
+    name = None                   # name of the mapping, used in the outputs
+    labels = None                 # list with the label (string) of each group
+    _network_index = None         # NetworkIndex the lookup was built for
+    _lookup = None                # array with the group of each link index, -1 for links in no group
+
+    @property
+    def num_groups(self):
+        return len(self.labels)
+
+    def count(self, contribs):
+        """
+        Sums up the contributions to an outlet by group of their source links. Sources in no group are ignored.
+        :param contribs: OutletContributions object
+        :return: A new GroupContributions object
+        """
+
+        links_idx = self._network_index.get_indices(contribs.src_link_ids)
+        rows_group = np.where(links_idx >= 0, self._lookup[links_idx], -1)
+        in_group = rows_group >= 0
+        flat_idx = rows_group[in_group] * len(LayerCounters.LAYERS) + \
+            LayerCounters.get_columns(contribs.src_layers[in_group])
+        counts = np.bincount(flat_idx, weights=contribs.counts[in_group],
+                             minlength=self.num_groups * len(LayerCounters.LAYERS))
+        return GroupContributions(self.name, self.labels,
+                                  counts.astype(np.int64).reshape(self.num_groups, len(LayerCounters.LAYERS)))
+
+    @staticmethod
+    def from_dict(name, links_groups, network_index):
+        """
+
+        :param name: Name of the mapping
+        :param links_groups: Dictionary of [link_id]->group label (all integers or all strings)
+        :param network_index: NetworkIndex of the domain. Links not in it are ignored.
+        :return: A new LinkGroups object
+        """
+
+        all_labels = sorted(set(links_groups.values()))
+        labels_pos = dict([(cur_label, i) for i, cur_label in enumerate(all_labels)])
+        lookup = np.full(network_index.num_links, -1, dtype=np.int64)
+        links_idx = network_index.get_indices(list(links_groups.keys()))
+        links_pos = np.array([labels_pos[v] for v in links_groups.values()], dtype=np.int64)
+        lookup[links_idx[links_idx >= 0]] = links_pos[links_idx >= 0]
+        return LinkGroups(name, [str(v) for v in all_labels], network_index, lookup)
+
+    @staticmethod
+    def read_csv(csv_fpath, csv_separator=","):
+        """
+        Reads a mapping written as lines of "link_id,group" (e.g. by barplot_rain.export_links_classification). Lines
+        whose first field is not a link id (e.g. headers) are skipped.
+        :param csv_fpath:
+        :param csv_separator:
+        :return: Dictionary of [link_id]->group label (integers if all of them are), None if file could not be read
+        """
+
+        if not os.path.exists(csv_fpath):
+            print("File '{0}' does not exist.".format(csv_fpath))
+            return None
+
+        links_groups = {}
+        with open(csv_fpath, "r") as rfile:
+            for cur_line in rfile:
+                cur_line_split = cur_line.strip().split(csv_separator)
+                if len(cur_line_split) < 2:
+                    continue
+                try:
+                    links_groups[int(cur_line_split[0])] = cur_line_split[1].strip()
+                except ValueError:
+                    continue
+
+        try:
+            return dict([(k, int(v)) for k, v in links_groups.items()])
+        except ValueError:
+            return links_groups
+
+    @staticmethod
+    def build(group_spec, outlet_link_ids, network_index):
+        """
+        Builds the mapping of each outlet
+        :param group_spec: LinkGroups.DISTANCE, LinkGroups.WIDTH or path of a CSV file read by 'read_csv'
+        :param outlet_link_ids: List of link ids of the outlets
+        :param network_index: NetworkIndex of the domain, with the length of the links
+        :return: Dictionary of [outlet link id]->LinkGroups object (None for outlets not in the domain), None if the
+                 mapping could not be built
+        """
+
+        # a CSV file gives the same groups to all outlets
+        if group_spec not in (LinkGroups.DISTANCE, LinkGroups.WIDTH):
+            links_groups = LinkGroups.read_csv(group_spec)
+            if links_groups is None:
+                return None
+            link_groups = LinkGroups.from_dict(os.path.splitext(os.path.basename(group_spec))[0], links_groups,
+                                               network_index)
+            return dict([(cur_outlet_id, link_groups) for cur_outlet_id in outlet_link_ids])
+
+        # classes are defined from each outlet
+        ret_dict = {}
+        for cur_outlet_id in outlet_link_ids:
+            cur_outlet_idx = network_index.get_index(cur_outlet_id)
+            if cur_outlet_idx is None:
+                ret_dict[cur_outlet_id] = None
+            elif group_spec == LinkGroups.DISTANCE:
+                links_dist = DistancesDefiner.calculate_links_distances_idx(
+                    cur_outlet_idx, network_index, dict(zip(network_index.link_ids.tolist(),
+                                                            network_index.link_length.tolist())))
+                ret_dict[cur_outlet_id] = LinkGroups.from_dict(
+                    group_spec, DistancesDefiner.classify_links(links_dist, num_classes=LinkGroups.NUM_CLASSES),
+                    network_index)
+            else:
+                links_width = DistancesDefiner.calculate_links_width_func_idx(cur_outlet_idx, network_index)
+                ret_dict[cur_outlet_id] = LinkGroups.from_dict(
+                    group_spec, DistancesDefiner.classify_links_width(links_width,
+                                                                      num_classes=LinkGroups.NUM_CLASSES),
+                    network_index)
+        return ret_dict
+
+    def __init__(self, name, labels, network_index, lookup):
+        """
+        Use LinkGroups.from_dict() or LinkGroups.build() instead
+        :param name:
+        :param labels: List of the labels of the groups
+        :param network_index: NetworkIndex of the domain
+        :param lookup: Array with the group of each link index, -1 for links in no group
+        """
+        self.name = name
+        self.labels = list(labels)
+        self._network_index = network_index
+        self._lookup = lookup
+
+
+# Dynamic Class - Contributions to an outlet at one time step summed up by group of source links
+class GroupContributions:
+    name = None                   # name of the LinkGroups mapping
+    labels = None                 # list with the label of each group
+    counts = None                 # array (groups x LayerCounters.LAYERS) of number of particles (int64)
+
+    def to_dict(self):
+        """
+        Adapter for the pickled contributions
+        :return: Dictionary with the "labels" and the "counts", a dictionary of layer source -> list of counts by group
+        """
+        return {"labels": list(self.labels), "counts": dict(zip(LayerCounters.LAYERS, self.counts.T.tolist()))}
+
+    def __init__(self, name, labels, counts):
+        """
+
+        :param name:
+        :param labels: List of the labels of the groups
+        :param counts: Array (groups x LayerCounters.LAYERS) of number of particles
+        """
+        self.name = name
+        self.labels = labels
+        self.counts = np.asarray(counts, dtype=np.int64)
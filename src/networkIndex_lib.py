@@ -0,0 +1,435 @@
+import numpy as np
+import json
+import os
+
+
+# Dynamic Class - dense integer indexing of the hillslope-links of a domain and their per-link attributes as arrays
+class NetworkIndex:
+    link_ids = None               # array of link ids (int64) - the position of each id is its link index
+    downstream_idx = None         # array with the index of the downstream link of each link (-1 for the outlet)
+    upstream_area = None          # array of upstream areas (km2)
+    hillslope_area = None         # array of hillslope areas (km2)
+    link_length = None            # array of link lengths (km)
+    upstream_ptr = None           # CSR row pointers of the upstream adjacency (number of links + 1)
+    upstream_idx = None           # CSR column of upstream link indexes
+    topo_order = None             # array of link indexes ordered upstream-first (each link after all its upstream)
+    _link_index = None            # dictionary of [link_id]->link index, built when first needed
+    _sorted_ids = None            # sorted copy of 'link_ids' for vectorized lookups
+    _sorted_pos = None            # link index of each element of '_sorted_ids'
+
+    SUBBASINS_PER_PART = 4        # sub-basins cut per part in 'partition_subbasins', the more the better balanced
+
+    ARRAYS = ("link_ids", "downstream_idx", "upstream_area", "hillslope_area", "link_length", "upstream_ptr",
+              "upstream_idx", "topo_order", "_sorted_ids", "_sorted_pos")
+
+    @property
+    def num_links(self):
+        return len(self.link_ids)
+
+    def get_index(self, link_id):
+        """
+
+        :param link_id:
+        :return: Integer with the index of the link, None if link is not in the domain
+        """
+        if self._link_index is None:
+            self._link_index = dict(zip(self.link_ids.tolist(), range(len(self.link_ids))))
+        return self._link_index.get(link_id)
+
+    def get_indices(self, link_ids):
+        """
+        Vectorized version of 'get_index'
+        :param link_ids: Array of link ids
+        :return: Array of link indexes (int32), -1 for link ids not in the domain
+        """
+
+        link_ids = np.asarray(link_ids, dtype=np.int64)
+        if self.num_links == 0:
+            return np.full(link_ids.shape, -1, dtype=np.int32)
+        sorted_pos = np.clip(np.searchsorted(self._sorted_ids, link_ids), 0, self.num_links - 1)
+        found = self._sorted_ids[sorted_pos] == link_ids
+        return np.where(found, self._sorted_pos[sorted_pos], -1).astype(np.int32)
+
+    def get_mask(self, link_ids):
+        """
+
+        :param link_ids: List of link ids
+        :return: Array of booleans, True for the links in the given list (ids not in the domain are ignored)
+        """
+        ret_mask = np.zeros(self.num_links, dtype=bool)
+        link_idx = self.get_indices(link_ids)
+        ret_mask[link_idx[link_idx >= 0]] = True
+        return ret_mask
+
+    def get_upstream_links(self, link_idx):
+        """
+
+        :param link_idx:
+        :return: Array with the indexes of the links draining directly into the given link
+        """
+        return self.upstream_idx[self.upstream_ptr[link_idx]:self.upstream_ptr[link_idx + 1]]
+
+    def get_outlets(self):
+        """
+
+        :return: Array with the indexes of the links draining out of the domain
+        """
+        return np.flatnonzero(self.downstream_idx < 0).astype(np.int32)
+
+    def get_subbasin(self, outlet_idx):
+        """
+        Lists all links draining into a given link, including itself
+        :param outlet_idx: Link index or array of link indexes
+        :return: Array of link indexes, ordered from the outlet(s) upstream, level by level
+        """
+        return np.concatenate(self._walk_upstream(np.atleast_1d(np.asarray(outlet_idx, dtype=np.int32))))
+
+    def accumulate_upstream(self, outlet_idx, values, outlet_value=None):
+        """
+        Sums values along the flow paths from a given outlet towards the headwaters, in linear time
+        :param outlet_idx: Link index of the outlet
+        :param values: Array with one value per link to be summed along the paths
+        :param outlet_value: Initial value of the outlet. If None, values[outlet_idx] is used.
+        :return: Array with the accumulated value of each link of the sub-basin and NaN for links outside it
+        """
+
+        ret_values = np.full(self.num_links, np.nan, dtype=np.float64)
+        ret_values[outlet_idx] = values[outlet_idx] if outlet_value is None else outlet_value
+        for cur_level in self._walk_upstream(np.array([outlet_idx], dtype=np.int32))[1:]:
+            ret_values[cur_level] = ret_values[self.downstream_idx[cur_level]] + values[cur_level]
+        return ret_values
+
+    def get_postorder(self):
+        """
+        Depth-first post-order of the links. Every link comes after all its upstream links and the links of every
+        sub-basin are contiguous.
+        :return: Array of link indexes
+        """
+
+        upstream_ptr = self.upstream_ptr.tolist()
+        upstream_idx = self.upstream_idx.tolist()
+        ret_order = []
+        for cur_outlet in self.get_outlets().tolist():
+            stack = [(cur_outlet, upstream_ptr[cur_outlet])]
+            while stack:
+                cur_link, cur_next = stack[-1]
+                if cur_next < upstream_ptr[cur_link + 1]:
+                    stack[-1] = (cur_link, cur_next + 1)
+                    stack.append((upstream_idx[cur_next], upstream_ptr[upstream_idx[cur_next]]))
+                else:
+                    ret_order.append(cur_link)
+                    stack.pop()
+        return np.array(ret_order, dtype=np.int32)
+
+    def partition_subbasins(self, num_parts, weights=None):
+        """
+        Splits the network into sub-basins of similar weight and distributes them among a number of parts. Sub-basins
+        are cut from the headwaters down as soon as they reach a fraction of the weight expected for each part.
+        :param num_parts: Number of parts (e.g. worker processes)
+        :param weights: Array with the weight of each link. If None, all links weight 1.
+        :return: Array with the part (0 to num_parts-1) of each link
+        """
+
+        num_parts = max(int(num_parts), 1)
+        weights = np.ones(self.num_links, dtype=np.float64) if weights is None else \
+            np.asarray(weights, dtype=np.float64)
+        target_weight = weights.sum() / (num_parts * NetworkIndex.SUBBASINS_PER_PART)
+        downstream_idx = self.downstream_idx.tolist()
+
+        # accumulate weights upstream first, cutting a sub-basin when it is heavy enough
+        acc_weights = weights.tolist()
+        is_root = [d < 0 for d in downstream_idx]
+        for cur_link in self.topo_order.tolist():
+            if acc_weights[cur_link] >= target_weight:
+                is_root[cur_link] = True
+            elif not is_root[cur_link]:
+                acc_weights[downstream_idx[cur_link]] += acc_weights[cur_link]
+
+        # label each link with its sub-basin root, downstream first
+        subbasin_root = list(range(self.num_links))
+        for cur_link in reversed(self.topo_order.tolist()):
+            if not is_root[cur_link]:
+                subbasin_root[cur_link] = subbasin_root[downstream_idx[cur_link]]
+
+        # heaviest sub-basins first, each one to the lightest part so far
+        all_roots = [cur_link for cur_link in range(self.num_links) if is_root[cur_link]]
+        parts_weight = [0.0] * num_parts
+        root_part = {}
+        for cur_root in sorted(all_roots, key=lambda r: -acc_weights[r]):
+            cur_part = parts_weight.index(min(parts_weight))
+            root_part[cur_root] = cur_part
+            parts_weight[cur_part] += acc_weights[cur_root]
+
+        return np.array([root_part[cur_root] for cur_root in subbasin_root], dtype=np.int32)
+
+    def reordered(self, new_order):
+        """
+        Creates a copy of the index with links renumbered
+        :param new_order: Array of current link indexes in their new order
+        :return: A new NetworkIndex object in which link new_order[i] has index i
+        """
+
+        new_order = np.asarray(new_order, dtype=np.int32)
+        old_to_new = np.full(self.num_links + 1, -1, dtype=np.int32)      # extra last position maps -1 to -1
+        old_to_new[new_order] = np.arange(len(new_order), dtype=np.int32)
+        return NetworkIndex(self.link_ids[new_order], old_to_new[self.downstream_idx[new_order]],
+                            self.upstream_area[new_order], self.hillslope_area[new_order],
+                            self.link_length[new_order])
+
+    def renumbered(self):
+        """
+        Renumbers links in depth-first post-order, so that the links of a sub-basin sit together in memory
+        :return: A new NetworkIndex object
+        """
+        return self.reordered(self.get_postorder())
+
+    def pruned(self, outlet_idx):
+        """
+        Creates a copy of the index restricted to the links draining into the given links
+        :param outlet_idx: Link index or array of link indexes of the outlets of the sub-basins to be kept
+        :return: A new NetworkIndex object, with the links in the same relative order and the most downstream outlets
+                 draining out
+        """
+        return self.reordered(np.unique(self.get_subbasin(outlet_idx)))
+
+    def _walk_upstream(self, start_idx):
+        """
+        Breadth-first traversal over the upstream adjacency
+        :param start_idx: Array of link indexes to start from
+        :return: List of arrays of link indexes, one per level
+        """
+
+        ret_levels = [start_idx]
+        cur_level = start_idx
+        while len(cur_level) > 0:
+            cur_starts = self.upstream_ptr[cur_level]
+            cur_counts = self.upstream_ptr[cur_level + 1] - cur_starts
+            cur_total = int(cur_counts.sum())
+            if cur_total == 0:
+                break
+            cur_offsets = np.repeat(cur_starts - np.cumsum(cur_counts) + cur_counts, cur_counts) + \
+                np.arange(cur_total)
+            cur_level = self.upstream_idx[cur_offsets]
+            ret_levels.append(cur_level)
+        return ret_levels
+
+    def to_upstream_dict(self):
+        """
+        Inverse of 'from_upstream_dict'
+        :return: Dictionary of [link_id]->list of upstream link ids (None for headwater links)
+        """
+
+        upstream_ids = self.link_ids[self.upstream_idx].tolist()
+        upstream_ptr = self.upstream_ptr.tolist()
+        ret_dict = {}
+        for cur_link_idx, cur_link_id in enumerate(self.link_ids.tolist()):
+            cur_up_ids = upstream_ids[upstream_ptr[cur_link_idx]:upstream_ptr[cur_link_idx + 1]]
+            ret_dict[cur_link_id] = cur_up_ids if len(cur_up_ids) > 0 else None
+        return ret_dict
+
+    def save(self, folder_path):
+        """
+        Writes all arrays of the index as .npy files in a folder
+        :param folder_path:
+        :return:
+        """
+
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        for cur_array_name in NetworkIndex.ARRAYS:
+            np.save(os.path.join(folder_path, "{0}.npy".format(cur_array_name.strip("_"))),
+                    getattr(self, cur_array_name))
+
+    @staticmethod
+    def load(folder_path, mmap=True):
+        """
+        Reads an index written by 'save'
+        :param folder_path:
+        :param mmap: If True, arrays are memory-mapped (read-only) instead of read into memory
+        :return: A new NetworkIndex object, None if some file is missing
+        """
+
+        ret_obj = NetworkIndex.__new__(NetworkIndex)
+        for cur_array_name in NetworkIndex.ARRAYS:
+            cur_file_path = os.path.join(folder_path, "{0}.npy".format(cur_array_name.strip("_")))
+            if not os.path.exists(cur_file_path):
+                print("Missing network index file '{0}'.".format(cur_file_path))
+                return None
+            setattr(ret_obj, cur_array_name, np.load(cur_file_path, mmap_mode='r' if mmap else None))
+        return ret_obj
+
+    @staticmethod
+    def from_upstream_dict(dict_topo):
+        """
+        Builds an index without attributes from a dictionary as the one read from .rvr files by the plotting scripts
+        :param dict_topo: Dictionary of [link_id]->list of upstream link ids (or None)
+        :return: A new NetworkIndex object
+        """
+
+        link_ids = np.array(list(dict_topo.keys()), dtype=np.int64)
+        link_index = dict(zip(link_ids.tolist(), range(len(link_ids))))
+        downstream_idx = np.full(len(link_ids), -1, dtype=np.int32)
+        for cur_link_id, cur_up_ids in dict_topo.items():
+            if cur_up_ids is None:
+                continue
+            for cur_up_id in cur_up_ids:
+                if cur_up_id in link_index:
+                    downstream_idx[link_index[cur_up_id]] = link_index[cur_link_id]
+        no_values = np.full(len(link_ids), np.nan, dtype=np.float64)
+        return NetworkIndex(link_ids, downstream_idx, no_values, no_values, no_values)
+
+    @staticmethod
+    def from_topology(topology):
+        """
+        Builds the index from a dictionary of HillslopeLinkPrm objects. Links keep the order of the dictionary.
+        :param topology: Dictionary of [link_id]->HillslopeLinkPrm, with parameters already filled
+        :return: A new NetworkIndex object
+        """
+
+        all_hl_prms = list(topology.values())
+        link_ids = np.array(list(topology.keys()), dtype=np.int64)
+        link_index = dict(zip(link_ids.tolist(), range(len(link_ids))))
+
+        downstream_idx = np.array([link_index.get(cur_hl.get_downstream_hl_id(), -1) for cur_hl in all_hl_prms],
+                                  dtype=np.int32)
+        upstream_area = NetworkIndex._attribute_array([cur_hl.get_upstream_area() for cur_hl in all_hl_prms])
+        hillslope_area = NetworkIndex._attribute_array([cur_hl.get_hillslope_area() for cur_hl in all_hl_prms])
+        link_length = NetworkIndex._attribute_array([cur_hl.get_link_length() for cur_hl in all_hl_prms])
+
+        return NetworkIndex(link_ids, downstream_idx, upstream_area, hillslope_area, link_length)
+
+    @staticmethod
+    def _attribute_array(values):
+        """
+
+        :param values: List of floats, with None for missing values
+        :return: Array of float64, with NaN for missing values
+        """
+        return np.array([np.nan if cur_value is None else cur_value for cur_value in values], dtype=np.float64)
+
+    def __init__(self, link_ids, downstream_idx, upstream_area, hillslope_area, link_length):
+        """
+
+        :param link_ids: Array of link ids. Their order defines the link indexes.
+        :param downstream_idx: Array of downstream link indexes (-1 for outlets)
+        :param upstream_area: Array of upstream areas
+        :param hillslope_area: Array of hillslope areas
+        :param link_length: Array of link lengths
+        """
+
+        self.link_ids = np.asarray(link_ids, dtype=np.int64)
+        self.downstream_idx = np.asarray(downstream_idx, dtype=np.int32)
+        self.upstream_area = np.asarray(upstream_area, dtype=np.float64)
+        self.hillslope_area = np.asarray(hillslope_area, dtype=np.float64)
+        self.link_length = np.asarray(link_length, dtype=np.float64)
+        self._sorted_pos = np.argsort(self.link_ids, kind='stable').astype(np.int32)
+        self._sorted_ids = self.link_ids[self._sorted_pos]
+
+        # upstream adjacency in compressed sparse rows, built by a counting sort over downstream links
+        has_downstream = np.flatnonzero(self.downstream_idx >= 0).astype(np.int32)
+        up_order = has_downstream[np.argsort(self.downstream_idx[has_downstream], kind='stable')]
+        self.upstream_ptr = np.zeros(len(self.link_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.downstream_idx[has_downstream], minlength=len(self.link_ids)),
+                  out=self.upstream_ptr[1:])
+        self.upstream_idx = up_order
+
+        # upstream-first order: reversed breadth-first traversal from the outlets
+        self.topo_order = np.concatenate(self._walk_upstream(self.get_outlets()))[::-1].copy()
+
+
+# Static Class - compiled, memory-mapped cache of the network index of .rvr/.prm files, stored next to the .rvr file
+class NetworkIndexCache:
+    CACHE_EXT = ".netcache"
+    KEY_FILE = "key.json"
+    VERSION = 1
+
+    @staticmethod
+    def get_cache_path(rvr_fpath, renumbered=False):
+        """
+
+        :param rvr_fpath:
+        :param renumbered:
+        :return: Path of the cache folder of the given .rvr file
+        """
+        return "{0}{1}{2}".format(rvr_fpath, "_renum" if renumbered else "", NetworkIndexCache.CACHE_EXT)
+
+    @staticmethod
+    def load(rvr_fpath, prm_fpath=None, renumbered=False, mmap=True):
+        """
+        Reads the cached index of a network if it is up to date with its source files
+        :param rvr_fpath:
+        :param prm_fpath: If None, only the .rvr file is checked (enough for topology-only uses)
+        :param renumbered: If True, the cache of the renumbered index is considered
+        :param mmap:
+        :return: NetworkIndex object or None if there is no valid cache
+        """
+
+        cache_path = NetworkIndexCache.get_cache_path(rvr_fpath, renumbered=renumbered)
+        key_fpath = os.path.join(cache_path, NetworkIndexCache.KEY_FILE)
+        if not os.path.exists(key_fpath):
+            return None
+        with open(key_fpath, "r") as r_file:
+            cached_key = json.load(r_file)
+
+        cur_key = NetworkIndexCache._build_key(rvr_fpath, prm_fpath)
+        if (cached_key.get("version") != cur_key["version"]) or (cached_key.get("rvr") != cur_key["rvr"]):
+            print("Network cache '{0}' is outdated.".format(cache_path))
+            return None
+        if (prm_fpath is not None) and (cached_key.get("prm") != cur_key["prm"]):
+            print("Network cache '{0}' is outdated.".format(cache_path))
+            return None
+
+        network_index = NetworkIndex.load(cache_path, mmap=mmap)
+        if network_index is not None:
+            print("Loaded network cache '{0}' ({1} links).".format(cache_path, network_index.num_links))
+        return network_index
+
+    @staticmethod
+    def save(network_index, rvr_fpath, prm_fpath, renumbered=False):
+        """
+
+        :param network_index:
+        :param rvr_fpath:
+        :param prm_fpath:
+        :param renumbered:
+        :return: Boolean. True if it was possible to write the cache, False otherwise
+        """
+
+        cache_path = NetworkIndexCache.get_cache_path(rvr_fpath, renumbered=renumbered)
+        try:
+            network_index.save(cache_path)
+            with open(os.path.join(cache_path, NetworkIndexCache.KEY_FILE), "w") as w_file:
+                json.dump(NetworkIndexCache._build_key(rvr_fpath, prm_fpath), w_file)
+        except (IOError, OSError) as e:
+            print("Could not write network cache '{0}': {1}.".format(cache_path, e))
+            return False
+
+        print("Wrote network cache '{0}'.".format(cache_path))
+        return True
+
+    @staticmethod
+    def _build_key(rvr_fpath, prm_fpath):
+        """
+
+        :param rvr_fpath:
+        :param prm_fpath:
+        :return: Dictionary identifying the current version of the source files by size and modification time
+        """
+
+        ret_key = {"version": NetworkIndexCache.VERSION, "rvr": NetworkIndexCache._file_stamp(rvr_fpath)}
+        if prm_fpath is not None:
+            ret_key["prm"] = NetworkIndexCache._file_stamp(prm_fpath)
+        return ret_key
+
+    @staticmethod
+    def _file_stamp(file_path):
+        """
+
+        :param file_path:
+        :return: List [size, modification time in nanoseconds]
+        """
+        file_stat = os.stat(file_path)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    def __init__(self):
+        return
@@ -80,7 +80,7 @@ class GraphsPlotter:
 
         # change data format for a better one
         conveted_data = GraphsPlotter._convert_data(raw_data, links_classes)
-        all_timestamps = sorted(list(raw_data.keys()))
+        all_timestamps, all_discharges = GraphsPlotter._get_timestamps_and_discharges(raw_data)
 
         #
         first_key = list(conveted_data.keys())[0]
@@ -131,7 +131,7 @@ class GraphsPlotter:
             if prev_bottom[cur_x] != 0:
                 the_disch.append(prev_bottom[cur_x])
             else:
-                the_disch.append(raw_data[all_timestamps[cur_x]]["discharge"])
+                the_disch.append(all_discharges[cur_x])
 
         # plot line
         ax.plot(x_vals + 0.5, the_disch, linewidth=2, color="#000000")
@@ -198,7 +198,7 @@ class GraphsPlotter:
         # change data format for a better one
         print("Converting data with rain.")
         conveted_data = GraphsPlotter._convert_data(raw_data, links_classes, rain=True)
-        all_timestamps = sorted(list(raw_data.keys()))
+        all_timestamps, all_discharges = GraphsPlotter._get_timestamps_and_discharges(raw_data)
 
         #
         first_key = list(conveted_data.keys())[0]
@@ -254,7 +254,7 @@ class GraphsPlotter:
             if prev_bottom[cur_x] != 0:
                 the_disch.append(prev_bottom[cur_x])
             else:
-                the_disch.append(raw_data[all_timestamps[cur_x]]["discharge"])
+                the_disch.append(all_discharges[cur_x])
 
         # plot line
         ax.plot(x_vals + 0.5, the_disch, linewidth=2, color="#000000")
@@ -312,6 +312,11 @@ class GraphsPlotter:
         :return: Dictionary with format {"D-Group 0":[12, 10, ...], "D-Group 1":[12, 10, ...]}
         """
 
+        # contribution files are aggregated as a whole
+        if not isinstance(raw_data, dict):
+            return GraphsPlotter._convert_contrib_file(raw_data, links_classes, total_classes=total_classes,
+                                                       rain=rain)
+
         # set up return dictionary
         ret_dict = {}
         if rain:
@@ -389,5 +394,46 @@ class GraphsPlotter:
 
         return ret_dict
 
+    @staticmethod
+    def _convert_contrib_file(contrib_file, links_classes, total_classes=5, rain=False):
+        """
+        Convert particle counting data of a contribution file into classes partial discharge data
+        :param contrib_file: ContribFile object
+        :param links_classes:
+        :param total_classes:
+        :return: Dictionary with format {"D-Group 0":[12, 10, ...], "D-Group 1":[12, 10, ...]}
+        """
+
+        old_counts, new_counts, total_counts = contrib_file.get_counts_by_class(links_classes, total_classes)
+
+        # share of the discharge of each step carried by each class
+        with np.errstate(divide='ignore', invalid='ignore'):
+            disch_per_part = np.where(total_counts > 0, contrib_file.discharges / total_counts, 0)
+        old_disch = old_counts * disch_per_part[:, np.newaxis]
+        new_disch = new_counts * disch_per_part[:, np.newaxis]
+
+        ret_dict = {}
+        for cur_class in range(total_classes):
+            if rain:
+                ret_dict["D-Group {0} Old".format(cur_class)] = old_disch[:, cur_class].tolist()
+                ret_dict["D-Group {0} New".format(cur_class)] = new_disch[:, cur_class].tolist()
+            else:
+                ret_dict["D-Group {0}".format(cur_class)] = (old_disch[:, cur_class] +
+                                                             new_disch[:, cur_class]).tolist()
+        return ret_dict
+
+    @staticmethod
+    def _get_timestamps_and_discharges(raw_data):
+        """
+        Gets the sorted timestamps and the outlet discharges of particle counting data
+        :param raw_data: Dictionary of [timestamp]->contributions dictionary, or ContribFile object
+        :return: Tuple (list of timestamps, list of discharges)
+        """
+
+        if not isinstance(raw_data, dict):
+            return raw_data.timestamps.tolist(), raw_data.discharges.tolist()
+        all_timestamps = sorted(list(raw_data.keys()))
+        return all_timestamps, [raw_data[cur_timestamp]["discharge"] for cur_timestamp in all_timestamps]
+
     def __init__(self):
         return
\ No newline at end of file
@@ -0,0 +1,410 @@
+from traceOutputs_lib import ParticleStore, TransferKernel, ParticleManager, OutletContributions
+import multiprocessing
+import numpy as np
+
+
+# Dynamic Class - Set of worker processes, each one holding and moving the particles of a group of sub-basins
+class SubbasinPool:
+    CMD_ADD = "add"                       # adds particles to the worker store (no reply)
+    CMD_STEP = "step"                     # moves all particles of the worker by one step
+    CMD_COUNT = "count"                   # counts particles of the worker by layer source
+    CMD_CONTRIB = "contrib"               # gets the contributing links of an outlet
+    CMD_GATHER = "gather"                 # gets all particles and the random state of the worker
+    CMD_SET_RANDOM = "set_random"         # replaces the random state of the worker (no reply)
+    CMD_CLOSE = "close"                   # ends the worker process
+
+    _network_index = None                 # NetworkIndex shared by master and workers
+    _links_part = None                    # array with the worker responsible for each link
+    _outlet_link_ids = None               # list of link ids whose contributing links are kept for every step
+    _connections = None                   # list of master-side Connection objects, one per worker
+    _processes = None                     # list of Process objects, one per worker
+    _parts_links = None                   # list of arrays with the link indexes of each worker
+    _live_particles = None                # SubbasinParticles object representing the current state of the workers
+
+    def get_num_workers(self):
+        return len(self._processes)
+
+    def scatter(self, particle_store):
+        """
+        Sends all particles of a ParticleStore to the workers responsible for their links
+        :param particle_store: ParticleStore object built over the same network index
+        :return: SubbasinParticles object representing the particles now held by the workers
+        """
+
+        self.add_particles(particle_store.link, particle_store.comp, particle_store.src_link, particle_store.src_layer)
+        self._live_particles = SubbasinParticles(self)
+        return self._live_particles
+
+    def add_particles(self, link_idx, comp, src_link_idx, src_layer):
+        """
+        Sends particles to the workers responsible for their links
+        :param link_idx: Array of link indexes
+        :param comp: Array of ParticleStore.COMP_... values
+        :param src_link_idx: Array of source link indexes
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :return:
+        """
+
+        if len(link_idx) == 0:
+            return
+        particles_part = self._links_part[link_idx]
+        for cur_part, cur_conn in enumerate(self._connections):
+            in_part = particles_part == cur_part
+            if not np.any(in_part):
+                continue
+            cur_conn.send((SubbasinPool.CMD_ADD, (link_idx[in_part], comp[in_part], src_link_idx[in_part],
+                                                  src_layer[in_part])))
+
+    def advance(self, step_probs, step_key=None):
+        """
+        Moves all particles by one step in parallel and exchanges the ones crossing workers boundaries
+        :param step_probs: Array as given by TransferKernel.step_probabilities() for all links
+        :param step_key: Integer identifying the step for the RandomStreams of the pool, if any
+        :return: SubbasinParticles object representing the particles after the step
+        """
+
+        for cur_conn, cur_part_links in zip(self._connections, self._parts_links):
+            cur_conn.send((SubbasinPool.CMD_STEP, (step_probs[:, cur_part_links], self._outlet_link_ids, step_key)))
+        all_replies = [cur_conn.recv() for cur_conn in self._connections]
+
+        # keep what was there before moving
+        if self._live_particles is not None:
+            self._live_particles.freeze(*SubbasinPool._merge_summaries([r[0] for r in all_replies]))
+
+        # deliver particles that crossed to other workers
+        all_leaving = [r[1] for r in all_replies if len(r[1][0]) > 0]
+        if len(all_leaving) > 0:
+            self.add_particles(*[np.concatenate(cur_col) for cur_col in zip(*all_leaving)])
+
+        self._live_particles = SubbasinParticles(self)
+        return self._live_particles
+
+    def gather(self):
+        """
+        Collects the particles held by all workers, e.g. for checkpointing
+        :return: Tuple (ParticleStore with the particles of all workers, worker after worker, list with the random
+                 state of each worker)
+        """
+
+        all_replies = self.query(SubbasinPool.CMD_GATHER)
+        ret_store = ParticleStore(self._network_index)
+        ret_store.set_columns(*[np.concatenate(cur_col) for cur_col in zip(*[r[0] for r in all_replies])])
+        return ret_store, [r[1] for r in all_replies]
+
+    def set_random_states(self, random_states):
+        """
+        Replaces the random states of the workers, e.g. when resuming from a checkpoint
+        :param random_states: List with one random state (as given by 'gather') for each worker
+        :return: True if set, False if the number of states does not match the number of workers
+        """
+
+        if len(random_states) != len(self._connections):
+            return False
+        for cur_conn, cur_state in zip(self._connections, random_states):
+            cur_conn.send((SubbasinPool.CMD_SET_RANDOM, cur_state))
+        return True
+
+    def query(self, command, args=None):
+        """
+        Sends the same request to all workers
+        :param command: One of SubbasinPool.CMD_COUNT, SubbasinPool.CMD_CONTRIB, SubbasinPool.CMD_GATHER
+        :param args:
+        :return: List with the reply of each worker
+        """
+        for cur_conn in self._connections:
+            cur_conn.send((command, args))
+        return [cur_conn.recv() for cur_conn in self._connections]
+
+    def close(self):
+        """
+        Ends all worker processes
+        :return:
+        """
+        if self._connections is None:
+            return
+        for cur_conn in self._connections:
+            try:
+                cur_conn.send((SubbasinPool.CMD_CLOSE, None))
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+        for cur_process in self._processes:
+            cur_process.join()
+        for cur_conn in self._connections:
+            cur_conn.close()
+        self._connections = None
+
+    @staticmethod
+    def _merge_summaries(all_summaries):
+        """
+        Sums up the summaries of the particles held by each worker
+        :param all_summaries: List of tuples (count, count by layer source, dict of [outlet id]->OutletContributions)
+        :return: Tuple (count, count by layer source, dict of [outlet id]->OutletContributions)
+        """
+
+        ret_count = 0
+        ret_layers = {}
+        ret_contribs = {}
+        for cur_count, cur_layers, cur_contribs in all_summaries:
+            ret_count += cur_count
+            for cur_layer, cur_layer_count in cur_layers.items():
+                ret_layers[cur_layer] = ret_layers.get(cur_layer, 0) + cur_layer_count
+            ret_contribs.update(cur_contribs)       # each outlet is summarized by the worker owning it only
+        return ret_count, ret_layers, ret_contribs
+
+    @staticmethod
+    def _worker_loop(conn, network_index, links_part, worker_id, seed, random_streams=None):
+        """
+        Main function of each worker process
+        :param conn: Worker-side Connection object
+        :param network_index: NetworkIndex of the whole domain
+        :param links_part: Array with the worker responsible for each link
+        :param worker_id: Number of the current worker
+        :param seed: Seed of the random values of the worker, None for an unpredictable one
+        :param random_streams: RandomStreams used instead of the seed, if any
+        :return:
+        """
+
+        part_links = np.flatnonzero(links_part == worker_id)
+        store = ParticleStore(network_index)
+        step_probs = np.full((5, network_index.num_links), np.nan, dtype=np.float64)
+        random_state = np.random.RandomState(seed)
+
+        while True:
+            command, args = conn.recv()
+
+            if command == SubbasinPool.CMD_ADD:
+                store.add_particles(*args, count=len(args[0]))
+
+            elif command == SubbasinPool.CMD_STEP:
+                part_step_probs, outlet_link_ids, step_key = args
+                conn_summary = SubbasinPool._summarize(store, outlet_link_ids, links_part, worker_id)
+
+                step_probs[:, part_links] = part_step_probs
+                if random_streams is None:
+                    rdm_values = random_state.uniform(0, 1, size=store.count_particles())
+                else:
+                    rdm_values = random_streams.particles_uniforms(step_key, store)
+                new_link, new_comp, still_in = TransferKernel.move(store.link, store.comp, rdm_values, step_probs,
+                                                                   network_index.downstream_idx)
+                stays = still_in & (links_part[new_link] == worker_id)
+                leaves = still_in & (~stays)
+                leaving = (new_link[leaves], new_comp[leaves], store.src_link[leaves], store.src_layer[leaves])
+                store = store.derive(new_link[stays], new_comp[stays], store.src_link[stays], store.src_layer[stays])
+                conn.send((conn_summary, leaving))
+
+            elif command == SubbasinPool.CMD_COUNT:
+                conn.send(store.count_particles_by_layer_source(aggregate_rain=args))
+
+            elif command == SubbasinPool.CMD_CONTRIB:
+                outlet_link_id, aggregate_rain = args
+                conn.send(store.get_contributions(outlet_link_id, aggregate_rain=aggregate_rain))
+
+            elif command == SubbasinPool.CMD_GATHER:
+                conn.send(((store.link, store.comp, store.src_link, store.src_layer), random_state.get_state()))
+
+            elif command == SubbasinPool.CMD_SET_RANDOM:
+                random_state.set_state(args)
+
+            elif command == SubbasinPool.CMD_CLOSE:
+                break
+
+        conn.close()
+
+    @staticmethod
+    def _summarize(store, outlet_link_ids, links_part, worker_id):
+        """
+
+        :param store: ParticleStore of a worker
+        :param outlet_link_ids: List of link ids whose contributing links are wanted
+        :param links_part:
+        :param worker_id:
+        :return: Tuple (count, count by layer source, dict of [outlet id]->OutletContributions of the worker outlets,
+                 with rain timestamps kept apart so that they can still be aggregated or aged)
+        """
+
+        cur_count, cur_layers = store.count_particles_by_layer_source(aggregate_rain=True)
+        cur_contribs = {}
+        for cur_outlet_id in outlet_link_ids:
+            cur_outlet_idx = store.get_link_index(cur_outlet_id)
+            if (cur_outlet_idx is not None) and (links_part[cur_outlet_idx] == worker_id):
+                cur_contribs[cur_outlet_id] = store.get_contributions(cur_outlet_id, aggregate_rain=False)
+        return cur_count, cur_layers, cur_contribs
+
+    def __init__(self, network_index, num_workers, outlet_link_ids=None, seed=None, random_streams=None):
+        """
+
+        :param network_index: NetworkIndex object of the domain
+        :param num_workers: Number of worker processes
+        :param outlet_link_ids: List of link ids whose contributing links are going to be asked after each step
+        :param seed: Seed for the random values of the workers, None for unpredictable ones
+        :param random_streams: RandomStreams giving the random values instead of the seed, so that results do not
+                               depend on the number of workers
+        """
+
+        self._network_index = network_index
+        self._links_part = network_index.partition_subbasins(num_workers)
+        self._outlet_link_ids = [] if outlet_link_ids is None else list(outlet_link_ids)
+        self._parts_links = [np.flatnonzero(self._links_part == p) for p in range(max(int(num_workers), 1))]
+        self._connections = []
+        self._processes = []
+
+        # fork keeps workers from re-running the calling script, when available
+        mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() \
+            else multiprocessing.get_context()
+        for cur_worker_id in range(len(self._parts_links)):
+            master_conn, worker_conn = mp_context.Pipe()
+            worker_seed = None if seed is None else seed + cur_worker_id
+            cur_process = mp_context.Process(target=SubbasinPool._worker_loop,
+                                             args=(worker_conn, network_index, self._links_part, cur_worker_id,
+                                                   worker_seed, random_streams))
+            cur_process.daemon = True
+            cur_process.start()
+            worker_conn.close()
+            self._connections.append(master_conn)
+            self._processes.append(cur_process)
+
+        print("Started {0} sub-basin workers ({1} to {2} links each).".format(
+            len(self._processes), min(len(p) for p in self._parts_links), max(len(p) for p in self._parts_links)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# Dynamic Class - Particles of a snapshot held by the workers of a SubbasinPool (same interface as ParticleStore)
+class SubbasinParticles:
+    _pool = None                          # SubbasinPool holding the particles
+    _frozen = None                        # tuple (count, by layer source, [outlet]->contributing links) once moved
+
+    def is_frozen(self):
+        """
+
+        :return: True if the particles were already moved, so only the summaries taken before moving are available
+        """
+        return self._frozen is not None
+
+    def freeze(self, count, count_by_layer, contribs):
+        """
+        Keeps the summaries of the particles before they get moved by the workers
+        :param count:
+        :param count_by_layer:
+        :param contribs: Dictionary of [outlet link id]->contributing links
+        :return:
+        """
+        self._frozen = (count, count_by_layer, contribs)
+
+    def add_particles(self, link_idx, comp, src_link_idx, src_layer, count=1):
+        """
+        Same as ParticleStore.add_particles
+        :return:
+        """
+        if self.is_frozen():
+            print("Cannot add particles to a snapshot already moved.")
+            return
+        count = max(int(count), 0)
+        self._pool.add_particles(np.broadcast_to(np.asarray(link_idx, dtype=np.int32), (count, )),
+                                 np.broadcast_to(np.asarray(comp, dtype=np.int8), (count, )),
+                                 np.broadcast_to(np.asarray(src_link_idx, dtype=np.int32), (count, )),
+                                 np.broadcast_to(np.asarray(src_layer, dtype=np.int64), (count, )))
+
+    def add_buckets(self, link_idx, comp, src_link_idx, src_layer, counts):
+        """
+        Same as ParticleStore.add_buckets
+        :return:
+        """
+        if self.is_frozen():
+            print("Cannot add particles to a snapshot already moved.")
+            return
+        counts = np.asarray(counts, dtype=np.int64)
+        self._pool.add_particles(np.repeat(np.broadcast_to(link_idx, counts.shape), counts).astype(np.int32),
+                                 np.repeat(np.broadcast_to(comp, counts.shape), counts).astype(np.int8),
+                                 np.repeat(np.broadcast_to(src_link_idx, counts.shape), counts).astype(np.int32),
+                                 np.repeat(np.broadcast_to(src_layer, counts.shape), counts).astype(np.int64))
+
+    def advance(self, step_probs, step_key=None):
+        """
+        Moves the particles by one step
+        :param step_probs: Array as given by TransferKernel.step_probabilities() for all links
+        :param step_key: Integer identifying the step for the RandomStreams of the pool, if any
+        :return: SubbasinParticles object with the moved particles
+        """
+        if self.is_frozen():
+            print("Cannot move particles of a snapshot already moved.")
+            return None
+        return self._pool.advance(step_probs, step_key=step_key)
+
+    def count_particles(self):
+        """
+
+        :return:
+        """
+        return self.count_particles_by_layer_source()[0]
+
+    def count_particles_by_layer_source(self, aggregate_rain=True):
+        """
+        Same as ParticleStore.count_particles_by_layer_source
+        :param aggregate_rain:
+        :return:
+        """
+
+        if self.is_frozen():
+            if not aggregate_rain:
+                print("Only rain-aggregated counts are kept for a snapshot already moved.")
+                return None
+            return self._frozen[0], dict(self._frozen[1])
+
+        ret_count, ret_layers, _ = SubbasinPool._merge_summaries(
+            [(c, l, {}) for c, l in self._pool.query(SubbasinPool.CMD_COUNT, aggregate_rain)])
+        for cur_layer in (ParticleManager.LAYER_POND, ParticleManager.LAYER_TOPLAYER,
+                          ParticleManager.LAYER_SUBSURFACE, ParticleManager.LAYER_CHANNEL):
+            ret_layers.setdefault(cur_layer, 0)
+        return ret_count, ret_layers
+
+    def get_contributions(self, outlet_link_id, aggregate_rain=True):
+        """
+        Same as ParticleStore.get_contributions
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return:
+        """
+
+        if self.is_frozen():
+            if outlet_link_id not in self._frozen[2]:
+                print("Contributing links of link {0} were not kept for a snapshot already moved.".format(
+                    outlet_link_id))
+                return None
+            return self._frozen[2][outlet_link_id].aggregate() if aggregate_rain else self._frozen[2][outlet_link_id]
+
+        # the particles of an outlet are all held by a single worker, but the rows of all are histogrammed again
+        all_contribs = self._pool.query(SubbasinPool.CMD_CONTRIB, (outlet_link_id, aggregate_rain))
+        return OutletContributions.count(outlet_link_id, np.concatenate([c.src_link_ids for c in all_contribs]),
+                                         np.concatenate([c.src_layers for c in all_contribs]),
+                                         counts=np.concatenate([c.counts for c in all_contribs]),
+                                         aggregate_rain=aggregate_rain)
+
+    def get_contributions_by_outlet(self, outlet_link_ids, aggregate_rain=True):
+        """
+        Same as ParticleStore.get_contributions_by_outlet. The summaries of a snapshot already moved hold the
+        contributions of all the outlets of the pool.
+        :param outlet_link_ids:
+        :param aggregate_rain:
+        :return:
+        """
+        return dict([(cur_outlet_id, self.get_contributions(cur_outlet_id, aggregate_rain=aggregate_rain))
+                     for cur_outlet_id in outlet_link_ids])
+
+    def get_contributing_links(self, outlet_link_id, aggregate_rain=True):
+        """
+        Same as ParticleStore.get_contributing_links
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return:
+        """
+        cur_contribs = self.get_contributions(outlet_link_id, aggregate_rain=aggregate_rain)
+        return None if cur_contribs is None else cur_contribs.to_dict()
+
+    def __init__(self, pool):
+        self._pool = pool
@@ -1,5 +1,11 @@
 from __future__ import division
-from traceOutputs_lib import GblVars, AsynchFilesReader, H5FileReader, OutputTracer, DomainSnapshot, ParticleManager
+from traceOutputs_lib import GblVars, AsynchFilesReader, H5FileReader, H5Prefetcher, OutputTracer, DomainSnapshot, \
+    ParticleManager, ParticleStore, TransferKernel, ThreadManager, RandomStreams, OutletAges, OutletContributions
+from subbasinPool_lib import SubbasinPool
+from contribFile_lib import ContribFileWriter
+from checkpoint_lib import CheckpointFile
+from ensemble_lib import EnsemblePool, EnsembleStats, EnsembleFileWriter
+from linkGroups_lib import LinkGroups
 from configFileReader_lib import ConfigFile
 from def_lib import ArgumentsManager
 import numpy as np
@@ -18,30 +24,99 @@ if '-h' in sys.argv:
     print("Performs the simulation of particles flow.")
     print("Usage 01: python traceOutputs_layers_rain.py -config CONFIG_JSON")
     print("  CONFIG_JSON : File path for a json configuration file.")
-    print("Usage 02: python traceOutputs_layers_rain.py -in_first_h5 IN_H5 -in_rvr IN_RVR -in_prm IN_PRM -link_id LINK_ID -out_hyd OUT_HYD [-max_parts PARTS] [-all_parts ALL_PARTS] [-vol_per_parts VOL_PARTS]")
+    print("Usage 02: python traceOutputs_layers_rain.py -in_first_h5 IN_H5 -in_rvr IN_RVR -in_prm IN_PRM -link_id LINK_ID -out_hyd OUT_HYD [-max_parts PARTS] [-all_parts ALL_PARTS] [-vol_per_parts VOL_PARTS] [-engine ENGINE] [-workers WORKERS] [-prefetch DEPTH] [-keep_link_order] [-no_cache] [-no_jit] [-checkpoint_every FILES] [-resume] [-no_prune] [-members MEMBERS] [-seed SEED] [-delta_t SECONDS] [-substeps SUBSTEPS] [-age_bin_width AGE_SECONDS] [-age_bins AGE_BINS] [-groups GROUPS] [-groups_only]")
     print("  IN_H5       : First .h5 file in an output sequency of snapshots.")
     print("  IN_RVR      : File path for .rvr describing the topology of the network.")
     print("  IN_PRM      : File path for .prm describing the fillslope-links in the network.")
-    print("  LINK_ID     : Integer with the link id of the link to which an hydrograph will be generated.")
-    print("  OUT_HYD     : Path for output hydrograph binary file.")
+    print("  LINK_ID     : Integer with the link id of the link to which an hydrograph will be generated. Several")
+    print("                link ids separated by commas (e.g. '12,34') give one hydrograph for each of them.")
+    print("  OUT_HYD     : Path for output hydrograph binary file. If it ends with '.h5', results are appended to an")
+    print("                HDF5 file along the run instead of being pickled at the end. With several link ids, the")
+    print("                pickled dictionary has one hydrograph dictionary for each link id.")
     print("  PARTS       : Number of particles to be set in the initial condition of the observed link.")
     print("  ALL_PARTS   : Number of particles to be set in the initial condition each layer of each link.")
     print("  VOL_PARTS   : Volume of water (in cubic meters) that is represented by a rain particle.")
+    print("  ENGINE      : How particles are held and moved: 'objects' (one Particle object each, default), 'store'")
+    print("                (arrays, one by one), 'vectorized' (arrays, all at once) or")
+    print("                'bucket' (only counts by location and source, moved with binomial splits) or 'subbasins'")
+    print("                (as 'vectorized', with sub-basins split among worker processes) or 'threads' (as")
+    print("                'vectorized', with chunks of links moved by a pool of threads, same results).")
+    print("  WORKERS     : Number of worker processes or threads of the 'subbasins' and 'threads' engines")
+    print("                (default: number of CPUs).")
+    print("  DEPTH       : Number of upcoming .h5 files read in background while particles are moved (default: 2).")
+    print("                Zero reads each file only when it is needed.")
+    print("  FILES       : Number of .h5 files processed between checkpoints of the whole particles state (default:")
+    print("                0, no checkpoints). The checkpoint is written next to OUT_HYD and removed once the run is")
+    print("                completed. Pickled outputs are rewritten at each checkpoint: prefer '.h5' OUT_HYD files.")
+    print("  MEMBERS     : Number of realizations run in parallel by WORKERS processes (ensemble mode). OUT_HYD is then")
+    print("                an HDF5 file with the mean, standard deviation and quantiles of the contributions of all")
+    print("                realizations. Only with ALL_PARTS and the 'objects', 'store', 'vectorized' or 'bucket'")
+    print("                engines (default: 'vectorized'), without checkpoints.")
+    print("  SEED        : Integer seed of the random values. Runs with a same seed give the same results, whatever the")
+    print("                number of WORKERS of the 'subbasins' and 'threads' engines or of ensemble members, and all")
+    print("                engines but 'bucket' give the same results as each other.")
+    print("  SECONDS     : Duration of each step. By default, the spacing between the timestamps of the .h5 files.")
+    print("  SUBSTEPS    : Number of steps between two .h5 files, with the states of the links linearly interpolated")
+    print("                between them (default: 1). Sparse model outputs can then be tracked with fine steps.")
+    print("  AGE_SECONDS : Width of the bins of the histograms of particles age at the outlets (default: 3600).")
+    print("  AGE_BINS    : Number of bins of the histograms of particles age at the outlets, the last one holding all")
+    print("                older particles (e.g. 240). By default, zero: no age histograms are written.")
+    print("  GROUPS      : Mappings of links into groups whose contributions are summed up along the run, separated")
+    print("                by commas: 'distance' (classes of distance to the outlet), 'width' (classes of width")
+    print("                function) or the path of a CSV file of 'link_id,group' lines (e.g. sub-basins, counties).")
+    print("  -keep_link_order : Do not renumber links by sub-basin (links are indexed in the .rvr order).")
+    print("  -no_cache        : Always parse .rvr and .prm files, ignoring the compiled network cache.")
+    print("  -no_jit          : Move particles with NumPy even if numba is installed.")
+    print("  -resume          : Continue an interrupted run from its checkpoint instead of starting from IN_H5.")
+    print("  -no_prune        : Simulate all links of the domain, not only the ones draining into LINK_ID.")
+    print("  -groups_only     : Write only the contributions by GROUPS, not the ones of each source link.")
     quit()
 
 
 # ###################################################### ARGS ######################################################## #
 
+ENGINE_OBJECTS = "objects"
+ENGINE_STORE = "store"
+ENGINE_VECTORIZED = "vectorized"
+ENGINE_BUCKET = "bucket"
+ENGINE_SUBBASINS = "subbasins"
+ENGINE_THREADS = "threads"
+ENGINES = (ENGINE_OBJECTS, ENGINE_STORE, ENGINE_VECTORIZED, ENGINE_BUCKET, ENGINE_SUBBASINS, ENGINE_THREADS)
+PREFETCH_DEPTH = 2
+CHECKPOINT_EVERY = 0
+SUBSTEPS = 1
+AGE_BIN_WIDTH = 3600
+AGE_BINS = 0
+ENSEMBLE_ENGINES = (ENGINE_OBJECTS, ENGINE_STORE, ENGINE_VECTORIZED, ENGINE_BUCKET)
+ENSEMBLE_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
 # get arguments
 config_json_fpath_arg = ArgumentsManager.get_str(sys.argv, '-config')
 input_fh5_fpath_arg = ArgumentsManager.get_str(sys.argv, '-in_first_h5')
 input_rvr_fpath_arg = ArgumentsManager.get_str(sys.argv, '-in_rvr')
 input_prm_fpath_arg = ArgumentsManager.get_str(sys.argv, '-in_prm')
-linkid_arg = ArgumentsManager.get_int(sys.argv, '-link_id')
+linkid_arg = ArgumentsManager.get_int_list(sys.argv, '-link_id')
 output_fpath_arg = ArgumentsManager.get_str(sys.argv, '-out_hyd')
 max_part_arg = ArgumentsManager.get_int(sys.argv, '-max_parts')
 all_part_arg = ArgumentsManager.get_int(sys.argv, '-all_parts')
 vol_part_arg = ArgumentsManager.get_flt(sys.argv, '-vol_per_parts')
+engine_arg = ArgumentsManager.get_str(sys.argv, '-engine')
+prefetch_arg = ArgumentsManager.get_int(sys.argv, '-prefetch')
+workers_arg = ArgumentsManager.get_int(sys.argv, '-workers')
+checkpoint_every_arg = ArgumentsManager.get_int(sys.argv, '-checkpoint_every')
+members_arg = ArgumentsManager.get_int(sys.argv, '-members')
+seed_arg = ArgumentsManager.get_int(sys.argv, '-seed')
+delta_t_arg = ArgumentsManager.get_int(sys.argv, '-delta_t')
+substeps_arg = ArgumentsManager.get_int(sys.argv, '-substeps')
+age_bin_width_arg = ArgumentsManager.get_int(sys.argv, '-age_bin_width')
+age_bins_arg = ArgumentsManager.get_int(sys.argv, '-age_bins')
+groups_arg = ArgumentsManager.get_str_list(sys.argv, '-groups')
+resume_arg = '-resume' in sys.argv
+no_prune_arg = '-no_prune' in sys.argv
+groups_only_arg = '-groups_only' in sys.argv
+keep_link_order_arg = '-keep_link_order' in sys.argv
+no_cache_arg = '-no_cache' in sys.argv
+no_jit_arg = '-no_jit' in sys.argv
 
 # basic checks
 if config_json_fpath_arg is None:
@@ -54,7 +129,7 @@ if config_json_fpath_arg is None:
     if input_prm_fpath_arg is None:
         print("Missing '-in_prm' argument.")
         quit()
-    if linkid_arg is None:
+    if (linkid_arg is None) or (len(linkid_arg) == 0):
         print("Missing '-link_id' argument.")
         quit()
     if output_fpath_arg is None:
@@ -63,6 +138,43 @@ if config_json_fpath_arg is None:
     if (max_part_arg is not None) and (all_part_arg is not None):
         print("Too many arguments: or '-max_parts', or '-all_parts', or none of them are expected, not both.")
         quit()
+if (engine_arg is not None) and (engine_arg not in ENGINES):
+    print("Invalid '-engine' argument: '{0}' not in {1}.".format(engine_arg, ENGINES))
+    quit()
+if (workers_arg is not None) and (workers_arg < 1):
+    print("Invalid '-workers' argument: expected a positive integer, got {0}.".format(workers_arg))
+    quit()
+if (prefetch_arg is not None) and (prefetch_arg < 0):
+    print("Invalid '-prefetch' argument: expected a non-negative integer, got {0}.".format(prefetch_arg))
+    quit()
+if (delta_t_arg is not None) and (delta_t_arg < 1):
+    print("Invalid '-delta_t' argument: expected a positive integer, got {0}.".format(delta_t_arg))
+    quit()
+if (substeps_arg is not None) and (substeps_arg < 1):
+    print("Invalid '-substeps' argument: expected a positive integer, got {0}.".format(substeps_arg))
+    quit()
+if (age_bin_width_arg is not None) and (age_bin_width_arg < 1):
+    print("Invalid '-age_bin_width' argument: expected a positive integer, got {0}.".format(age_bin_width_arg))
+    quit()
+if (age_bins_arg is not None) and (age_bins_arg < 0):
+    print("Invalid '-age_bins' argument: expected a non-negative integer, got {0}.".format(age_bins_arg))
+    quit()
+if groups_only_arg and not groups_arg:
+    print("Invalid '-groups_only' argument: no '-groups' given.")
+    quit()
+if (seed_arg is not None) and (seed_arg < 0):
+    print("Invalid '-seed' argument: expected a non-negative integer, got {0}.".format(seed_arg))
+    quit()
+if (members_arg is not None) and (members_arg < 1):
+    print("Invalid '-members' argument: expected a positive integer, got {0}.".format(members_arg))
+    quit()
+if (members_arg is not None) and (not ContribFileWriter.is_contrib_file(output_fpath_arg or "")):
+    print("Invalid '-out_hyd' argument: ensembles are written as '{0}' files.".format(ContribFileWriter.FILE_EXT))
+    quit()
+if (checkpoint_every_arg is not None) and (checkpoint_every_arg < 0):
+    print("Invalid '-checkpoint_every' argument: expected a non-negative integer, got {0}.".format(
+        checkpoint_every_arg))
+    quit()
 
 
 # ###################################################### DEFS ######################################################## #
@@ -94,6 +206,124 @@ def debug_parts(the_snapshot):
     print("...from rain:'{0}'.".format(parts_dict[ParticleManager.LAYER_RAIN]))
 
 
+def save_contrib_links(hydrograph_fpath, contrib_links_dict):
+    """
+    Pickles the contributions of the outlets. A single outlet is written as a dictionary of [timestamp]->contributions,
+    several outlets as a dictionary of [outlet link id]->dictionary of [timestamp]->contributions.
+    :param hydrograph_fpath:
+    :param contrib_links_dict: Dictionary of [outlet link id]->dictionary of [timestamp]->contributions
+    :return:
+    """
+
+    with open(hydrograph_fpath + ".tmp", "wb+") as wfile:
+        pickle.dump(list(contrib_links_dict.values())[0] if len(contrib_links_dict) == 1 else contrib_links_dict,
+                    wfile)
+    os.replace(hydrograph_fpath + ".tmp", hydrograph_fpath)
+
+
+def load_contrib_links(hydrograph_fpath, outlet_link_ids, last_timestamp):
+    """
+    Reads back the contributions written by 'save_contrib_links' up to a given time
+    :param hydrograph_fpath:
+    :param outlet_link_ids: List of outlet link ids
+    :param last_timestamp: Contributions after this timestamp are dropped
+    :return: Dictionary of [outlet link id]->dictionary of [timestamp]->contributions
+    """
+
+    ret_dict = dict([(cur_outlet_id, {}) for cur_outlet_id in outlet_link_ids])
+    if not os.path.exists(hydrograph_fpath):
+        return ret_dict
+    with open(hydrograph_fpath, "rb") as rfile:
+        file_content = pickle.load(rfile)
+    if len(outlet_link_ids) == 1:
+        file_content = {outlet_link_ids[0]: file_content}
+    for cur_outlet_id in outlet_link_ids:
+        ret_dict[cur_outlet_id] = dict([(k, v) for k, v in file_content.get(cur_outlet_id, {}).items()
+                                        if k <= last_timestamp])
+    return ret_dict
+
+
+def write_checkpoint(checkpoint_fpath, cur_snapshot, last_file_position, hydrograph_fpath, contrib_writer=None,
+                     contrib_links_dict=None, subbasin_pool=None):
+    """
+    Makes sure all the contributions so far are in the output file and writes the checkpoint of the particles state
+    :param checkpoint_fpath:
+    :param cur_snapshot: DomainSnapshot after moving the particles of the file at 'last_file_position'
+    :param last_file_position: Position of the last processed h5 file
+    :param hydrograph_fpath: Output hydrograph file path
+    :param contrib_writer: ContribFileWriter of the run, None if contributions are pickled
+    :param contrib_links_dict: Dictionary of [outlet link id]->contributions so far, only used if 'contrib_writer' is
+                               None
+    :param subbasin_pool: SubbasinPool holding the particles, None if particles are in 'cur_snapshot'
+    :return:
+    """
+
+    if contrib_writer is not None:
+        contrib_writer.flush()
+    else:
+        save_contrib_links(hydrograph_fpath, contrib_links_dict)
+
+    if subbasin_pool is not None:
+        cur_particles, worker_random_states = subbasin_pool.gather()
+        CheckpointFile.write(checkpoint_fpath, cur_snapshot, last_file_position, particles=cur_particles,
+                             worker_random_states=worker_random_states)
+    else:
+        CheckpointFile.write(checkpoint_fpath, cur_snapshot, last_file_position)
+
+
+def get_files_time_steps(all_h5_files, delta_t=None):
+    """
+
+    :param all_h5_files: List of h5 file paths, as given by H5FileReader.list_h5_files
+    :param delta_t: Seconds per step for all files. If None, taken from the spacing of the files.
+    :return: Array with the seconds of the step of each file, None if it could not be known
+    """
+
+    if delta_t is not None:
+        return np.full(len(all_h5_files), delta_t, dtype=np.int64)
+    if len(all_h5_files) == 1:
+        print("Single h5 file: using a step of {0} seconds.".format(GblVars.delta_t))
+        return np.full(1, GblVars.delta_t, dtype=np.int64)
+    files_time_steps = H5FileReader.get_time_steps(all_h5_files)
+    if files_time_steps is None:
+        print("Could not get the time step from the names of the h5 files.")
+    else:
+        print("Time step of {0} seconds from the h5 files.".format(int(np.median(files_time_steps))))
+    return files_time_steps
+
+
+def load_domain(rvr_fpath, prm_fpath, outlet_linkids, renumber_links=True, use_cache=True, prune=True):
+    """
+    Builds GblVars.network_index, keeping only the links draining into the outlets if asked
+    :param rvr_fpath:
+    :param prm_fpath:
+    :param outlet_linkids: List of link ids of the outlets
+    :param renumber_links: If True, links are indexed in depth-first post-order (sub-basins contiguous in memory).
+    :param use_cache: If True, the compiled network cache next to the .rvr file is used (and created if needed).
+    :param prune: If True, only the links draining into the outlets are kept.
+    :return: True if built, False otherwise
+    """
+
+    GblVars.network_index = AsynchFilesReader.load_network_index(rvr_fpath, prm_fpath, renumber=renumber_links,
+                                                                 use_cache=use_cache)
+    if GblVars.network_index is None:
+        print("Could not build the network from '{0}' and '{1}'.".format(rvr_fpath, prm_fpath))
+        return False
+
+    # links that cannot drain into the outlets do not change their hydrographs
+    if prune and (None not in outlet_linkids):
+        outlets_idx = GblVars.network_index.get_indices(outlet_linkids)
+        if np.any(outlets_idx < 0):
+            print("Outlet links {0} not in the network of '{1}'.".format(
+                [v for v, i in zip(outlet_linkids, outlets_idx.tolist()) if i < 0], rvr_fpath))
+            return False
+        total_links = GblVars.network_index.num_links
+        GblVars.network_index = GblVars.network_index.pruned(outlets_idx)
+        print("Simulating {0} of {1} links (upstream of links {2}).".format(GblVars.network_index.num_links,
+                                                                           total_links, outlet_linkids))
+    return True
+
+
 def read_config_and_perform_traking(config_json_fpath):
     """
 
@@ -120,40 +350,91 @@ def read_config_and_perform_traking(config_json_fpath):
     ref_h5_fpath = json_config_file.get_first_h5_file_path()
     rvr_fpath = json_config_file.get_rvr_file_path()
     prm_fpath = json_config_file.get_prm_file_path()
-    outlet_linkid = json_config_file.get_outlet_link_id()
+    outlet_linkid = json_config_file.get_outlet_link_ids()
     hydrograph_fpath = json_config_file.get_particle_track_file_path()
     max_part = None
     all_part = None
     vol_part = None
-
+    if json_config_file.get_particles_initdist_method() == ConfigFile.PART_METH_EQUL:
+        all_part = json_config_file.get_particles_initdist_number()
+    elif json_config_file.get_particles_initdist_method() == ConfigFile.PART_METH_PROP:
+        max_part = json_config_file.get_particles_initdist_number()
+    if json_config_file.get_particles_raindist_method() == ConfigFile.PART_METH_PROP:
+        vol_part = json_config_file.get_particles_raindist_volume()
 
     # call function
     print("Performing particle tracking...")
-    # perform_tracking(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, hydrograph_fpath, max_part=max_part,
-    #                  all_part=all_part, vol_part=vol_part)
+    perform_tracking(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, hydrograph_fpath, max_part=max_part,
+                     all_part=all_part, vol_part=vol_part)
 
 
 def perform_tracking(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, hydrograph_fpath, max_part=None, all_part=None,
-                     vol_part=None):
+                     vol_part=None, engine=None, renumber_links=True, use_cache=True, prefetch_depth=None,
+                     num_workers=None, checkpoint_every=None, resume=False, prune=True, seed=None, delta_t=None,
+                     substeps=None, age_bin_width=None, age_bins=None, link_groups=None, groups_only=False):
     """
     Central function of the script.
     :param ref_h5_fpath:
     :param rvr_fpath:
     :param prm_fpath:
-    :param outlet_linkid:
+    :param outlet_linkid: Link id or list of link ids of the outlets whose contributing links are wanted
     :param hydrograph_fpath:
     :param max_part:
     :param all_part:
     :param vol_part:
+    :param engine: One of ENGINES. If None, ENGINE_OBJECTS is used.
+    :param renumber_links: If True, links are indexed in depth-first post-order (sub-basins contiguous in memory).
+    :param use_cache: If True, the compiled network cache next to the .rvr file is used (and created if needed).
+    :param prefetch_depth: Number of upcoming .h5 files read in background. If None, PREFETCH_DEPTH is used.
+    :param num_workers: Number of worker processes or threads of ENGINE_SUBBASINS and ENGINE_THREADS. If None, the
+                        number of CPUs is used.
+    :param checkpoint_every: Number of h5 files processed between checkpoints, zero for none. If None,
+                             CHECKPOINT_EVERY is used.
+    :param resume: If True, the run continues from the checkpoint of a previous run with the same output file.
+    :param prune: If True, only the links draining into the outlet are simulated.
+    :param seed: Integer seed of the random values. If None, numpy's global random state is used as it is.
+    :param delta_t: Seconds per step. If None, the spacing of the h5 files is used.
+    :param substeps: Number of steps between two h5 files, with states interpolated between them. If None, SUBSTEPS is
+                     used.
+    :param age_bin_width: Seconds per bin of the age histograms of the outlets. If None, AGE_BIN_WIDTH is used.
+    :param age_bins: Number of bins of the age histograms of the outlets, zero for none. If None, AGE_BINS is used.
+    :param link_groups: List of mappings of links into groups (as expected by LinkGroups.build) whose contributions
+                        are summed up at each step
+    :param groups_only: If True, only the contributions by group are kept, not the ones of each source link
     :return:
     """
 
+    engine = ENGINE_OBJECTS if engine is None else engine
+    substeps = SUBSTEPS if substeps is None else substeps
+    age_bin_width = AGE_BIN_WIDTH if age_bin_width is None else age_bin_width
+    age_bins = AGE_BINS if age_bins is None else age_bins
+    prefetch_depth = PREFETCH_DEPTH if prefetch_depth is None else prefetch_depth
+    checkpoint_every = CHECKPOINT_EVERY if checkpoint_every is None else checkpoint_every
+    in_store = engine in (ENGINE_STORE, ENGINE_VECTORIZED, ENGINE_SUBBASINS, ENGINE_THREADS)
+    outlet_linkids = list(outlet_linkid) if isinstance(outlet_linkid, (list, tuple)) else [outlet_linkid]
+
     # build parameters
-    domain_prm = AsynchFilesReader.build_topology(rvr_fpath)
-    AsynchFilesReader.fill_parameters(domain_prm, prm_fpath)
-    GblVars.domain_structure = domain_prm
+    if not load_domain(rvr_fpath, prm_fpath, outlet_linkids, renumber_links=renumber_links, use_cache=use_cache,
+                       prune=prune):
+        return
     GblVars.vol_particles = 0 if vol_part is None else vol_part
 
+    # lookup of the group of each link, for each mapping and outlet
+    outlets_groups = dict([(cur_outlet_id, []) for cur_outlet_id in outlet_linkids])
+    for cur_group_spec in ([] if link_groups is None else link_groups):
+        cur_outlets_groups = LinkGroups.build(cur_group_spec, outlet_linkids, GblVars.network_index)
+        if cur_outlets_groups is None:
+            print("Could not build the link groups '{0}'.".format(cur_group_spec))
+            return
+        for cur_outlet_id, cur_groups in cur_outlets_groups.items():
+            if cur_groups is not None:
+                outlets_groups[cur_outlet_id].append(cur_groups)
+
+    # seeded runs draw from counter-based streams, not depending on the number of workers or on particles order
+    GblVars.random_streams = None if seed is None else RandomStreams(seed)
+    if seed is not None:
+        np.random.seed(GblVars.random_streams.get_legacy_seed())
+
     '''
     if True:
         print("--QUIT() DEBUG--")
@@ -169,19 +450,62 @@ def perform_tracking(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, hydrogra
     # separate initial condition file
     ini_h5_file_path = all_h5_files[0]
     ini_h5_file_timestamp = H5FileReader.get_h5_file_timestamp(ini_h5_file_path)
+    files_time_steps = get_files_time_steps(all_h5_files, delta_t)
+    if files_time_steps is None:
+        return
+
+    # get the state of an interrupted run
+    checkpoint_fpath = CheckpointFile.get_file_path(hydrograph_fpath)
+    checkpoint = None
+    first_file_position = 0
+    if resume:
+        checkpoint = CheckpointFile.read(checkpoint_fpath)
+        if checkpoint is None:
+            print("Could not resume from '{0}'.".format(checkpoint_fpath))
+            return
+        last_file_position = int(checkpoint["last_file_position"])
+        if (last_file_position >= len(all_h5_files)) or \
+                (H5FileReader.get_h5_file_timestamp(all_h5_files[last_file_position]) !=
+                 int(checkpoint["timestamp"])):
+            print("Checkpoint '{0}' does not match the h5 files of '{1}'.".format(checkpoint_fpath, ref_h5_fpath))
+            return
+        first_file_position = last_file_position + 1
+        print("Resuming from file {0} of {1}.".format(first_file_position, len(all_h5_files)))
 
     # create initial conditions for particles
-    if (max_part is not None) and (all_part is None):
-        init_cond = OutputTracer.distribute_particles_proportional(topology, all_h5_files[0], max_part, outlet_linkid)
+    if checkpoint is not None:
+        init_cond = CheckpointFile.build_snapshot(checkpoint, particle_store=in_store,
+                                                  particle_buckets=(engine == ENGINE_BUCKET))
+    elif (max_part is not None) and (all_part is None):
+        init_cond = OutputTracer.distribute_particles_proportional(topology, all_h5_files[0], max_part, outlet_linkids[0])
     elif (max_part is None) and (all_part is not None):
         init_cond = OutputTracer.distribute_particles_equally(timestamp=ini_h5_file_timestamp, parts_in_pounds=all_part,
                                                               parts_in_toplayer=all_part, parts_in_subsurface=all_part,
-                                                              parts_in_channel=all_part)
+                                                              parts_in_channel=all_part,
+                                                              particle_store=in_store,
+                                                              particle_buckets=(engine == ENGINE_BUCKET))
         print("Created snapshot with {0} states.".format(len(init_cond.hl_states)))
     else:
         print("Missing information for initial condition.")
         return
 
+    # hand particles over to sub-basin workers (seeded from numpy's global random state)
+    subbasin_pool = None
+    if engine == ENGINE_SUBBASINS:
+        subbasin_pool = SubbasinPool(GblVars.network_index, os.cpu_count() if num_workers is None else num_workers,
+                                     outlet_link_ids=outlet_linkids, seed=int(np.random.randint(0, 2**30)),
+                                     random_streams=GblVars.random_streams)
+        init_cond.particles = subbasin_pool.scatter(init_cond.particles)
+    thread_manager = ThreadManager(num_workers) if engine == ENGINE_THREADS else None
+
+    # continue the random sequences where they were
+    if checkpoint is not None:
+        CheckpointFile.restore_random_state(checkpoint)
+        worker_random_states = CheckpointFile.get_worker_random_states(checkpoint)
+        if (subbasin_pool is not None) and ((worker_random_states is None) or
+                                            (not subbasin_pool.set_random_states(worker_random_states))):
+            print("Workers random states not restored: checkpoint written with other number of workers.")
+
     # debug 1
     print("Count parts 1a = {0}".format(init_cond.count_particles()))
     print("...at '{0}'.".format(datetime.datetime.now()))
@@ -192,31 +516,182 @@ def perform_tracking(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, hydrogra
     #
     limit_files = None
     cur_cond = init_cond
-    contrib_links_dict = {}
-    total_files = len(all_h5_files)
-    for count_files, cur_h5_file_path in enumerate(all_h5_files):
-        cur_file_timestamp = extract_timestamp_from_filepath(cur_h5_file_path)
-        next_cond = advance_particles(cur_h5_file_path, cur_cond)
-        cur_cond.outlet_link_id = outlet_linkid
-        # contrib_links_dict[cur_file_timestamp] = next_cond.get_contributing_links()
-        contrib_links_dict[cur_file_timestamp] = cur_cond.get_contributing_links(aggregate_rain=True)
-
-        '''
-        print("Total particles at {0}: {1} to {2}.".format(count_files, cur_cond.count_particles(),
-                                                           next_cond.count_particles()))
-        '''
-        print("File {0} of {1}.".format(count_files, total_files))
-        cur_cond = next_cond
-        if (limit_files is not None) and (count_files >= limit_files):
-            break
-
-        # debug 2
-        debug_parts(cur_cond)
+    contrib_links_dict = dict([(cur_outlet_id, {}) for cur_outlet_id in outlet_linkids])
+    contrib_writer = None
+    if ContribFileWriter.is_contrib_file(hydrograph_fpath):
+        contrib_writer = ContribFileWriter(hydrograph_fpath,
+                                           resume_steps=(first_file_position if checkpoint is not None else None))
+    elif checkpoint is not None:
+        contrib_links_dict = load_contrib_links(hydrograph_fpath, outlet_linkids, int(checkpoint["timestamp"]))
+    try:
+        total_files = len(all_h5_files)
+        prev_content = None
+        if (substeps > 1) and (first_file_position > 0):
+            prev_content = H5FileReader.read_snapshot_dataset(all_h5_files[first_file_position - 1],
+                                                              shared_buffer=False)
+        with H5Prefetcher(all_h5_files[first_file_position:], depth=prefetch_depth) as h5_prefetcher:
+            for count_files in range(first_file_position, total_files):
+                cur_h5_file_path = all_h5_files[count_files]
+                cur_file_timestamp = extract_timestamp_from_filepath(cur_h5_file_path)
+                cur_content = h5_prefetcher.get_snapshot_content(count_files - first_file_position)
+                if substeps > 1:
+                    cur_cond, next_cond = advance_particles_substeps(cur_h5_file_path, cur_cond, prev_content,
+                                                                     cur_content, files_time_steps[count_files],
+                                                                     substeps, engine=engine,
+                                                                     thread_manager=thread_manager)
+                    prev_content = np.array(cur_content, copy=True)
+                else:
+                    GblVars.delta_t = int(files_time_steps[count_files])
+                    next_cond = advance_particles(cur_h5_file_path, cur_cond, engine=engine,
+                                                  snapshot_content=cur_content, thread_manager=thread_manager)
+                cur_cond.outlet_link_id = outlet_linkids[0]
+                # contrib_links_dict[cur_file_timestamp] = next_cond.get_contributing_links()
+                # rain timestamps are kept apart only as long as needed to age the particles
+                all_contribs = cur_cond.get_outlets_contributions(outlet_linkids, aggregate_rain=(age_bins == 0))
+                for cur_outlet_id in outlet_linkids:
+                    cur_contribs, cur_ages, cur_groups = all_contribs[cur_outlet_id], None, None
+                    if (cur_contribs is not None) and (age_bins > 0):
+                        cur_ages = OutletAges.count(cur_contribs, cur_file_timestamp, ini_h5_file_timestamp,
+                                                    age_bin_width, age_bins)
+                        cur_contribs = cur_contribs.aggregate()
+                    if cur_contribs is not None:
+                        cur_groups = [g.count(cur_contribs) for g in outlets_groups[cur_outlet_id]]
+                        if groups_only:
+                            cur_contribs = OutletContributions(cur_outlet_id, [], [], [],
+                                                               discharge=cur_contribs.discharge)
+                    if contrib_writer is not None:
+                        contrib_writer.append(cur_file_timestamp, cur_contribs, ages=cur_ages, groups=cur_groups)
+                    else:
+                        contrib_links_dict[cur_outlet_id][cur_file_timestamp] = None if cur_contribs is None else \
+                            cur_contribs.to_dict(with_header=True)
+                        if cur_ages is not None:
+                            contrib_links_dict[cur_outlet_id][cur_file_timestamp]["ages"] = cur_ages.to_dict()
+                        if cur_groups:
+                            contrib_links_dict[cur_outlet_id][cur_file_timestamp]["groups"] = \
+                                dict([(g.name, g.to_dict()) for g in cur_groups])
+
+                '''
+                print("Total particles at {0}: {1} to {2}.".format(count_files, cur_cond.count_particles(),
+                                                                   next_cond.count_particles()))
+                '''
+                print("File {0} of {1}.".format(count_files, total_files))
+                cur_cond = next_cond
+                if (checkpoint_every > 0) and ((count_files + 1) % checkpoint_every == 0) and \
+                        (count_files + 1 < total_files):
+                    write_checkpoint(checkpoint_fpath, cur_cond, count_files, hydrograph_fpath,
+                                     contrib_writer=contrib_writer, contrib_links_dict=contrib_links_dict,
+                                     subbasin_pool=subbasin_pool)
+                if (limit_files is not None) and (count_files >= limit_files):
+                    break
+
+                # debug 2
+                debug_parts(cur_cond)
+    finally:
+        # workers and writer thread are ended even if the run is interrupted, e.g. by an unreadable file
+        if subbasin_pool is not None:
+            subbasin_pool.close()
+        if thread_manager is not None:
+            thread_manager.close()
+        if contrib_writer is not None:
+            contrib_writer.close()
 
     # writing binary file
-    with open(hydrograph_fpath, "wb+") as wfile:
-        pickle.dump(contrib_links_dict, wfile)
-    print("Wrote file '{0}'.".format(hydrograph_fpath))
+    if contrib_writer is None:
+        save_contrib_links(hydrograph_fpath, contrib_links_dict)
+        print("Wrote file '{0}'.".format(hydrograph_fpath))
+
+    # the run is complete, nothing to resume from
+    if os.path.exists(checkpoint_fpath):
+        os.remove(checkpoint_fpath)
+
+    return
+
+
+def perform_ensemble(ref_h5_fpath, rvr_fpath, prm_fpath, outlet_linkid, summary_fpath, num_members, all_part=None,
+                     vol_part=None, engine=None, renumber_links=True, use_cache=True, prefetch_depth=None,
+                     num_workers=None, prune=True, quantiles=None, seed=None, delta_t=None):
+    """
+    Runs several realizations of 'perform_tracking' in parallel, reading each h5 file only once, and writes the
+    statistics of their contributions step by step instead of the contributions of each realization.
+    :param ref_h5_fpath:
+    :param rvr_fpath:
+    :param prm_fpath:
+    :param outlet_linkid: Link id or list of link ids of the outlets whose contributing links are wanted
+    :param summary_fpath: Output HDF5 file path
+    :param num_members: Number of realizations
+    :param all_part:
+    :param vol_part:
+    :param engine: One of ENSEMBLE_ENGINES. If None, ENGINE_VECTORIZED is used.
+    :param renumber_links:
+    :param use_cache:
+    :param prefetch_depth: Number of upcoming .h5 files read in background. If None, PREFETCH_DEPTH is used.
+    :param num_workers: Number of worker processes. If None, the number of CPUs is used.
+    :param prune:
+    :param quantiles: Sequence of quantiles of the contributions to be written. If None, ENSEMBLE_QUANTILES is used.
+    :param seed: Integer seed of the ensemble. If None, it is drawn from numpy's global random state.
+    :param delta_t: Seconds per step. If None, the spacing of the h5 files is used.
+    :return:
+    """
+
+    engine = ENGINE_VECTORIZED if engine is None else engine
+    prefetch_depth = PREFETCH_DEPTH if prefetch_depth is None else prefetch_depth
+    quantiles = ENSEMBLE_QUANTILES if quantiles is None else quantiles
+    outlet_linkids = list(outlet_linkid) if isinstance(outlet_linkid, (list, tuple)) else [outlet_linkid]
+
+    # basic checks
+    if engine not in ENSEMBLE_ENGINES:
+        print("Engine '{0}' cannot be used by ensembles, expected one of {1}.".format(engine, ENSEMBLE_ENGINES))
+        return
+    if all_part is None:
+        print("Missing information for initial condition.")
+        return
+
+    # build parameters
+    if not load_domain(rvr_fpath, prm_fpath, outlet_linkids, renumber_links=renumber_links, use_cache=use_cache,
+                       prune=prune):
+        return
+    GblVars.vol_particles = 0 if vol_part is None else vol_part
+
+    # list all h5 files and basic check it
+    all_h5_files = H5FileReader.list_h5_files(ref_h5_fpath)
+    if (all_h5_files is None) or (len(all_h5_files) == 0):
+        print("Not enough files in '{0}'.".format(ref_h5_fpath))
+        return
+
+    files_time_steps = get_files_time_steps(all_h5_files, delta_t)
+    if files_time_steps is None:
+        return
+    files_time_steps = dict(zip(all_h5_files, files_time_steps.tolist()))
+
+    # same initial condition for all members, which only differ by their random draws
+    init_cond = OutputTracer.distribute_particles_equally(
+        timestamp=H5FileReader.get_h5_file_timestamp(all_h5_files[0]), parts_in_pounds=all_part,
+        parts_in_toplayer=all_part, parts_in_subsurface=all_part, parts_in_channel=all_part,
+        particle_store=engine in (ENGINE_STORE, ENGINE_VECTORIZED), particle_buckets=(engine == ENGINE_BUCKET))
+
+    def step_member(h5_file_path, cur_snapshot, snapshot_content):
+        GblVars.delta_t = int(files_time_steps[h5_file_path])
+        next_snapshot = advance_particles(h5_file_path, cur_snapshot, engine=engine, snapshot_content=snapshot_content)
+        cur_snapshot.outlet_link_id = outlet_linkids[0]
+        return next_snapshot
+
+    all_stats = [EnsembleStats(cur_outlet_id, quantiles) for cur_outlet_id in outlet_linkids]
+    total_files = len(all_h5_files)
+    ensemble_streams = RandomStreams(int(np.random.randint(0, 2**30)) if seed is None else seed)
+    with EnsemblePool(init_cond, num_members, os.cpu_count() if num_workers is None else num_workers, step_member,
+                      outlet_linkids, ensemble_streams) as ensemble_pool, \
+            EnsembleFileWriter(summary_fpath, num_members) as summary_writer, \
+            H5Prefetcher(all_h5_files, depth=prefetch_depth) as h5_prefetcher:
+        for count_files in range(total_files):
+            cur_h5_file_path = all_h5_files[count_files]
+            all_members_contribs = ensemble_pool.advance(cur_h5_file_path,
+                                                         h5_prefetcher.get_snapshot_content(count_files))
+            for cur_stats in all_stats:
+                cur_stats.reset()
+                for cur_member_contribs in all_members_contribs:
+                    cur_stats.add(cur_member_contribs[cur_stats.outlet_link_id])
+                summary_writer.append(extract_timestamp_from_filepath(cur_h5_file_path), cur_stats)
+            print("File {0} of {1}.".format(count_files, total_files))
 
     return
 
@@ -230,9 +705,9 @@ def calculate_volume_in_link(disch_dict, link_id):
     :return:
     """
 
-    chan_len = GblVars.domain_structure[link_id].get_link_length()
-    chan_aup = GblVars.domain_structure[link_id].get_upstream_area()
-    chan_ahl = GblVars.domain_structure[link_id].get_hillslope_area()
+    link_idx = GblVars.network_index.get_index(link_id)
+    chan_len = GblVars.network_index.link_length[link_idx]
+    chan_aup = GblVars.network_index.upstream_area[link_idx]
     chan_dsc = disch_dict[link_id]
 
     # print("Link length: {0}".format(chan_len))
@@ -243,118 +718,341 @@ def calculate_volume_in_link(disch_dict, link_id):
     return vol_disch
 
 
-def advance_particles(h5_file_path, cur_snapshot):
+def draw_transfer(step_probs, cur_rdm_val):
+    """
+    Uses a single uniform value to know which transfer, if any, a particle makes along the whole step. Equivalent to
+    repeating GblVars.delta_t single-trial draws, whatever the duration of the step.
+    :param step_probs: Increasing sequence of probabilities of leaving within the step, as given (for one link) by
+                       TransferKernel.step_probabilities
+    :param cur_rdm_val: Uniform value in [0, 1) drawn for the particle
+    :return: Index of the first probability above the value, None if the particle got stuck
+    """
+
+    for cur_exit, cur_prob in enumerate(step_probs):
+        if cur_rdm_val < cur_prob:
+            return cur_exit
+    return None
+
+
+def get_links_step_probabilities(cur_snapshot):
+    """
+    Gets, for the engines moving particles one by one, the probabilities of leaving each compartment within the step
+    :param cur_snapshot: DomainSnapshot with 'hydraulics' filled
+    :return: List with, for each link, the list of probabilities indexed by TransferKernel.STEP_...
+    """
+
+    links_probs, _ = get_links_probabilities(cur_snapshot)
+    return TransferKernel.step_probabilities(*links_probs, num_trials=GblVars.delta_t).T.tolist()
+
+
+def get_links_probabilities(cur_snapshot):
+    """
+    Gathers the single-trial leaving probabilities and the downstream link of each link in the particle store order
+    :param cur_snapshot: DomainSnapshot with 'hydraulics' filled
+    :return: Tuple of 5 probabilities arrays (as in DomainHydraulics.get_leave_probabilities) and array of downstream
+             link indexes (-1 if leaving the domain)
+    """
+
+    return cur_snapshot.hydraulics.get_leave_probabilities(), GblVars.network_index.downstream_idx
+
+
+def draw_uniforms(cur_parts, step_key):
+    """
+    Draws one uniform value per particle, from the streams of GblVars.random_streams if the run is seeded
+    :param cur_parts: ParticleStore object
+    :param step_key: Integer identifying the step (the timestamp of the h5 file being applied)
+    :return: Array of uniform values in [0, 1)
+    """
+    if GblVars.random_streams is None:
+        return np.random.uniform(0, 1, size=cur_parts.count_particles())
+    return GblVars.random_streams.particles_uniforms(step_key, cur_parts)
+
+
+def draw_objects_uniforms(cur_snapshot, step_key):
+    """
+    Same as 'draw_uniforms' for the Particle objects of a snapshot, in the order in which 'advance_particles' moves them
+    :param cur_snapshot: DomainSnapshot with the particles in its 'hl_states'
+    :param step_key: Integer identifying the step (the timestamp of the h5 file being applied)
+    :return: Iterator over uniform values in [0, 1)
+    """
+
+    all_states = [cur_snapshot.hl_states[cur_link_id] for cur_link_id in GblVars.network_index.link_ids.tolist()]
+    if GblVars.random_streams is None:
+        num_parts = sum([len(s.parts_chnl_frnt) + len(s.parts_subs_frnt) + len(s.parts_topl_frnt) +
+                         len(s.parts_pond_frnt) for s in all_states])
+        return iter(np.random.uniform(0, 1, size=num_parts).tolist())
+
+    parts_link, parts_comp, parts_src_link, parts_src_layer = [], [], [], []
+    for cur_link_id, cur_state in zip(GblVars.network_index.link_ids.tolist(), all_states):
+        for cur_comp, cur_parts in ((ParticleStore.COMP_CHANNEL, cur_state.parts_chnl_frnt),
+                                    (ParticleStore.COMP_SUBSURFACE, cur_state.parts_subs_frnt),
+                                    (ParticleStore.COMP_TOPLAYER, cur_state.parts_topl_frnt),
+                                    (ParticleStore.COMP_POND, cur_state.parts_pond_frnt)):
+            for cur_particle in cur_parts:
+                parts_link.append(cur_link_id)
+                parts_comp.append(cur_comp)
+                parts_src_link.append(cur_particle.get_linkid())
+                parts_src_layer.append(cur_particle.get_layer_source())
+    return iter(GblVars.random_streams.uniforms(step_key, parts_link, parts_comp, parts_src_link,
+                                                parts_src_layer).tolist())
+
+
+def advance_particles_vectorized(cur_snapshot, layer_counters=None, step_key=None):
+    """
+    Moves all the particles held in the ParticleStore of a snapshot with a single vectorized random draw
+    :param cur_snapshot: DomainSnapshot with 'particles' store and 'hydraulics' filled
+    :param layer_counters: LayerCounters from which the particles leaving the domain are removed, if any
+    :param step_key: Integer identifying the step for seeded runs
+    :return: New ParticleStore with the moved particles
+    """
+
+    cur_parts = cur_snapshot.particles
+    links_probs, links_down = get_links_probabilities(cur_snapshot)
+    step_probs = TransferKernel.step_probabilities(*links_probs, num_trials=GblVars.delta_t)
+
+    rdm_values = draw_uniforms(cur_parts, step_key)
+    new_link, new_comp, still_in = TransferKernel.move(cur_parts.link, cur_parts.comp, rdm_values, step_probs,
+                                                       links_down)
+
+    if layer_counters is not None:
+        layer_counters.remove(cur_parts.src_link[~still_in], cur_parts.src_layer[~still_in])
+    return cur_parts.derive(new_link[still_in], new_comp[still_in], cur_parts.src_link[still_in],
+                            cur_parts.src_layer[still_in])
+
+
+def advance_particles_threads(cur_snapshot, thread_manager, layer_counters=None, step_key=None):
+    """
+    Same as 'advance_particles_vectorized', with chunks of links processed by the threads of a ThreadManager
+    :param cur_snapshot: DomainSnapshot with 'particles' store and 'hydraulics' filled
+    :param thread_manager: ThreadManager object
+    :param layer_counters: LayerCounters from which the particles leaving the domain are removed, if any
+    :param step_key: Integer identifying the step for seeded runs
+    :return: New ParticleStore with the moved particles
+    """
+
+    cur_parts = cur_snapshot.particles
+    links_probs, links_down = get_links_probabilities(cur_snapshot)
+
+    rdm_values = draw_uniforms(cur_parts, step_key)
+    new_link, new_comp, still_in = thread_manager.move(cur_parts.link, cur_parts.comp, rdm_values, links_probs,
+                                                       links_down, GblVars.delta_t)
+
+    if layer_counters is not None:
+        layer_counters.remove(cur_parts.src_link[~still_in], cur_parts.src_layer[~still_in])
+    return cur_parts.derive(new_link[still_in], new_comp[still_in], cur_parts.src_link[still_in],
+                            cur_parts.src_layer[still_in])
+
+
+def advance_particles_subbasins(cur_snapshot, step_key=None):
+    """
+    Moves all the particles held by the workers of a SubbasinPool, each worker moving the ones of its sub-basins
+    :param cur_snapshot: DomainSnapshot with 'particles' as SubbasinParticles and 'hydraulics' filled
+    :param step_key: Integer identifying the step for seeded runs
+    :return: New SubbasinParticles with the moved particles
+    """
+
+    links_probs, _ = get_links_probabilities(cur_snapshot)
+    step_probs = TransferKernel.step_probabilities(*links_probs, num_trials=GblVars.delta_t)
+    return cur_snapshot.particles.advance(step_probs, step_key=step_key)
+
+
+def advance_particles_buckets(cur_snapshot, layer_counters=None, step_key=None):
+    """
+    Moves all the particles counted in the ParticleBuckets of a snapshot, splitting each bucket with binomial draws
+    :param cur_snapshot: DomainSnapshot with 'particles' buckets and 'hydraulics' filled
+    :param layer_counters: LayerCounters from which the particles leaving the domain are removed, if any
+    :param step_key: Integer identifying the step for seeded runs
+    :return: New ParticleBuckets with the moved particles
+    """
+
+    cur_parts = cur_snapshot.particles
+    links_probs, links_down = get_links_probabilities(cur_snapshot)
+    step_probs = TransferKernel.step_probabilities(*links_probs, num_trials=GblVars.delta_t)
+    rng = None if GblVars.random_streams is None else GblVars.random_streams.get_generator(step_key)
+
+    new_link, new_comp, new_counts, new_rows = TransferKernel.split(cur_parts.link, cur_parts.comp, cur_parts.counts,
+                                                                    step_probs, links_down, rng=rng)
+
+    # whatever is missing from each bucket left the domain
+    if layer_counters is not None:
+        left_counts = cur_parts.counts - np.bincount(new_rows, weights=new_counts,
+                                                     minlength=len(cur_parts.counts)).astype(np.int64)
+        left_rows = np.flatnonzero(left_counts)
+        layer_counters.remove(cur_parts.src_link[left_rows], cur_parts.src_layer[left_rows], left_counts[left_rows])
+
+    return cur_parts.derive(new_link, new_comp, cur_parts.src_link[new_rows], cur_parts.src_layer[new_rows],
+                            new_counts)
+
+
+def advance_particles_store(cur_snapshot, layer_counters=None, step_key=None):
+    """
+    Moves the particles held in the ParticleStore of a snapshot
+    :param cur_snapshot: DomainSnapshot with 'particles' store and 'hydraulics' filled
+    :param layer_counters: LayerCounters from which the particles leaving the domain are removed, if any
+    :param step_key: Integer identifying the step for seeded runs
+    :return: New ParticleStore with the moved particles
+    """
+
+    cur_parts = cur_snapshot.particles
+    links_down = GblVars.network_index.downstream_idx
+    links_probs = get_links_step_probabilities(cur_snapshot)
+    rdm_values = draw_uniforms(cur_parts, step_key).tolist()
+
+    # move each particle
+    new_link = cur_parts.link.copy()
+    new_comp = cur_parts.comp.copy()
+    still_in = np.ones(cur_parts.count_particles(), dtype=bool)
+    for i, (cur_link_idx, cur_comp) in enumerate(zip(cur_parts.link.tolist(), cur_parts.comp.tolist())):
+        prob_leave_cc, prob_leave_sc, prob_leave_ts, prob_leave_pc, prob_leave_pt = links_probs[cur_link_idx]
+        if cur_comp == ParticleStore.COMP_CHANNEL:
+            if draw_transfer((prob_leave_cc, ), rdm_values[i]) is not None:
+                if links_down[cur_link_idx] < 0:
+                    still_in[i] = False                                                       # particle left domain
+                else:
+                    new_link[i] = links_down[cur_link_idx]
+        elif cur_comp == ParticleStore.COMP_SUBSURFACE:
+            if draw_transfer((prob_leave_sc, ), rdm_values[i]) is not None:
+                new_comp[i] = ParticleStore.COMP_CHANNEL
+        elif cur_comp == ParticleStore.COMP_TOPLAYER:
+            if draw_transfer((prob_leave_ts, ), rdm_values[i]) is not None:
+                new_comp[i] = ParticleStore.COMP_SUBSURFACE
+        elif cur_comp == ParticleStore.COMP_POND:
+            cur_exit = draw_transfer((prob_leave_pc, prob_leave_pt), rdm_values[i])
+            if cur_exit == 0:
+                new_comp[i] = ParticleStore.COMP_CHANNEL
+            elif cur_exit == 1:
+                new_comp[i] = ParticleStore.COMP_TOPLAYER
+
+    if layer_counters is not None:
+        layer_counters.remove(cur_parts.src_link[~still_in], cur_parts.src_layer[~still_in])
+    return cur_parts.derive(new_link[still_in], new_comp[still_in], cur_parts.src_link[still_in],
+                            cur_parts.src_layer[still_in])
+
+
+def advance_particles_substeps(h5_file_path, cur_snapshot, prev_content, snapshot_content, time_step, substeps,
+                               engine=None, thread_manager=None):
+    """
+    Moves particles along the interval before an h5 file in several steps, with states linearly interpolated from the
+    ones of the previous file
+    :param h5_file_path:
+    :param cur_snapshot: DomainSnapshot at the beginning of the interval
+    :param prev_content: Content of the previous h5 file, None to use 'snapshot_content' all along the interval
+    :param snapshot_content: Content of the h5 file
+    :param time_step: Seconds of the whole interval
+    :param substeps: Number of steps in the interval
+    :param engine:
+    :param thread_manager:
+    :return: Tuple (DomainSnapshot moved in the last step, filled with the states of the h5 file, and the new
+             DomainSnapshot at the end of the interval)
+    """
+
+    file_timestamp = H5FileReader.get_h5_file_timestamp(h5_file_path)
+    GblVars.delta_t = max(int(round(time_step / substeps)), 1)
+    next_snapshot = None
+    for cur_substep in range(1, substeps + 1):
+        if next_snapshot is not None:
+            cur_snapshot = next_snapshot
+        cur_content = H5FileReader.interpolate_snapshot_content(prev_content, snapshot_content,
+                                                                cur_substep / substeps)
+        next_snapshot = advance_particles(h5_file_path, cur_snapshot, engine=engine, snapshot_content=cur_content,
+                                          thread_manager=thread_manager,
+                                          the_timestamp=file_timestamp - (time_step * (substeps - cur_substep)) //
+                                          substeps)
+    return cur_snapshot, next_snapshot
+
+
+def advance_particles(h5_file_path, cur_snapshot, engine=None, snapshot_content=None, thread_manager=None,
+                      the_timestamp=None):
     """
 
     :param h5_file_path:
     :param cur_snapshot:
-    :param volume_particles:
+    :param engine: One of ENGINES. Only used when particles are held in a ParticleStore or ParticleBuckets.
+    :param snapshot_content: Content of the h5 file already read (e.g. by a H5Prefetcher). If None, file is read.
+    :param thread_manager: ThreadManager object, only used by ENGINE_THREADS
+    :param the_timestamp: Timestamp of the new snapshot. If None, the one of the h5 file.
     :return: New dictionary with new particles condition
     """
 
-    count_links_dbg = 10
-
     # disch_dict = H5FileReader.read_h5_file(h5_file_path)
-    H5FileReader.read_h5_file_and_fill_snapshot(h5_file_path, cur_snapshot)
-    the_timestamp = H5FileReader.get_h5_file_timestamp(h5_file_path)
+    H5FileReader.read_h5_file_and_fill_snapshot(h5_file_path, cur_snapshot, snapshot_content=snapshot_content)
+    if the_timestamp is None:
+        the_timestamp = H5FileReader.get_h5_file_timestamp(h5_file_path)
 
     # create new empty domain snapshot
     ret_snapshot = DomainSnapshot(hillslopelink_ids=cur_snapshot.hl_states.keys(), the_timestamp=the_timestamp)
     ret_snapshot.inherit_cummulated_rained_parts(cur_snapshot)
 
+    # sub-basin workers count their own particles
+    if (cur_snapshot.particles is None) or (engine != ENGINE_SUBBASINS):
+        ret_snapshot.inherit_layer_counters(cur_snapshot)
+    layer_counters = ret_snapshot.layer_counters
+
+    # move particles held in a particle store
+    if (cur_snapshot.particles is not None) and (engine == ENGINE_BUCKET):
+        ret_snapshot.particles = advance_particles_buckets(cur_snapshot, layer_counters=layer_counters,
+                                                           step_key=the_timestamp)
+        return ret_snapshot
+    elif (cur_snapshot.particles is not None) and (engine == ENGINE_THREADS):
+        ret_snapshot.particles = advance_particles_threads(cur_snapshot, thread_manager, layer_counters=layer_counters,
+                                                           step_key=the_timestamp)
+        return ret_snapshot
+    elif (cur_snapshot.particles is not None) and (engine == ENGINE_SUBBASINS):
+        ret_snapshot.particles = advance_particles_subbasins(cur_snapshot, step_key=the_timestamp)
+        return ret_snapshot
+    elif (cur_snapshot.particles is not None) and (engine == ENGINE_VECTORIZED):
+        ret_snapshot.particles = advance_particles_vectorized(cur_snapshot, layer_counters=layer_counters,
+                                                              step_key=the_timestamp)
+        return ret_snapshot
+    elif cur_snapshot.particles is not None:
+        ret_snapshot.particles = advance_particles_store(cur_snapshot, layer_counters=layer_counters,
+                                                         step_key=the_timestamp)
+        return ret_snapshot
+
     # iterate and move particles
-    total_links = len(cur_snapshot.hl_states.keys())
-    for i, cur_link_id in enumerate(cur_snapshot.hl_states.keys()):
-
-        # estimate channel volume and prob. of leaving it
-        # cur_link_vol = calculate_volume_in_link(disch_dict, cur_link_id)
-        cur_link_vol = cur_snapshot.hl_states[cur_link_id].volum_chnl
-        cur_link_dsc = cur_snapshot.hl_states[cur_link_id].disch_chnl
-        prob_leave_cc = cur_link_dsc / cur_link_vol
-        prob_leave_sc = cur_snapshot.hl_states[cur_link_id].volum_subs / cur_snapshot.hl_states[cur_link_id].disch_ssch
-        prob_leave_ts = cur_snapshot.hl_states[cur_link_id].volum_tplr / cur_snapshot.hl_states[cur_link_id].disch_tlss
-        prob_leave_pc = cur_snapshot.hl_states[cur_link_id].volum_pond / cur_snapshot.hl_states[cur_link_id].disch_pdch
-        prob_leave_pt = cur_snapshot.hl_states[cur_link_id].volum_pond / cur_snapshot.hl_states[cur_link_id].disch_pdtl
-        prob_leave_pt += prob_leave_pc
-
-        # debug
-        '''
-        if count_links_dbg > 0:
-            print("{0} <- {1}".format(total_links, i))
-            print("Link {0}: {1:.4f}/{2:.4f} = {3:.4f}".format(cur_link_id, cur_link_dsc, cur_link_vol, prob_leave_cc))
-            print("Link {0}: {1:.4f}/{2:.4f} = {3:.4f}".format(cur_link_id,
-                                                               cur_snapshot.hl_states[cur_link_id].disch_ssch,
-                                                               cur_snapshot.hl_states[cur_link_id].volum_subs,
-                                                               prob_leave_sc))
-            print("Link {0}: {1:.4f}/{2:.4f} = {3:.4f}".format(cur_link_id,
-                                                               cur_snapshot.hl_states[cur_link_id].disch_tlss,
-                                                               cur_snapshot.hl_states[cur_link_id].volum_tplr,
-                                                               prob_leave_ts))
-            print("Link {0}: {1:.4f}/{2:.4f} = {3:.4f}".format(cur_link_id,
-                                                               cur_snapshot.hl_states[cur_link_id].disch_pdch,
-                                                               cur_snapshot.hl_states[cur_link_id].volum_pond,
-                                                               prob_leave_pc))
-            print("Link {0}: {1:.4f}/{2:.4f} = {3:.4f}".format(cur_link_id,
-                                                               cur_snapshot.hl_states[cur_link_id].disch_pdtl,
-                                                               cur_snapshot.hl_states[cur_link_id].volum_pond,
-                                                               prob_leave_pt))
-            count_links_dbg -= 1
-            if count_links_dbg == 0:
-                print(" (...)")
-                count_links_dbg -= 1
-        '''
+    all_link_ids = GblVars.network_index.link_ids
+    all_links_probs = get_links_step_probabilities(cur_snapshot)
+    rdm_values = draw_objects_uniforms(cur_snapshot, the_timestamp)
+    for cur_link_idx, (cur_link_id, cur_links_probs) in enumerate(zip(all_link_ids.tolist(), all_links_probs)):
+
+        # prob. of leaving each compartment along the step
+        prob_leave_cc, prob_leave_sc, prob_leave_ts, prob_leave_pc, prob_leave_pt = cur_links_probs
 
         # move particles from one channel to other
         for cur_particle in cur_snapshot.hl_states[cur_link_id].parts_chnl_frnt:
-            count_times = GblVars.delta_t
-            while count_times > 0:
-                cur_rdm_val = np.random.uniform(0, 1)                                                     # limit tries
-                if cur_rdm_val <= prob_leave_cc:
-                    cur_downlink_id = GblVars.domain_structure[cur_link_id].get_downstream_hl_id()
-                    if (cur_downlink_id is not None) and (cur_downlink_id in ret_snapshot.hl_states.keys()):
-                        ret_snapshot.hl_states[cur_downlink_id].parts_chnl_frnt.append(cur_particle)  # particle flowed
-                    break
-                count_times -= 1
-            if count_times <= 0:
+            if draw_transfer((prob_leave_cc, ), next(rdm_values)) is not None:
+                cur_downlink_idx = GblVars.network_index.downstream_idx[cur_link_idx]
+                if cur_downlink_idx >= 0:
+                    cur_downlink_id = int(all_link_ids[cur_downlink_idx])
+                    ret_snapshot.hl_states[cur_downlink_id].parts_chnl_frnt.append(cur_particle)  # particle flowed
+                elif layer_counters is not None:
+                    layer_counters.remove(GblVars.network_index.get_index(cur_particle.get_linkid()),
+                                          cur_particle.get_layer_source())                       # particle left
+            else:
                 ret_snapshot.hl_states[cur_link_id].parts_chnl_frnt.append(cur_particle)           # particle got stuck
 
         # move particles from sub surface to channel
         for cur_particle in cur_snapshot.hl_states[cur_link_id].parts_subs_frnt:
-            count_times = GblVars.delta_t
-            while count_times > 0:
-                cur_rdm_val = np.random.uniform(0, 1)
-                if cur_rdm_val <= prob_leave_sc:
-                    ret_snapshot.hl_states[cur_link_id].parts_chnl_frnt.append(cur_particle)
-                    break
-                count_times -= 1
-            if count_times <= 0:
+            if draw_transfer((prob_leave_sc, ), next(rdm_values)) is not None:
+                ret_snapshot.hl_states[cur_link_id].parts_chnl_frnt.append(cur_particle)
+            else:
                 ret_snapshot.hl_states[cur_link_id].parts_subs_frnt.append(cur_particle)
 
         # move particles from top layer to sub surface
         for cur_particle in cur_snapshot.hl_states[cur_link_id].parts_topl_frnt:
-            count_times = GblVars.delta_t
-            while count_times > 0:
-                cur_rdm_val = np.random.uniform(0, 1)
-                if cur_rdm_val <= prob_leave_ts:
-                    ret_snapshot.hl_states[cur_link_id].parts_subs_frnt.append(cur_particle)
-                    break
-                count_times -= 1
-            if count_times <= 0:
+            if draw_transfer((prob_leave_ts, ), next(rdm_values)) is not None:
+                ret_snapshot.hl_states[cur_link_id].parts_subs_frnt.append(cur_particle)
+            else:
                 ret_snapshot.hl_states[cur_link_id].parts_topl_frnt.append(cur_particle)
 
         # move particles from ponds to top layer or to channel
         for cur_particle in cur_snapshot.hl_states[cur_link_id].parts_pond_frnt:
-            count_times = GblVars.delta_t
-            while count_times > 0:
-                cur_rdm_val = np.random.uniform(0, 1)
-                if cur_rdm_val <= prob_leave_pc:
-                    ret_snapshot.hl_states[cur_link_id].parts_chnl_frnt.append(cur_particle)
-                    break
-                elif cur_rdm_val <= prob_leave_pt:
-                    ret_snapshot.hl_states[cur_link_id].parts_topl_frnt.append(cur_particle)
-                    break
-                count_times -= 1
-            if count_times <= 0:
+            cur_exit = draw_transfer((prob_leave_pc, prob_leave_pt), next(rdm_values))
+            if cur_exit == 0:
+                ret_snapshot.hl_states[cur_link_id].parts_chnl_frnt.append(cur_particle)
+            elif cur_exit == 1:
+                ret_snapshot.hl_states[cur_link_id].parts_topl_frnt.append(cur_particle)
+            else:
                 ret_snapshot.hl_states[cur_link_id].parts_pond_frnt.append(cur_particle)
 
     #
@@ -363,9 +1061,21 @@ def advance_particles(h5_file_path, cur_snapshot):
 
 # ###################################################### RUNS ######################################################## #
 
-if config_json_fpath_arg is None:
+TransferKernel.use_jit = not no_jit_arg
+if (config_json_fpath_arg is None) and (members_arg is not None):
+    perform_ensemble(input_fh5_fpath_arg, input_rvr_fpath_arg, input_prm_fpath_arg, linkid_arg, output_fpath_arg,
+                     members_arg, all_part=all_part_arg, vol_part=vol_part_arg, engine=engine_arg,
+                     renumber_links=not keep_link_order_arg, use_cache=not no_cache_arg,
+                     prefetch_depth=prefetch_arg, num_workers=workers_arg, prune=not no_prune_arg, seed=seed_arg,
+                     delta_t=delta_t_arg)
+elif config_json_fpath_arg is None:
     perform_tracking(input_fh5_fpath_arg, input_rvr_fpath_arg, input_prm_fpath_arg, linkid_arg, output_fpath_arg,
-                     max_part=max_part_arg, all_part=all_part_arg, vol_part=vol_part_arg)
+                     max_part=max_part_arg, all_part=all_part_arg, vol_part=vol_part_arg, engine=engine_arg,
+                     renumber_links=not keep_link_order_arg, use_cache=not no_cache_arg,
+                     prefetch_depth=prefetch_arg, num_workers=workers_arg, checkpoint_every=checkpoint_every_arg,
+                     resume=resume_arg, prune=not no_prune_arg, seed=seed_arg, delta_t=delta_t_arg,
+                     substeps=substeps_arg, age_bin_width=age_bin_width_arg, age_bins=age_bins_arg,
+                     link_groups=groups_arg, groups_only=groups_only_arg)
 else:
     read_config_and_perform_traking(config_json_fpath_arg)
 print("So far, so done!")
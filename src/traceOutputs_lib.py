@@ -1,10 +1,18 @@
+from networkIndex_lib import NetworkIndex, NetworkIndexCache
+import concurrent.futures
 import numpy as np
+import threading
 import datetime
-import _thread
+import queue
 import h5py
 import math
 import os
 
+try:
+    import numba                  # optional: compiles the particle stepping kernel when available
+except ImportError:
+    numba = None
+
 
 # Static Class - holds all global constant values for the program
 class GblVars:
@@ -18,8 +26,10 @@ class GblVars:
     lambda_1 = 0.2
     lambda_2 = -0.1
     vel_ref = 0.33
-    delta_t = 600                 # assuming 10 minutes time interval (60 secs * 10 min)
+    delta_t = 600                 # seconds (trials) per step, set from the spacing of the h5 files by default
     domain_structure = {}         # expected to be a dictionary of [link_id]->HillslopeLinkPrm
+    network_index = None          # expected to be a NetworkIndex of the domain (built or loaded from cache)
+    random_streams = None         # RandomStreams of a seeded run, None to draw from numpy's global random state
 
     vol_particles = 0             # volume of water that represents a particle
 
@@ -72,12 +82,20 @@ class DomainSnapshot:
     hl_states = None
     outlet_link_id = None
     hl_cummulative_rained_parts = None
+    particles = None              # ParticleStore or ParticleBuckets with all particles, None if held in 'hl_states' lists
+    hydraulics = None             # DomainHydraulics with discharges and volumes of all links, None if not read yet
+    layer_counters = None         # LayerCounters kept up to date with the particles, None if they must be counted
 
     def count_particles(self):
         """
 
         :return:
         """
+        if self.layer_counters is not None:
+            return self.layer_counters.count_particles()
+        if self.particles is not None:
+            return self.particles.count_particles()
+
         counting = 0
         for cur_link_id in self.hl_states.keys():
             counting += self.hl_states[cur_link_id].count_particles()
@@ -90,6 +108,11 @@ class DomainSnapshot:
         :return: Integer of counting and Dictionary of [layer_source_flag]:[]
         """
 
+        if self.layer_counters is not None:
+            return self.layer_counters.count_particles_by_layer_source(aggregate_rain=aggregate_rain)
+        if self.particles is not None:
+            return self.particles.count_particles_by_layer_source(aggregate_rain=aggregate_rain)
+
         # create basic dictionary
         return_dict = {
             ParticleManager.LAYER_POND: 0,
@@ -134,22 +157,27 @@ class DomainSnapshot:
 
     def inherit_cummulated_rained_parts(self, previous_domain_snapshot):
         """
-        Copies the dictionary of accumulated rained particles from a given snapshot into the current object
+        Copies the array of accumulated rained particles from a given snapshot into the current object
+        :param previous_domain_snapshot:
+        :return:
+        """
+
+        self.hl_cummulative_rained_parts = previous_domain_snapshot.hl_cummulative_rained_parts.copy()
+
+    def inherit_layer_counters(self, previous_domain_snapshot):
+        """
+        Copies the particle counters from a given snapshot into the current object, to be updated as particles leave
         :param previous_domain_snapshot:
         :return:
         """
 
-        for cur_linkid, cur_parts_count in previous_domain_snapshot.hl_cummulative_rained_parts.items():
-            self.hl_cummulative_rained_parts[cur_linkid] = cur_parts_count
-            '''
-            if cur_linkid == 522792:
-                print("Inheriting {0} rain particles counting on link {1}.".format(cur_parts_count, cur_linkid))
-            '''
+        self.layer_counters = None if previous_domain_snapshot.layer_counters is None else \
+            previous_domain_snapshot.layer_counters.copy()
 
-    def add_particles_from_rainfall(self, cur_link_id, cur_acc_rain_wc):
+    def add_particles_from_rainfall(self, cur_link_idx, cur_acc_rain_wc):
         """
 
-        :param cur_link_id:
+        :param cur_link_idx: Index of the link in GblVars.network_index
         :param cur_acc_rain_wc:
         :return:
         """
@@ -159,11 +187,10 @@ class DomainSnapshot:
             return
 
         # estimate the number of particles to be added from rainfall
-        acc_vol_water = cur_acc_rain_wc * GblVars.domain_structure[cur_link_id].upstream_area * (10**6)  # km2 to m2
+        cur_link_id = int(GblVars.network_index.link_ids[cur_link_idx])
+        acc_vol_water = cur_acc_rain_wc * GblVars.network_index.upstream_area[cur_link_idx] * (10**6)  # km2 to m2
         expected_acc_rain_particles = int(np.floor(acc_vol_water / GblVars.vol_particles))
-        if cur_link_id not in self.hl_cummulative_rained_parts:
-            self.hl_cummulative_rained_parts[cur_link_id] = 0
-        generated_acc_rain_particles = self.hl_cummulative_rained_parts[cur_link_id]
+        generated_acc_rain_particles = int(self.hl_cummulative_rained_parts[cur_link_idx])
         particles_to_be_generated = expected_acc_rain_particles - generated_acc_rain_particles
 
         if cur_link_id == 522792:
@@ -172,55 +199,132 @@ class DomainSnapshot:
                                                                                  generated_acc_rain_particles))
 
         # create and add the particles
+        if (self.layer_counters is not None) and (particles_to_be_generated > 0):
+            self.layer_counters.add(cur_link_idx, self.timestamp, particles_to_be_generated)
+        if self.particles is not None:
+            self.particles.add_particles(cur_link_idx, ParticleStore.COMP_POND, cur_link_idx, self.timestamp,
+                                         count=particles_to_be_generated)
+            self.hl_cummulative_rained_parts[cur_link_idx] += max(particles_to_be_generated, 0)
+            return
         for count_generated in range(particles_to_be_generated):
             cur_new_part = Particle(cur_link_id, self.timestamp)
             self.hl_states[cur_link_id].parts_pond_frnt.append(cur_new_part)
-            self.hl_cummulative_rained_parts[cur_link_id] += 1
+            self.hl_cummulative_rained_parts[cur_link_idx] += 1
+
+    def add_particles_from_rainfall_columns(self, links_idx, acc_rain_wc):
+        """
+        Same as 'add_particles_from_rainfall', but for arrays of links at once
+        :param links_idx: Array of indices of the links in GblVars.network_index
+        :param acc_rain_wc: Array of accumulated rainfall water columns
+        :return:
+        """
+
+        # basic checl to avoid zero-division
+        if GblVars.vol_particles == 0:
+            return
+
+        # estimate the number of particles to be added from rainfall
+        acc_vol_water = acc_rain_wc * GblVars.network_index.upstream_area[links_idx] * (10**6)  # km2 to m2
+        expected_acc_rain_particles = np.floor(acc_vol_water / GblVars.vol_particles).astype(np.int64)
+        particles_to_be_generated = expected_acc_rain_particles - self.hl_cummulative_rained_parts[links_idx]
+
+        # create and add the particles
+        generating = particles_to_be_generated > 0
+        links_idx = links_idx[generating]
+        particles_to_be_generated = particles_to_be_generated[generating]
+        if self.layer_counters is not None:
+            self.layer_counters.add(links_idx, self.timestamp, particles_to_be_generated)
+        if self.particles is not None:
+            self.particles.add_buckets(links_idx, ParticleStore.COMP_POND, links_idx, self.timestamp,
+                                       particles_to_be_generated)
+            np.add.at(self.hl_cummulative_rained_parts, links_idx, particles_to_be_generated)
+            return
+        for cur_link_idx, cur_count in zip(links_idx.tolist(), particles_to_be_generated.tolist()):
+            cur_link_id = int(GblVars.network_index.link_ids[cur_link_idx])
+            for count_generated in range(cur_count):
+                cur_new_part = Particle(cur_link_id, self.timestamp)
+                self.hl_states[cur_link_id].parts_pond_frnt.append(cur_new_part)
+            self.hl_cummulative_rained_parts[cur_link_idx] += cur_count
+
+    def get_contributions(self, aggregate_rain=True, outlet_link_id=None):
+        """
+        Counts the particles in the channel of an outlet by source link and source layer
+        :param aggregate_rain:
+        :param outlet_link_id: Link whose contributing links are wanted. If None, 'outlet_link_id' attribute is used.
+        :return: An OutletContributions object, None if the outlet is not in the domain
+        """
+
+        outlet_link_id = self.outlet_link_id if outlet_link_id is None else outlet_link_id
+        return self.get_outlets_contributions([outlet_link_id], aggregate_rain=aggregate_rain)[outlet_link_id]
+
+    def get_outlets_contributions(self, outlet_link_ids, aggregate_rain=True):
+        """
+        Same as 'get_contributions' for several outlets. Particles held in a store are scanned only once.
+        :param outlet_link_ids: List of link ids
+        :param aggregate_rain:
+        :return: A dictionary of outlet link_id -> OutletContributions object (None if not in the domain)
+        """
+
+        if self.particles is not None:
+            all_contribs = self.particles.get_contributions_by_outlet(outlet_link_ids, aggregate_rain=aggregate_rain)
+        else:
+            all_contribs = {}
+
+        ret_dict = {}
+        for cur_outlet_id in outlet_link_ids:
+            if not self._check_outlet(cur_outlet_id):
+                ret_dict[cur_outlet_id] = None
+                continue
+            if self.particles is None:
+                cur_parts = self.hl_states[cur_outlet_id].parts_chnl_frnt
+                all_contribs[cur_outlet_id] = OutletContributions.count(
+                    cur_outlet_id, [p.get_linkid() for p in cur_parts], [p.get_layer_source() for p in cur_parts],
+                    aggregate_rain=aggregate_rain)
+            ret_dict[cur_outlet_id] = all_contribs.get(cur_outlet_id)
+            if ret_dict[cur_outlet_id] is None:
+                ret_dict[cur_outlet_id] = OutletContributions.count(cur_outlet_id, [], [],
+                                                                    aggregate_rain=aggregate_rain)
+            ret_dict[cur_outlet_id].discharge = None if self.hydraulics is None else \
+                self.hydraulics.disch_chnl[GblVars.network_index.get_index(cur_outlet_id)]
+        return ret_dict
 
-    def get_contributing_links(self, aggregate_rain=True):
+    def get_contributing_links(self, aggregate_rain=True, outlet_link_id=None):
         """
 
         :param aggregate_rain:
+        :param outlet_link_id: Link whose contributing links are wanted. If None, 'outlet_link_id' attribute is used.
         :return: A dictionary of link_id -> number of particles
         """
 
-        # basic test
-        if self.outlet_link_id is None:
-            print("Got None dict for contrib. links - No outled link id.")
-            return None
-        elif self.outlet_link_id not in self.hl_states.keys():
-            print("Got None dict for contrib. links - Missing outled link id.")
-            return None
+        outlet_link_id = self.outlet_link_id if outlet_link_id is None else outlet_link_id
+        return self.get_outlets_contributing_links([outlet_link_id], aggregate_rain=aggregate_rain)[outlet_link_id]
+
+    def get_outlets_contributing_links(self, outlet_link_ids, aggregate_rain=True):
+        """
+        Same as 'get_contributing_links' for several outlets, adapted from 'get_outlets_contributions'
+        :param outlet_link_ids: List of link ids
+        :param aggregate_rain:
+        :return: A dictionary of outlet link_id -> dictionary as given by 'get_contributing_links'
+        """
 
-        # gets the hillslope-link state of the outlet
-        cur_state = self.hl_states[self.outlet_link_id]
-        links_id = {}
-        links_id["discharge"] = cur_state.disch_chnl
-        links_id["outlet_link_id"] = self.outlet_link_id
+        all_contribs = self.get_outlets_contributions(outlet_link_ids, aggregate_rain=aggregate_rain)
+        return dict([(cur_outlet_id, None if cur_contribs is None else cur_contribs.to_dict(with_header=True))
+                     for cur_outlet_id, cur_contribs in all_contribs.items()])
 
-        #
-        for cur_particle in cur_state.parts_chnl_frnt:
-            cur_link_id = cur_particle.get_linkid()
-            if cur_link_id not in links_id:
-                links_id[cur_link_id] = {ParticleManager.LAYER_POND: 0,
-                                         ParticleManager.LAYER_TOPLAYER: 0,
-                                         ParticleManager.LAYER_SUBSURFACE: 0,
-                                         ParticleManager.LAYER_CHANNEL: 0}
-                if aggregate_rain:
-                    links_id[cur_link_id][ParticleManager.LAYER_RAIN] = 0
-
-            #
-            cur_p_source = cur_particle.get_layer_source()
-            if cur_p_source < 0:
-                links_id[cur_link_id][cur_p_source] += 1
-            elif aggregate_rain:
-                links_id[cur_link_id][ParticleManager.LAYER_RAIN] += 1
-            else:
-                if cur_p_source not in links_id[cur_link_id].keys():
-                    links_id[cur_link_id][cur_p_source] = 0
-                links_id[cur_link_id][cur_p_source] += 1
+    def _check_outlet(self, outlet_link_id):
+        """
 
-        return links_id
+        :param outlet_link_id:
+        :return: True if the outlet is in the domain, False otherwise
+        """
+
+        if outlet_link_id is None:
+            print("Got None dict for contrib. links - No outled link id.")
+            return False
+        elif outlet_link_id not in self.hl_states.keys():
+            print("Got None dict for contrib. links - Missing outled link id.")
+            return False
+        return True
 
     def set_timestamp(self, the_timestamp):
         """
@@ -230,11 +334,14 @@ class DomainSnapshot:
         """
         self.timestamp = the_timestamp
 
-    def __init__(self, hillslopelink_ids=None, the_timestamp=None):
+    def __init__(self, hillslopelink_ids=None, the_timestamp=None, particles=None):
         # start it
         self.hl_states = {}
         self.timestamp = the_timestamp
-        self.hl_cummulative_rained_parts = {}
+        self.hl_cummulative_rained_parts = np.zeros(0 if GblVars.network_index is None else
+                                                    GblVars.network_index.num_links, dtype=np.int64)
+        self.particles = particles
+        self.hydraulics = None
 
         # initializes each
         if hillslopelink_ids is not None:
@@ -248,15 +355,6 @@ class HillslopeLinkState:
     parts_pond_frnt = None        # list of Particle objects in the back part of the channel
     parts_topl_frnt = None        # list of Particle objects in the back part of the channel
     parts_subs_frnt = None        # list of Particle objects in the back part of the channel
-    disch_chnl = None             # discharge channel                 (m3/s)
-    disch_pdch = None             # discharge ponds -> channel        (m3/s)
-    disch_pdtl = None             # discharge ponds -> top layer      (m3/s)
-    disch_tlss = None             # discharge top layer -> subsurface (m3/s)
-    disch_ssch = None             # discharge subsurface -> channel   (m3/s)
-    volum_chnl = None             # volume of water in channel
-    volum_pond = None             # volume of water in ponds
-    volum_tplr = None             # volume of water in top layer
-    volum_subs = None             # volume of water in subsurface
 
     def count_particles(self, in_channel=True, in_ponds=True, in_toplayer=True, in_subsurface=True):
         """
@@ -300,71 +398,110 @@ class HillslopeLinkState:
 
         return None
 
-    def set_dischs_and_volume(self, link_id, disch_chnl, wc_pond, wc_topl, wc_subs):
+    def __init__(self):
+        self.parts_chnl_frnt = []
+        self.parts_pond_frnt = []
+        self.parts_topl_frnt = []
+        self.parts_subs_frnt = []
+
+
+# Dynamic Class - Discharges and volumes of all hillslope-links of the domain in a moment of time, as columns
+class DomainHydraulics:
+    k2 = None                     # per-link factor of the ponds -> channel rate (1/min), constant for a domain
+    tau = None                    # per-link factor of the channel volume, constant for a domain
+    hillslope_area = None         # per-link hillslope area (m2 when multiplied by a water column in meters)
+    disch_chnl = None             # discharge channel                 (m3/s)
+    disch_pdch = None             # discharge ponds -> channel        (m3/s)
+    disch_pdtl = None             # discharge ponds -> top layer      (m3/s)
+    disch_tlss = None             # discharge top layer -> subsurface (m3/s)
+    disch_ssch = None             # discharge subsurface -> channel   (m3/s)
+    volum_chnl = None             # volume of water in channel
+    volum_pond = None             # volume of water in ponds
+    volum_tplr = None             # volume of water in top layer
+    volum_subs = None             # volume of water in subsurface
+
+    _coefficients = None          # tuple (network index, k2, tau) of the last domain whose coefficients were computed
+
+    @staticmethod
+    def get_coefficients(network_index):
+        """
+        Computes the static per-link factors of the hydraulic equations, reusing them while the domain is the same
+        :param network_index: NetworkIndex object
+        :return: Tuple of arrays (k2, tau)
         """
 
-        :param link_id:
-        :param disch_chnl:
-        :param wc_pond: Water Column stored in ponds (in meters)
-        :param wc_topl: Water Column stored in top layer (in meters)
-        :param wc_subs: Water Column stored in sub surface (in meters)
+        if (DomainHydraulics._coefficients is None) or (DomainHydraulics._coefficients[0] is not network_index):
+            k2 = GblVars.vh * (network_index.link_length / network_index.hillslope_area) * 60 * 0.001
+            tau = ((1 - GblVars.lambda_1) * network_index.link_length * 1000) / \
+                (GblVars.vel_ref * (network_index.upstream_area ** GblVars.lambda_2))
+            DomainHydraulics._coefficients = (network_index, k2, tau)
+        return DomainHydraulics._coefficients[1], DomainHydraulics._coefficients[2]
+
+    def set_dischs_and_volumes(self, links_idx, disch_chnl, wc_pond, wc_topl, wc_subs):
+        """
+        Sets discharges and volumes of the given links. The ones of the other links are kept.
+        :param links_idx: Array of indices of the links in GblVars.network_index
+        :param disch_chnl: Array of channel discharges
+        :param wc_pond: Array of water columns stored in ponds (in meters)
+        :param wc_topl: Array of water columns stored in top layer (in meters)
+        :param wc_subs: Array of water columns stored in sub surface (in meters)
         :return:
         """
 
-        k2 = GblVars.vh * (GblVars.domain_structure[link_id].link_length/GblVars.domain_structure[link_id].hillslope_area) * 60 * 0.001
-        kt = k2*(GblVars.a + (GblVars.b * ((1 - (wc_pond / GblVars.sl))**GblVars.alpha)))
+        k2 = self.k2[links_idx]
+        kt = k2 * (GblVars.a + (GblVars.b * ((1 - (wc_pond / GblVars.sl)) ** GblVars.alpha)))
+        links_hl_area = self.hillslope_area[links_idx]
 
         # solve channel
-        # print("Set channel discharge ({0}).".format(disch_chnl))
-        self.disch_chnl = disch_chnl
-        self.volum_chnl = self.__calculate_channel_volume(link_id)
+        self.disch_chnl[links_idx] = disch_chnl
+        self.volum_chnl[links_idx] = self.tau[links_idx] * ((self.disch_chnl[links_idx] ** (1 - GblVars.lambda_1)) /
+                                                            (1 - GblVars.lambda_1))
 
         # solve pond
-        self.volum_pond = HillslopeLinkState.__calculate_volume_from_water_column(link_id, wc_pond)
-        self.disch_pdch = k2 * self.volum_pond
-        self.disch_pdtl = kt * self.volum_pond
+        self.volum_pond[links_idx] = links_hl_area * wc_pond
+        self.disch_pdch[links_idx] = k2 * self.volum_pond[links_idx]
+        self.disch_pdtl[links_idx] = kt * self.volum_pond[links_idx]
 
         # solve top layer
-        self.volum_tplr = HillslopeLinkState.__calculate_volume_from_water_column(link_id, wc_topl)
-        self.disch_tlss = GblVars.ki * self.volum_tplr
+        self.volum_tplr[links_idx] = links_hl_area * wc_topl
+        self.disch_tlss[links_idx] = GblVars.ki * self.volum_tplr[links_idx]
 
         # solve sub-surface
-        self.volum_subs = HillslopeLinkState.__calculate_volume_from_water_column(link_id, wc_subs)
-        self.disch_ssch = GblVars.k3 * self.volum_subs
+        self.volum_subs[links_idx] = links_hl_area * wc_subs
+        self.disch_ssch[links_idx] = GblVars.k3 * self.volum_subs[links_idx]
 
-    def __calculate_channel_volume(self, link_id):
+    def get_leave_probabilities(self):
         """
-
-        :param link_id:
-        :return:
+        Probabilities of a particle leaving each compartment in a single trial, for all links
+        :return: Tuple of arrays (channel->downstream, subsurface->channel, top layer->subsurface, ponds->channel,
+                 ponds->channel or top layer). Undefined ones (zero storage and discharge) are NaN.
         """
-        chan_len = GblVars.domain_structure[link_id].get_link_length()
-        chan_aup = GblVars.domain_structure[link_id].get_upstream_area()
-        chan_ahl = GblVars.domain_structure[link_id].get_hillslope_area()
-        chan_dsc = self.disch_chnl
-
-        # print("Link length: {0}".format(chan_len))
 
-        tau = ((1 - GblVars.lambda_1) * chan_len * 1000)/(GblVars.vel_ref * (chan_aup**GblVars.lambda_2))
-        vol_disch = tau * ((chan_dsc**(1 - GblVars.lambda_1))/(1 - GblVars.lambda_1))
-
-        return vol_disch
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prob_leave_cc = self.disch_chnl / self.volum_chnl
+            prob_leave_sc = self.volum_subs / self.disch_ssch
+            prob_leave_ts = self.volum_tplr / self.disch_tlss
+            prob_leave_pc = self.volum_pond / self.disch_pdch
+            prob_leave_pt = self.volum_pond / self.disch_pdtl
+            prob_leave_pt += prob_leave_pc
+        return prob_leave_cc, prob_leave_sc, prob_leave_ts, prob_leave_pc, prob_leave_pt
 
-    @staticmethod
-    def __calculate_volume_from_water_column(link_id, water_column):
+    def __init__(self, network_index):
         """
 
-        :param link_id:
-        :param water_column:
-        :return:
+        :param network_index: NetworkIndex object of the domain
         """
-        return GblVars.domain_structure[link_id].get_hillslope_area() * water_column
-
-    def __init__(self):
-        self.parts_chnl_frnt = []
-        self.parts_pond_frnt = []
-        self.parts_topl_frnt = []
-        self.parts_subs_frnt = []
+        self.k2, self.tau = DomainHydraulics.get_coefficients(network_index)
+        self.hillslope_area = network_index.hillslope_area
+        self.disch_chnl = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.disch_pdch = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.disch_pdtl = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.disch_tlss = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.disch_ssch = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.volum_chnl = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.volum_pond = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.volum_tplr = np.full(network_index.num_links, np.nan, dtype=np.float64)
+        self.volum_subs = np.full(network_index.num_links, np.nan, dtype=np.float64)
 
 
 # Dynamic Class -
@@ -394,11 +531,13 @@ class ParticleManager:
     LAYER_CHANNEL = -4
 
     _count_particles = 0
+    _count_lock = threading.Lock()
 
     @staticmethod
     def give_me_the_particle_id():
-        ParticleManager._count_particles += 1
-        return ParticleManager._count_particles
+        with ParticleManager._count_lock:
+            ParticleManager._count_particles += 1
+            return ParticleManager._count_particles
 
     @staticmethod
     def particles_created():
@@ -408,218 +547,1167 @@ class ParticleManager:
         return
 
 
-# Static Class - Library of functions (its methods) for performing the tracking steps
-class OutputTracer:
+# Dynamic Class - Number of particles in the domain by source link and source layer, updated as particles come and go
+class LayerCounters:
+    LAYERS = (ParticleManager.LAYER_POND, ParticleManager.LAYER_TOPLAYER, ParticleManager.LAYER_SUBSURFACE,
+              ParticleManager.LAYER_CHANNEL, ParticleManager.LAYER_RAIN)    # column of each layer in 'counts'
+
+    counts = None                 # array (links x LAYERS) of particles by source link index and source layer (int64)
+    _total = None                 # number of particles, the sum of 'counts'
 
     @staticmethod
-    def distribute_particles_proportional(first_h5_file, max_particles, outlet_link_id):
+    def get_columns(src_layer):
         """
-        Creates a snapshot with initial particles distributed proportionally to the outlet channel discharge
-        :param topo:
-        :param first_h5_file:
-        :param max_particles:
-        :param outlet_link_id:
-        :return: Initial particles dictionary
+
+        :param src_layer: Integer or array of ParticleManager.LAYER_... values or insertion timestamps
+        :return: Column of each source layer in 'counts' (all insertion timestamps fall in the LAYER_RAIN one)
         """
+        src_layer = np.asarray(src_layer, dtype=np.int64)
+        return np.where(src_layer < 0, -src_layer - 1, len(LayerCounters.LAYERS) - 1)
 
-        link_discharge = None
-        ret_dict = {}
+    def add(self, src_link_idx, src_layer, counts=1):
+        """
 
-        print("...at '{0}'.".format(datetime.datetime.now()))
+        :param src_link_idx: Integer or array of source link indexes
+        :param src_layer: Integer or array of ParticleManager.LAYER_... values or insertion timestamps
+        :param counts: Integer or array with the number of particles of each entry
+        :return:
+        """
+        src_link_idx, columns, counts = np.broadcast_arrays(np.asarray(src_link_idx, dtype=np.int64),
+                                                            LayerCounters.get_columns(src_layer),
+                                                            np.asarray(counts, dtype=np.int64))
+        np.add.at(self.counts, (src_link_idx, columns), counts)
+        self._total += int(counts.sum())
 
-        # reading file
-        print("Reading file '{0}'.".format(first_h5_file))
-        disch_dict = H5FileReader.read_h5_file(first_h5_file)
+    def remove(self, src_link_idx, src_layer, counts=1):
+        """
+        Same as 'add', for particles leaving the domain
+        :return:
+        """
+        self.add(src_link_idx, src_layer, -np.asarray(counts, dtype=np.int64))
 
-        print("...at '{0}'.".format(datetime.datetime.now()))
+    def count_particles(self):
+        """
 
-        # find proportion particles/storage
-        if max_particles is None:
-            min_dich = math.inf
-            min_linkid = None
-            for cur_linkid in disch_dict.keys():
-                if disch_dict[cur_linkid] < min_dich:
-                    min_linkid, min_dich = cur_linkid, disch_dict[cur_linkid]
-            vol_disch2 = OutputTracer.calculate_volume_in_link(topo, disch_dict, min_linkid)
-            particle_ratio = 1 / vol_disch2
-        else:
-            min_dich = disch_dict[outlet_link_id]
-            vol_disch2 = OutputTracer.calculate_volume_in_link(topo, min_dich, outlet_link_id)
-            particle_ratio = max_particles / vol_disch2
-        print("Ref. disch.: {0}, ref. volum.:{1}.".format(min_dich, vol_disch2))
-        print("Part. ratio: {0}".format(particle_ratio))
+        :return: Number of particles, in constant time
+        """
+        return self._total
 
-        print("...at '{0}'.".format(datetime.datetime.now()))
+    def count_particles_by_layer_source(self, aggregate_rain=True):
+        """
+        Same as ParticleStore.count_particles_by_layer_source, reducing the counters of all links
+        :param aggregate_rain: If True, all rain-generated particles are aggregated into a single source numbered '1'
+        :return: Integer of counting and Dictionary of [layer_source_flag]:[]
+        """
 
-        # distribute particles through network
-        for cur_link_id in disch_dict.keys():
-            cur_vol = OutputTracer.calculate_volume_in_link(topo, disch_dict, cur_link_id)
-            cur_parts = int(particle_ratio * cur_vol)
-            ret_dict[cur_link_id] = []
-            for count_p in range(0, cur_parts):
-                ret_dict[cur_link_id].append(Particle(cur_link_id))
+        layers_counts = self.counts.sum(axis=0).tolist()
+        return_dict = dict(zip(LayerCounters.LAYERS, layers_counts))
+        if not aggregate_rain:
+            del return_dict[ParticleManager.LAYER_RAIN]
+        return sum(return_dict.values()), return_dict
 
-        print("...at '{0}'.".format(datetime.datetime.now()))
+    def copy(self):
+        """
 
-        # debug
-        for count_i in range(0, 5):
-            cur_link_id = list(disch_dict.keys())[count_i]
-            print("Link {0}: {1} ({2} m3/s).".format(cur_link_id, len(ret_dict[cur_link_id]), disch_dict[cur_link_id]))
-        print("Link {0}: {1} ({2} m3/s).".format(outlet_link_id, len(ret_dict[outlet_link_id]),
-                                                 disch_dict[outlet_link_id]))
+        :return: A new LayerCounters object with the same counts
+        """
+        ret_obj = LayerCounters(len(self.counts))
+        ret_obj.counts[:] = self.counts
+        ret_obj._total = self._total
+        return ret_obj
 
-        print("Created {0} particles.".format(ParticleManager.particles_created()))
-        print("...at '{0}'.".format(datetime.datetime.now()))
+    def __init__(self, num_links):
+        """
 
-        return ret_dict
+        :param num_links: Number of links of the domain
+        """
+        self.counts = np.zeros((num_links, len(LayerCounters.LAYERS)), dtype=np.int64)
+        self._total = 0
+
+
+# Dynamic Class - particles in the channel of an outlet counted by source link and source layer, as rows of arrays
+class OutletContributions:
+    outlet_link_id = None         # link id of the outlet
+    discharge = None              # discharge of the outlet, None if unknown
+    src_link_ids = None           # column of source link ids, rows of a same link are contiguous (int64)
+    src_layers = None             # column of ParticleManager.LAYER_... values or insertion timestamps (int64)
+    counts = None                 # column with the number of particles of each row (int64)
 
     @staticmethod
-    def distribute_particles_equally(timestamp=None, parts_in_pounds=0, parts_in_toplayer=0, parts_in_subsurface=0,
-                                     parts_in_channel=0):
+    def count(outlet_link_id, src_link_ids, src_layers, counts=None, aggregate_rain=True):
         """
-        Creates a snapshot with initial particles distributed proportionally to the outlet channel discharge
-        :param timestamp:
-        :param parts_in_pounds:
-        :param parts_in_toplayer:
-        :param parts_in_subsurface:
-        :param parts_in_channel:
-        :return: A new DomainSnapshot object filled with new Particle objects
+        Histograms the particles of an outlet. As in the dictionaries of 'to_dict', each source link gets a row for
+        every domain layer (and for LAYER_RAIN if aggregating rain) even if it holds no particle.
+        :param outlet_link_id:
+        :param src_link_ids: Array of source link ids of the particles (or buckets) in the channel of the outlet
+        :param src_layers: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :param counts: Array with the number of particles of each entry. If None, one each.
+        :param aggregate_rain: If True, all rain-generated particles are aggregated into LAYER_RAIN
+        :return: A new OutletContributions object
         """
 
-        ret_obj = DomainSnapshot(the_timestamp=timestamp)
+        src_layers = np.asarray(src_layers, dtype=np.int64)
+        uniq_link_ids, links_pos = np.unique(np.asarray(src_link_ids, dtype=np.int64), return_inverse=True)
+        counts = None if counts is None else np.asarray(counts, dtype=np.int64)
+
+        # domain layers (and aggregated rain) in a dense histogram of source link x layer
+        fixed_layers = np.array(LayerCounters.LAYERS if aggregate_rain else LayerCounters.LAYERS[:-1], dtype=np.int64)
+        fixed = np.ones(len(src_layers), dtype=bool) if aggregate_rain else (src_layers < 0)
+        fixed_bins = links_pos[fixed] * len(fixed_layers) + LayerCounters.get_columns(src_layers[fixed])
+        fixed_counts = np.bincount(fixed_bins, weights=None if counts is None else counts[fixed],
+                                   minlength=len(uniq_link_ids) * len(fixed_layers)).astype(np.int64)
+        rows_pos = np.repeat(np.arange(len(uniq_link_ids)), len(fixed_layers))
+        rows_layer = np.tile(fixed_layers, len(uniq_link_ids))
+        rows_count = fixed_counts
+
+        # insertion timestamps kept apart: one row for each (source link, timestamp) found
+        if not aggregate_rain:
+            rain_pos, rain_layer = links_pos[~fixed], src_layers[~fixed]
+            rain_count = np.ones(len(rain_pos), dtype=np.int64) if counts is None else counts[~fixed]
+            order = np.lexsort((rain_layer, rain_pos))
+            rain_pos, rain_layer, rain_count = rain_pos[order], rain_layer[order], rain_count[order]
+            new_key = np.ones(len(rain_pos), dtype=bool)
+            new_key[1:] = (np.diff(rain_pos) != 0) | (np.diff(rain_layer) != 0)
+            key_starts = np.flatnonzero(new_key)
+            rain_count = np.add.reduceat(rain_count, key_starts) if len(key_starts) > 0 else rain_count
+            order = np.argsort(np.concatenate((rows_pos, rain_pos[key_starts])), kind="stable")
+            rows_pos = np.concatenate((rows_pos, rain_pos[key_starts]))[order]
+            rows_layer = np.concatenate((rows_layer, rain_layer[key_starts]))[order]
+            rows_count = np.concatenate((rows_count, rain_count))[order]
+
+        return OutletContributions(outlet_link_id, uniq_link_ids[rows_pos], rows_layer, rows_count)
 
-        # print("...at '{0}'.".format(datetime.datetime.now()))
+    def count_particles(self):
+        """
 
-        # distribute particles through network
-        for cur_link_id in GblVars.domain_structure.keys():
+        :return: Number of particles in the channel of the outlet
+        """
+        return int(self.counts.sum())
 
-            cur_state_obj = HillslopeLinkState()
-            for i in range(0, parts_in_pounds):
-                cur_state_obj.parts_pond_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_POND))
-            for i in range(0, parts_in_toplayer):
-                cur_state_obj.parts_topl_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_TOPLAYER))
-            for i in range(0, parts_in_subsurface):
-                cur_state_obj.parts_subs_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_SUBSURFACE))
-            for i in range(0, parts_in_channel):
-                cur_state_obj.parts_chnl_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_CHANNEL))
-            ret_obj.hl_states[cur_link_id] = cur_state_obj
+    def aggregate(self):
+        """
 
+        :return: A new OutletContributions object with all rain-generated rows aggregated into LAYER_RAIN, the same
+                 as if counted with 'aggregate_rain' set
+        """
+        ret_obj = OutletContributions.count(self.outlet_link_id, self.src_link_ids, self.src_layers,
+                                            counts=self.counts, aggregate_rain=True)
+        ret_obj.discharge = self.discharge
         return ret_obj
 
-    @staticmethod
-    def calculate_volume_in_link(topo, disch_dict, link_id):
+    def to_dict(self, with_header=False):
+        """
+        Adapter for consumers of the nested dictionaries
+        :param with_header: If True, "discharge" and "outlet_link_id" keys are included
+        :return: A dictionary of source link_id -> dictionary of layer source -> number of particles
         """
 
-        :param topo:
-        :param disch_dict:
-        :param link_id:
-        :return:
+        links_id = {"discharge": self.discharge, "outlet_link_id": self.outlet_link_id} if with_header else {}
+        for cur_link_id, cur_layer, cur_count in zip(self.src_link_ids.tolist(), self.src_layers.tolist(),
+                                                     self.counts.tolist()):
+            if cur_link_id not in links_id:
+                links_id[cur_link_id] = {}
+            links_id[cur_link_id][cur_layer] = cur_count
+        return links_id
+
+    def __init__(self, outlet_link_id, src_link_ids, src_layers, counts, discharge=None):
         """
 
-        # print("{0} of {1} ?".format(link_id, topo[link_id]))
-        chan_len = topo[link_id].get_link_length()
-        chan_aup = topo[link_id].get_upstream_area()
-        chan_ahl = topo[link_id].get_hillslope_area()
-        chan_dsc = disch_dict[link_id]
+        :param outlet_link_id:
+        :param src_link_ids: Array of source link ids, one per row
+        :param src_layers: Array of source layers, one per row
+        :param counts: Array of number of particles, one per row
+        :param discharge:
+        """
+        self.outlet_link_id = outlet_link_id
+        self.src_link_ids = np.asarray(src_link_ids, dtype=np.int64)
+        self.src_layers = np.asarray(src_layers, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.discharge = discharge
 
-        # print("Link length: {0}".format(chan_len))
 
-        tau = ((1 - GblVars.lambda_1) * chan_len * 1000)/(GblVars.vel_ref * (chan_aup**GblVars.lambda_2))
-        vol_disch = tau * ((chan_dsc**(1 - GblVars.lambda_1))/(1 - GblVars.lambda_1))
+# Dynamic Class - Histogram of the age of the particles in the channel of an outlet at one time step, by source layer
+class OutletAges:
+    outlet_link_id = None         # link id of the outlet
+    bin_width = None              # width of the age bins, in seconds
+    counts = None                 # array (LayerCounters.LAYERS x bins) of number of particles (int64)
 
-        return vol_disch
+    @staticmethod
+    def count(contribs, timestamp, ini_timestamp, bin_width, num_bins):
+        """
+        Histograms the age of the particles of an outlet from its contribution rows, so that the cost does not depend
+        on the number of particles. Rain-generated particles are aged since their insertion timestamp. Particles
+        present since the beginning have no known birth, so they are aged since 'ini_timestamp'.
+        :param contribs: OutletContributions object with rain timestamps kept apart (not aggregated)
+        :param timestamp: Timestamp of the step
+        :param ini_timestamp: Timestamp of the initial condition of the run
+        :param bin_width: Seconds per bin
+        :param num_bins: Number of bins, the last one also holding all older particles
+        :return: A new OutletAges object
+        """
 
-    def __init__(self):
-        return
+        ages = np.where(contribs.src_layers < 0, timestamp - ini_timestamp, timestamp - contribs.src_layers)
+        age_bins = np.clip(ages // bin_width, 0, num_bins - 1)
+        flat_idx = LayerCounters.get_columns(contribs.src_layers) * num_bins + age_bins
+        counts = np.bincount(flat_idx, weights=contribs.counts, minlength=len(LayerCounters.LAYERS) * num_bins)
+        return OutletAges(contribs.outlet_link_id, bin_width,
+                          counts.astype(np.int64).reshape(len(LayerCounters.LAYERS), num_bins))
 
+    def get_bin_edges(self):
+        """
 
-# Static Class - Library of functions (its methods) for reading Asynch files (.rvr, .prm, ...)
-class AsynchFilesReader:
+        :return: Array with the lower age of each bin, in seconds
+        """
+        return np.arange(self.counts.shape[1], dtype=np.int64) * self.bin_width
 
-    @staticmethod
-    def build_topology(rvr_fpath):
+    def to_dict(self):
+        """
+        Adapter for the pickled contributions
+        :return: Dictionary with "bin_width" and "counts", a dictionary of layer source -> list of counts by bin
         """
+        return {"bin_width": self.bin_width,
+                "counts": dict(zip(LayerCounters.LAYERS, self.counts.tolist()))}
 
-        :param rvr_fpath:
-        :return: Dictionary of HillslopeLinkPrm objects with link ids as keys.
+    def __init__(self, outlet_link_id, bin_width, counts):
         """
 
-        # basic check
-        if not os.path.exists(rvr_fpath):
-            print("File not found: '{0}'.".format(rvr_fpath))
-            return None
+        :param outlet_link_id:
+        :param bin_width: Seconds per bin
+        :param counts: Array (LayerCounters.LAYERS x bins) of number of particles
+        """
+        self.outlet_link_id = outlet_link_id
+        self.bin_width = int(bin_width)
+        self.counts = np.asarray(counts, dtype=np.int64)
 
-        # start variables
-        counter = 0
-        all_hillslopelinks = {}
-        last_linkid = None
-
-        # read it line by line
-        with open(rvr_fpath, "r+") as rfile:
-            num_links = None
-            percent_dot = 0
-            print("Building topology:")
-            for cur_line in rfile:
-
-                cur_line_clear = cur_line.strip()
-
-                # ignore blank lines
-                if cur_line_clear == "":
-                    continue
-
-                # get header
-                if num_links is None:
-                    num_links = int(cur_line_clear)
-                    continue
-
-                cur_line_split = cur_line_clear.split(" ")
-
-                # get link id
-                if (len(cur_line_split) == 1) and (last_linkid is None):
-                    last_linkid = int(cur_line_split[0])
-                    continue
-
-                elif (len(cur_line_split) == 1) and (last_linkid is not None):
-                    if last_linkid not in all_hillslopelinks.keys():
-                        all_hillslopelinks[last_linkid] = HillslopeLinkPrm(last_linkid)
-                    last_linkid = None
-                    counter += 1
-
-                elif (len(cur_line_split) > 1) and (last_linkid is not None):
-                    # create obj if necessary
-                    if last_linkid not in all_hillslopelinks.keys():
-                        cur_hl = HillslopeLinkPrm(last_linkid)
-                        all_hillslopelinks[last_linkid] = cur_hl
-                    else:
-                        cur_hl = all_hillslopelinks[last_linkid]
-                    # parse line and set values to obj
-                    for cur_up_hl_id in [int(s) for s in cur_line_split[1:]]:
-                        cur_hl.add_upstream_hl_id(cur_up_hl_id)
-                        # create parent if necessary
-                        if cur_up_hl_id not in all_hillslopelinks.keys():
-                            all_hillslopelinks[cur_up_hl_id] = HillslopeLinkPrm(cur_up_hl_id)
-                        # set parents ref downstream
-                        all_hillslopelinks[cur_up_hl_id].set_downstream_hl_id(last_linkid)
-                    last_linkid = None
-                    counter += 1
-
-                # debug message
-                cur_percent = counter / num_links
-                if cur_percent > percent_dot:
-                    print("  {0}%".format(int(percent_dot * 100)))
-                    percent_dot += 0.1
 
-        print("Created topology with {0} links.".format(len(all_hillslopelinks.keys())))
-        return all_hillslopelinks
+# Dynamic Class - struct-of-arrays storage of all particles of a domain (replaces per-object Particle instances)
+class ParticleStore:
+    COMP_CHANNEL = 0
+    COMP_POND = 1
+    COMP_TOPLAYER = 2
+    COMP_SUBSURFACE = 3
 
-    @staticmethod
-    def fill_parameters(topology, prm_fpath):
-        """
+    BYTES_PER_PARTICLE = 17       # int32 link + int8 compartment + int32 source link + int64 source layer
 
-        :param topology:
-        :param prm_fpath:
-        :return: Boolean. True if it was possible to perform the changes in 'prm_fpath' var, False otherwise
-        """
+    network_index = None          # NetworkIndex of the domain
+    link_ids = None               # array of link ids - the position of each id is its link index
+    _link = None                  # column of current link indexes (int32)
+    _comp = None                  # column of current compartments, one of COMP_... (int8)
+    _src_link = None              # column of source link indexes (int32)
+    _src_layer = None             # column of ParticleManager.LAYER_... values or insertion timestamps (int64)
+    _size = None                  # number of particles stored (the columns may have a larger capacity)
+
+    @property
+    def link(self):
+        return self._link[:self._size]
+
+    @property
+    def comp(self):
+        return self._comp[:self._size]
+
+    @property
+    def src_link(self):
+        return self._src_link[:self._size]
+
+    @property
+    def src_layer(self):
+        return self._src_layer[:self._size]
+
+    def get_link_index(self, link_id):
+        """
+
+        :param link_id:
+        :return: Integer with the index of the link, None if link is not in the domain
+        """
+        return self.network_index.get_index(link_id)
+
+    def add_particles(self, link_idx, comp, src_link_idx, src_layer, count=1):
+        """
+        Appends particles at the end of the store. Scalar arguments are repeated 'count' times, array arguments must
+        have 'count' elements.
+        :param link_idx: Integer or array of link indexes
+        :param comp: Integer or array of ParticleStore.COMP_... values
+        :param src_link_idx: Integer or array of source link indexes
+        :param src_layer: Integer or array of ParticleManager.LAYER_... values or insertion timestamps
+        :param count: Number of particles to be added
+        :return:
+        """
+
+        if count <= 0:
+            return
+
+        self._reserve(self._size + count)
+        new_size = self._size + count
+        self._link[self._size:new_size] = link_idx
+        self._comp[self._size:new_size] = comp
+        self._src_link[self._size:new_size] = src_link_idx
+        self._src_layer[self._size:new_size] = src_layer
+        self._size = new_size
+
+    def add_buckets(self, link_idx, comp, src_link_idx, src_layer, counts):
+        """
+        Appends 'counts[i]' particles with the i-th given attributes
+        :param link_idx: Array of link indexes
+        :param comp: Array of ParticleStore.COMP_... values
+        :param src_link_idx: Array of source link indexes
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :param counts: Array with the number of particles of each entry
+        :return:
+        """
+
+        counts = np.asarray(counts, dtype=np.int64)
+        self.add_particles(np.repeat(np.broadcast_to(link_idx, counts.shape), counts),
+                           np.repeat(np.broadcast_to(comp, counts.shape), counts),
+                           np.repeat(np.broadcast_to(src_link_idx, counts.shape), counts),
+                           np.repeat(np.broadcast_to(src_layer, counts.shape), counts), count=int(counts.sum()))
+
+    def set_columns(self, link_idx, comp, src_link_idx, src_layer):
+        """
+        Replaces the whole content of the store by the given columns
+        :param link_idx: Array of link indexes
+        :param comp: Array of ParticleStore.COMP_... values
+        :param src_link_idx: Array of source link indexes
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :return:
+        """
+
+        self._link = np.ascontiguousarray(link_idx, dtype=np.int32)
+        self._comp = np.ascontiguousarray(comp, dtype=np.int8)
+        self._src_link = np.ascontiguousarray(src_link_idx, dtype=np.int32)
+        self._src_layer = np.ascontiguousarray(src_layer, dtype=np.int64)
+        self._size = len(self._link)
+
+    def derive(self, link_idx, comp, src_link_idx, src_layer):
+        """
+        Creates a new store over the same domain links filled with the given columns
+        :param link_idx:
+        :param comp:
+        :param src_link_idx:
+        :param src_layer:
+        :return: A new ParticleStore object
+        """
+        ret_obj = ParticleStore(self.network_index)
+        ret_obj.set_columns(link_idx, comp, src_link_idx, src_layer)
+        return ret_obj
+
+    def count_particles(self):
+        """
+
+        :return:
+        """
+        return self._size
+
+    def count_particles_by_layer_source(self, aggregate_rain=True):
+        """
+
+        :param aggregate_rain: If True, all rain-generated particles are aggregated into a single source numbered '1'
+        :return: Integer of counting and Dictionary of [layer_source_flag]:[]
+        """
+
+        src_layer = self.src_layer
+        return_dict = {}
+        for cur_layer in (ParticleManager.LAYER_POND, ParticleManager.LAYER_TOPLAYER,
+                          ParticleManager.LAYER_SUBSURFACE, ParticleManager.LAYER_CHANNEL):
+            return_dict[cur_layer] = int(np.count_nonzero(src_layer == cur_layer))
+        if aggregate_rain:
+            return_dict[ParticleManager.LAYER_RAIN] = int(np.count_nonzero(src_layer > 0))
+
+        return sum(return_dict.values()), return_dict
+
+    def get_contributions(self, outlet_link_id, aggregate_rain=True):
+        """
+        Counts the particles in the channel of the outlet link by source link and source layer
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return: An OutletContributions object
+        """
+
+        outlet_idx = self.get_link_index(outlet_link_id)
+        if outlet_idx is None:
+            return OutletContributions.count(outlet_link_id, [], [], aggregate_rain=aggregate_rain)
+
+        at_outlet = (self.link == outlet_idx) & (self.comp == ParticleStore.COMP_CHANNEL)
+        return OutletContributions.count(outlet_link_id, self.link_ids[self.src_link[at_outlet]],
+                                         self.src_layer[at_outlet], aggregate_rain=aggregate_rain)
+
+    def get_contributions_by_outlet(self, outlet_link_ids, aggregate_rain=True):
+        """
+        Same as 'get_contributions' for several outlets, selecting the particles of all of them in a single pass
+        :param outlet_link_ids: List of link ids
+        :param aggregate_rain:
+        :return: A dictionary of outlet link_id -> OutletContributions object
+        """
+
+        at_outlets = (self.comp == ParticleStore.COMP_CHANNEL) & \
+            self.network_index.get_mask(outlet_link_ids)[self.link]
+        outlets_parts = self.derive(self.link[at_outlets], self.comp[at_outlets], self.src_link[at_outlets],
+                                    self.src_layer[at_outlets])
+        return dict([(cur_outlet_id, outlets_parts.get_contributions(cur_outlet_id, aggregate_rain=aggregate_rain))
+                     for cur_outlet_id in outlet_link_ids])
+
+    def get_contributing_links(self, outlet_link_id, aggregate_rain=True):
+        """
+        Same as 'get_contributions', as nested dictionaries
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return: A dictionary of source link_id -> dictionary of layer source -> number of particles
+        """
+        return self.get_contributions(outlet_link_id, aggregate_rain=aggregate_rain).to_dict()
+
+    def _reserve(self, capacity):
+        """
+        Grows the columns geometrically so that appending is amortized O(1)
+        :param capacity:
+        :return:
+        """
+
+        if capacity <= len(self._link):
+            return
+        new_capacity = max(capacity, 2 * len(self._link), 1024)
+        for cur_attr in ("_link", "_comp", "_src_link", "_src_layer"):
+            cur_column = getattr(self, cur_attr)
+            new_column = np.empty(new_capacity, dtype=cur_column.dtype)
+            new_column[:self._size] = cur_column[:self._size]
+            setattr(self, cur_attr, new_column)
+
+    def __init__(self, network_index):
+        """
+
+        :param network_index: NetworkIndex of the domain, defining the link indexes
+        """
+        self.network_index = network_index
+        self.link_ids = network_index.link_ids
+        self.set_columns(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int32),
+                         np.empty(0, dtype=np.int64))
+
+
+# Dynamic Class - counts of particles by location and source, for when particles identities are not needed
+class ParticleBuckets:
+    network_index = None          # NetworkIndex of the domain
+    link_ids = None               # array of link ids - the position of each id is its link index
+    link = None                   # column of link indexes (int32)
+    comp = None                   # column of compartments, one of ParticleStore.COMP_... (int8)
+    src_link = None               # column of source link indexes (int32)
+    src_layer = None              # column of ParticleManager.LAYER_... values or insertion timestamps (int64)
+    counts = None                 # column with the number of particles in each bucket (int64)
+
+    def get_link_index(self, link_id):
+        """
+
+        :param link_id:
+        :return: Integer with the index of the link, None if link is not in the domain
+        """
+        return self.network_index.get_index(link_id)
+
+    def add_particles(self, link_idx, comp, src_link_idx, src_layer, count=1):
+        """
+        Adds 'count' particles. Same signature as ParticleStore.add_particles.
+        :param link_idx: Integer or array of link indexes
+        :param comp: Integer or array of ParticleStore.COMP_... values
+        :param src_link_idx: Integer or array of source link indexes
+        :param src_layer: Integer or array of ParticleManager.LAYER_... values or insertion timestamps
+        :param count: Number of particles to be added
+        :return:
+        """
+
+        if count <= 0:
+            return
+        if np.ndim(link_idx) == np.ndim(comp) == np.ndim(src_link_idx) == np.ndim(src_layer) == 0:
+            self.add_buckets(link_idx, comp, src_link_idx, src_layer, np.array([count], dtype=np.int64))
+        else:
+            self.add_buckets(link_idx, comp, src_link_idx, src_layer, np.ones(count, dtype=np.int64))
+
+    def add_buckets(self, link_idx, comp, src_link_idx, src_layer, counts):
+        """
+        Adds 'counts[i]' particles with the i-th given attributes
+        :param link_idx: Array of link indexes
+        :param comp: Array of ParticleStore.COMP_... values
+        :param src_link_idx: Array of source link indexes
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :param counts: Array with the number of particles of each entry
+        :return:
+        """
+
+        counts = np.asarray(counts, dtype=np.int64)
+        self.set_columns(np.concatenate((self.link, np.broadcast_to(link_idx, counts.shape))),
+                         np.concatenate((self.comp, np.broadcast_to(comp, counts.shape))),
+                         np.concatenate((self.src_link, np.broadcast_to(src_link_idx, counts.shape))),
+                         np.concatenate((self.src_layer, np.broadcast_to(src_layer, counts.shape))),
+                         np.concatenate((self.counts, counts)))
+
+    def set_columns(self, link_idx, comp, src_link_idx, src_layer, counts):
+        """
+        Replaces the whole content by the given columns, dropping empty buckets and merging repeated ones
+        :param link_idx: Array of link indexes
+        :param comp: Array of ParticleStore.COMP_... values
+        :param src_link_idx: Array of source link indexes
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :param counts: Array with the number of particles of each entry
+        :return:
+        """
+
+        link_idx = np.asarray(link_idx, dtype=np.int32)
+        comp = np.asarray(comp, dtype=np.int8)
+        src_link_idx = np.asarray(src_link_idx, dtype=np.int32)
+        src_layer = np.asarray(src_layer, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+
+        # sort by key and sum up repeated keys
+        not_empty = counts > 0
+        link_idx, comp = link_idx[not_empty], comp[not_empty]
+        src_link_idx, src_layer, counts = src_link_idx[not_empty], src_layer[not_empty], counts[not_empty]
+        order = np.lexsort((src_layer, src_link_idx, comp, link_idx))
+        link_idx, comp = link_idx[order], comp[order]
+        src_link_idx, src_layer, counts = src_link_idx[order], src_layer[order], counts[order]
+        new_key = np.ones(len(counts), dtype=bool)
+        new_key[1:] = (np.diff(link_idx) != 0) | (np.diff(comp) != 0) | (np.diff(src_link_idx) != 0) | \
+                      (np.diff(src_layer) != 0)
+        key_starts = np.flatnonzero(new_key)
+
+        self.link = link_idx[key_starts]
+        self.comp = comp[key_starts]
+        self.src_link = src_link_idx[key_starts]
+        self.src_layer = src_layer[key_starts]
+        self.counts = np.add.reduceat(counts, key_starts) if len(key_starts) > 0 else counts
+
+    def derive(self, link_idx, comp, src_link_idx, src_layer, counts):
+        """
+        Creates a new set of buckets over the same domain links filled with the given columns
+        :param link_idx:
+        :param comp:
+        :param src_link_idx:
+        :param src_layer:
+        :param counts:
+        :return: A new ParticleBuckets object
+        """
+        ret_obj = ParticleBuckets(self.network_index)
+        ret_obj.set_columns(link_idx, comp, src_link_idx, src_layer, counts)
+        return ret_obj
+
+    def count_particles(self):
+        """
+
+        :return:
+        """
+        return int(self.counts.sum())
+
+    def count_particles_by_layer_source(self, aggregate_rain=True):
+        """
+
+        :param aggregate_rain: If True, all rain-generated particles are aggregated into a single source numbered '1'
+        :return: Integer of counting and Dictionary of [layer_source_flag]:[]
+        """
+
+        return_dict = {}
+        for cur_layer in (ParticleManager.LAYER_POND, ParticleManager.LAYER_TOPLAYER,
+                          ParticleManager.LAYER_SUBSURFACE, ParticleManager.LAYER_CHANNEL):
+            return_dict[cur_layer] = int(self.counts[self.src_layer == cur_layer].sum())
+        if aggregate_rain:
+            return_dict[ParticleManager.LAYER_RAIN] = int(self.counts[self.src_layer > 0].sum())
+
+        return sum(return_dict.values()), return_dict
+
+    def get_contributions(self, outlet_link_id, aggregate_rain=True):
+        """
+        Counts the particles in the channel of the outlet link by source link and source layer
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return: An OutletContributions object
+        """
+
+        outlet_idx = self.get_link_index(outlet_link_id)
+        if outlet_idx is None:
+            return OutletContributions.count(outlet_link_id, [], [], aggregate_rain=aggregate_rain)
+
+        at_outlet = (self.link == outlet_idx) & (self.comp == ParticleStore.COMP_CHANNEL)
+        return OutletContributions.count(outlet_link_id, self.link_ids[self.src_link[at_outlet]],
+                                         self.src_layer[at_outlet], counts=self.counts[at_outlet],
+                                         aggregate_rain=aggregate_rain)
+
+    def get_contributions_by_outlet(self, outlet_link_ids, aggregate_rain=True):
+        """
+        Same as 'get_contributions' for several outlets, selecting the buckets of all of them in a single pass
+        :param outlet_link_ids: List of link ids
+        :param aggregate_rain:
+        :return: A dictionary of outlet link_id -> OutletContributions object
+        """
+
+        at_outlets = (self.comp == ParticleStore.COMP_CHANNEL) & \
+            self.network_index.get_mask(outlet_link_ids)[self.link]
+        outlets_parts = self.derive(self.link[at_outlets], self.comp[at_outlets], self.src_link[at_outlets],
+                                    self.src_layer[at_outlets], self.counts[at_outlets])
+        return dict([(cur_outlet_id, outlets_parts.get_contributions(cur_outlet_id, aggregate_rain=aggregate_rain))
+                     for cur_outlet_id in outlet_link_ids])
+
+    def get_contributing_links(self, outlet_link_id, aggregate_rain=True):
+        """
+        Same as 'get_contributions', as nested dictionaries
+        :param outlet_link_id:
+        :param aggregate_rain:
+        :return: A dictionary of source link_id -> dictionary of layer source -> number of particles
+        """
+        return self.get_contributions(outlet_link_id, aggregate_rain=aggregate_rain).to_dict()
+
+    def __init__(self, network_index):
+        """
+
+        :param network_index: NetworkIndex of the domain, defining the link indexes
+        """
+        self.network_index = network_index
+        self.link_ids = network_index.link_ids
+        self.set_columns(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int32),
+                         np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+# Dynamic Class - Counter-based random values: the value of a particle is a hash of the seed, the step and the particle
+# attributes, so that a same seed gives the same results however particles are ordered, chunked or split among workers
+class RandomStreams:
+    _GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+    _MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+    _MIX_2 = np.uint64(0x94D049BB133111EB)
+
+    seed_sequence = None          # numpy SeedSequence the keys are derived from
+    key = None                    # 64-bit key of the hash (uint64)
+
+    def spawn(self, num_streams):
+        """
+        Derives independent streams, e.g. one for each member of an ensemble
+        :param num_streams:
+        :return: List of new RandomStreams objects
+        """
+        return [RandomStreams(s) for s in self.seed_sequence.spawn(num_streams)]
+
+    def get_legacy_seed(self):
+        """
+
+        :return: Integer seed for numpy's global random state of seeded runs
+        """
+        return int(self.seed_sequence.generate_state(3, dtype=np.uint32)[2])
+
+    def get_generator(self, step_key):
+        """
+        Gets a generator for the draws that are not made particle by particle (e.g. binomial splits of buckets)
+        :param step_key: Integer identifying the step (e.g. the timestamp of the h5 file being applied)
+        :return: numpy Generator object, the same for a same key and step
+        """
+        return np.random.default_rng((int(self.key), int(step_key)))
+
+    def uniforms(self, step_key, link_ids, comp, src_link_ids, src_layer):
+        """
+        Gets one uniform value per particle. Particles with the same attributes are interchangeable, so they are ranked
+        among themselves and the rank enters the hash instead of the position of the particle in the arrays.
+        :param step_key: Integer identifying the step (e.g. the timestamp of the h5 file being applied)
+        :param link_ids: Array of current link ids of the particles
+        :param comp: Array of current compartments (ParticleStore.COMP_...)
+        :param src_link_ids: Array of source link ids
+        :param src_layer: Array of ParticleManager.LAYER_... values or insertion timestamps
+        :return: Array of uniform values in [0, 1)
+        """
+
+        # the attributes are hashed into a single key, so that identical particles are found by sorting only it
+        num_values = len(link_ids)
+        hashed = np.full(num_values, self.key, dtype=np.uint64)
+        for cur_column in (step_key, link_ids, comp, src_link_ids, src_layer):
+            hashed += RandomStreams._GOLDEN
+            hashed += np.asarray(cur_column, dtype=np.int64).view(np.uint64)
+            RandomStreams._mix(hashed)
+
+        # only the particles sharing their key are ranked, in their order in the arrays
+        rank = np.zeros(num_values, dtype=np.int64)
+        sorted_hashed = np.sort(hashed)
+        same_next = sorted_hashed[1:] == sorted_hashed[:-1]
+        if np.any(same_next):
+            # (group, position) pairs packed in 64 bits (up to 2**32 particles), so that a plain sort gives the order
+            # within each group
+            order = np.argsort(hashed)
+            in_dup = np.zeros(num_values, dtype=bool)
+            in_dup[1:] = same_next
+            in_dup[:-1] |= same_next
+            groups = np.cumsum(np.concatenate(([True], ~same_next)))[in_dup]
+            packed = np.sort((groups.astype(np.uint64) << np.uint64(32)) | order[in_dup].astype(np.uint64))
+            dup_idx = (packed & np.uint64(0xFFFFFFFF)).astype(np.int64)
+            new_key = np.ones(len(packed), dtype=bool)
+            new_key[1:] = (packed[1:] >> np.uint64(32)) != (packed[:-1] >> np.uint64(32))
+            key_starts = np.flatnonzero(new_key)
+            rank[dup_idx] = np.arange(len(dup_idx), dtype=np.int64) - key_starts[np.cumsum(new_key) - 1]
+
+        hashed = RandomStreams._mix(hashed + RandomStreams._GOLDEN + rank.view(np.uint64))
+        return (hashed >> np.uint64(11)).astype(np.float64) * (1.0 / 2**53)
+
+    def particles_uniforms(self, step_key, particles):
+        """
+        Same as 'uniforms' for all particles of a ParticleStore
+        :param step_key:
+        :param particles: ParticleStore object
+        :return: Array of uniform values in [0, 1), one per particle
+        """
+        return self.uniforms(step_key, particles.link_ids[particles.link], particles.comp,
+                             particles.link_ids[particles.src_link], particles.src_layer)
+
+    @staticmethod
+    def _mix(values):
+        """
+        SplitMix64 finalizer
+        :param values: Array of uint64, modified in place
+        :return: Array of uint64
+        """
+        with np.errstate(over="ignore"):
+            values ^= values >> np.uint64(30)
+            values *= RandomStreams._MIX_1
+            values ^= values >> np.uint64(27)
+            values *= RandomStreams._MIX_2
+            values ^= values >> np.uint64(31)
+        return values
+
+    def __init__(self, seed=None):
+        """
+
+        :param seed: Integer, numpy SeedSequence or None for an unpredictable seed
+        """
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.key = self.seed_sequence.generate_state(1, dtype=np.uint64)[0]
+
+
+# Static Class - Closed-form, vectorized equivalent of the trial-by-trial transfers of particles between compartments
+class TransferKernel:
+    STEP_CHNL = 0                 # channel -> downstream channel
+    STEP_SUBS = 1                 # subsurface -> channel
+    STEP_TOPL = 2                 # top layer -> subsurface
+    STEP_POND_CHNL = 3            # ponds -> channel
+    STEP_POND_ANY = 4             # ponds -> channel or top layer
+
+    use_jit = True                # if True and numba is installed, 'move' runs a compiled loop
+    _jit_move = None              # compiled loop, built when first needed
+
+    @staticmethod
+    def step_probabilities(prob_leave_cc, prob_leave_sc, prob_leave_ts, prob_leave_pc, prob_leave_pt, num_trials):
+        """
+        Converts single-trial probabilities (as given by DomainHydraulics.get_leave_probabilities) into the
+        probabilities of leaving each compartment within 'num_trials' trials. Undefined (NaN) probabilities never
+        trigger a transfer, as in the trial-by-trial comparisons.
+        :param prob_leave_cc: Array with one single-trial probability per link
+        :param prob_leave_sc: Array with one single-trial probability per link
+        :param prob_leave_ts: Array with one single-trial probability per link
+        :param prob_leave_pc: Array with one single-trial probability per link
+        :param prob_leave_pt: Array with one single-trial cumulative probability (ponds->channel or top layer) per link
+        :param num_trials: Number of trials in a step (usually GblVars.delta_t)
+        :return: Array with shape (5, number of links) indexed by TransferKernel.STEP_...
+        """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            trial_chnl = TransferKernel._clean_probability(prob_leave_cc)
+            trial_subs = TransferKernel._clean_probability(prob_leave_sc)
+            trial_topl = TransferKernel._clean_probability(prob_leave_ts)
+            trial_pond_chnl = TransferKernel._clean_probability(prob_leave_pc)
+            trial_pond_any = np.where(np.isnan(prob_leave_pt), trial_pond_chnl,
+                                      TransferKernel._clean_probability(prob_leave_pt))
+            trial_pond_any = np.maximum(trial_pond_any, trial_pond_chnl)
+
+            ret_probs = np.empty((5, len(trial_chnl)), dtype=np.float64)
+            ret_probs[TransferKernel.STEP_CHNL] = TransferKernel._leave_within(trial_chnl, num_trials)
+            ret_probs[TransferKernel.STEP_SUBS] = TransferKernel._leave_within(trial_subs, num_trials)
+            ret_probs[TransferKernel.STEP_TOPL] = TransferKernel._leave_within(trial_topl, num_trials)
+            ret_probs[TransferKernel.STEP_POND_ANY] = TransferKernel._leave_within(trial_pond_any, num_trials)
+
+            # once leaving the ponds, the exit is chosen proportionally to the single-trial probabilities
+            chnl_share = np.where(trial_pond_any > 0, trial_pond_chnl / trial_pond_any, 0)
+            ret_probs[TransferKernel.STEP_POND_CHNL] = ret_probs[TransferKernel.STEP_POND_ANY] * chnl_share
+
+        return ret_probs
+
+    @staticmethod
+    def move(link_idx, comp, rdm_values, step_probs, links_down):
+        """
+        Moves all given particles by one step, consuming a single uniform random value per particle
+        :param link_idx: Array of current link indexes of the particles
+        :param comp: Array of current compartments (ParticleStore.COMP_...) of the particles
+        :param rdm_values: Array of uniform random values in [0, 1), one per particle
+        :param step_probs: Array as returned by TransferKernel.step_probabilities
+        :param links_down: Array with the downstream link index of each link (-1 if leaving the domain)
+        :return: Arrays of new link indexes, new compartments and a boolean mask of particles still in the domain
+        """
+
+        jit_move = TransferKernel.get_jit_move()
+        if jit_move is not None:
+            new_link = np.empty(len(link_idx), dtype=np.int32)
+            new_comp = np.empty(len(link_idx), dtype=np.int8)
+            jit_move(np.ascontiguousarray(link_idx, dtype=np.int32), np.ascontiguousarray(comp, dtype=np.int8),
+                     np.ascontiguousarray(rdm_values, dtype=np.float64), step_probs,
+                     np.ascontiguousarray(links_down, dtype=np.int32), new_link, new_comp)
+            return new_link, new_comp, new_link >= 0
+
+        new_link = np.array(link_idx, dtype=np.int32)
+        new_comp = np.array(comp, dtype=np.int8)
+        parts_probs = step_probs[:, link_idx]
+
+        # channel -> downstream channel
+        leaving = (comp == ParticleStore.COMP_CHANNEL) & (rdm_values < parts_probs[TransferKernel.STEP_CHNL])
+        new_link[leaving] = links_down[link_idx[leaving]]
+
+        # subsurface -> channel, top layer -> subsurface
+        leaving = (comp == ParticleStore.COMP_SUBSURFACE) & (rdm_values < parts_probs[TransferKernel.STEP_SUBS])
+        new_comp[leaving] = ParticleStore.COMP_CHANNEL
+        leaving = (comp == ParticleStore.COMP_TOPLAYER) & (rdm_values < parts_probs[TransferKernel.STEP_TOPL])
+        new_comp[leaving] = ParticleStore.COMP_SUBSURFACE
+
+        # ponds -> channel or top layer
+        in_ponds = comp == ParticleStore.COMP_POND
+        to_channel = in_ponds & (rdm_values < parts_probs[TransferKernel.STEP_POND_CHNL])
+        to_toplayer = in_ponds & (~to_channel) & (rdm_values < parts_probs[TransferKernel.STEP_POND_ANY])
+        new_comp[to_channel] = ParticleStore.COMP_CHANNEL
+        new_comp[to_toplayer] = ParticleStore.COMP_TOPLAYER
+
+        return new_link, new_comp, new_link >= 0
+
+    @staticmethod
+    def split(link_idx, comp, counts, step_probs, links_down, rng=None):
+        """
+        Moves buckets of particles by one step, splitting each bucket with binomial draws
+        :param link_idx: Array of current link indexes of the buckets
+        :param comp: Array of current compartments (ParticleStore.COMP_...) of the buckets
+        :param counts: Array with the number of particles in each bucket
+        :param step_probs: Array as returned by TransferKernel.step_probabilities
+        :param links_down: Array with the downstream link index of each link (-1 if leaving the domain)
+        :param rng: numpy Generator the draws are taken from. If None, numpy's global random state is used.
+        :return: Arrays of new link indexes, new compartments, counts and the originating bucket of each new bucket
+        """
+
+        rng = np.random if rng is None else rng
+
+        buckets_probs = step_probs[:, link_idx]
+        leave_probs = np.zeros(len(counts), dtype=np.float64)
+        dest_link = np.array(link_idx, dtype=np.int32)
+        dest_comp = np.array(comp, dtype=np.int8)
+
+        # one-exit compartments
+        in_chnl = comp == ParticleStore.COMP_CHANNEL
+        leave_probs[in_chnl] = buckets_probs[TransferKernel.STEP_CHNL, in_chnl]
+        dest_link[in_chnl] = links_down[link_idx[in_chnl]]
+        in_subs = comp == ParticleStore.COMP_SUBSURFACE
+        leave_probs[in_subs] = buckets_probs[TransferKernel.STEP_SUBS, in_subs]
+        dest_comp[in_subs] = ParticleStore.COMP_CHANNEL
+        in_topl = comp == ParticleStore.COMP_TOPLAYER
+        leave_probs[in_topl] = buckets_probs[TransferKernel.STEP_TOPL, in_topl]
+        dest_comp[in_topl] = ParticleStore.COMP_SUBSURFACE
+
+        # ponds: first exit is the channel, the second is the top layer given not going to the channel
+        in_pond = comp == ParticleStore.COMP_POND
+        leave_probs[in_pond] = buckets_probs[TransferKernel.STEP_POND_CHNL, in_pond]
+        dest_comp[in_pond] = ParticleStore.COMP_CHANNEL
+
+        moved = rng.binomial(counts, leave_probs)
+        stayed = counts - moved
+
+        pond_rows = np.flatnonzero(in_pond)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pond_chnl = buckets_probs[TransferKernel.STEP_POND_CHNL, pond_rows]
+            pond_topl = (buckets_probs[TransferKernel.STEP_POND_ANY, pond_rows] - pond_chnl) / (1 - pond_chnl)
+        pond_topl = np.clip(np.nan_to_num(pond_topl, nan=0.0), 0, 1)
+        to_topl = rng.binomial(stayed[pond_rows], pond_topl)
+        stayed[pond_rows] -= to_topl
+
+        all_rows = np.arange(len(counts))
+        new_link = np.concatenate((link_idx, dest_link, link_idx[pond_rows]))
+        new_comp = np.concatenate((comp, dest_comp, np.full(len(pond_rows), ParticleStore.COMP_TOPLAYER,
+                                                            dtype=np.int8)))
+        new_counts = np.concatenate((stayed, moved, to_topl))
+        new_rows = np.concatenate((all_rows, all_rows, pond_rows))
+
+        still_in = (new_link >= 0) & (new_counts > 0)
+        return new_link[still_in], new_comp[still_in], new_counts[still_in], new_rows[still_in]
+
+    @staticmethod
+    def get_jit_move():
+        """
+        Gets the compiled version of the loop behind 'move', compiling it in the first call
+        :return: Compiled function, None if numba is not installed or 'use_jit' is False
+        """
+
+        if (numba is None) or (not TransferKernel.use_jit):
+            return None
+        if TransferKernel._jit_move is None:
+            TransferKernel._jit_move = numba.njit(nogil=True)(TransferKernel._build_move_loop())
+        return TransferKernel._jit_move
+
+    @staticmethod
+    def _build_move_loop():
+        """
+        Builds the particle-by-particle equivalent of 'move', with constants bound so that it can be compiled
+        :return: Function (link_idx, comp, rdm_values, step_probs, links_down, new_link, new_comp) filling the last two
+        """
+
+        comp_chnl, comp_pond = ParticleStore.COMP_CHANNEL, ParticleStore.COMP_POND
+        comp_topl, comp_subs = ParticleStore.COMP_TOPLAYER, ParticleStore.COMP_SUBSURFACE
+        step_chnl, step_subs, step_topl = TransferKernel.STEP_CHNL, TransferKernel.STEP_SUBS, TransferKernel.STEP_TOPL
+        step_pond_chnl, step_pond_any = TransferKernel.STEP_POND_CHNL, TransferKernel.STEP_POND_ANY
+
+        def move_loop(link_idx, comp, rdm_values, step_probs, links_down, new_link, new_comp):
+            for i in range(link_idx.shape[0]):
+                cur_link, cur_comp, cur_rdm = link_idx[i], comp[i], rdm_values[i]
+                new_link[i], new_comp[i] = cur_link, cur_comp
+                if cur_comp == comp_chnl:
+                    if cur_rdm < step_probs[step_chnl, cur_link]:
+                        new_link[i] = links_down[cur_link]
+                elif cur_comp == comp_subs:
+                    if cur_rdm < step_probs[step_subs, cur_link]:
+                        new_comp[i] = comp_chnl
+                elif cur_comp == comp_topl:
+                    if cur_rdm < step_probs[step_topl, cur_link]:
+                        new_comp[i] = comp_subs
+                elif cur_comp == comp_pond:
+                    if cur_rdm < step_probs[step_pond_chnl, cur_link]:
+                        new_comp[i] = comp_chnl
+                    elif cur_rdm < step_probs[step_pond_any, cur_link]:
+                        new_comp[i] = comp_topl
+
+        return move_loop
+
+    @staticmethod
+    def _clean_probability(trial_probs):
+        """
+
+        :param trial_probs:
+        :return: Copy of the given array with NaN replaced by 0 and values clipped into [0, 1]
+        """
+        return np.clip(np.nan_to_num(np.asarray(trial_probs, dtype=np.float64), nan=0.0, posinf=1.0, neginf=0.0),
+                       0, 1)
+
+    @staticmethod
+    def _leave_within(trial_probs, num_trials):
+        """
+
+        :param trial_probs: Single-trial probabilities, already in [0, 1]
+        :param num_trials:
+        :return: Probability of at least one success in 'num_trials' trials: 1 - (1 - p)^n
+        """
+        return -np.expm1(num_trials * np.log1p(-trial_probs))
+
+    def __init__(self):
+        return
+
+
+# Static Class - Library of functions (its methods) for performing the tracking steps
+class OutputTracer:
+
+    @staticmethod
+    def distribute_particles_proportional(first_h5_file, max_particles, outlet_link_id):
+        """
+        Creates a snapshot with initial particles distributed proportionally to the outlet channel discharge
+        :param topo:
+        :param first_h5_file:
+        :param max_particles:
+        :param outlet_link_id:
+        :return: Initial particles dictionary
+        """
+
+        link_discharge = None
+        ret_dict = {}
+
+        print("...at '{0}'.".format(datetime.datetime.now()))
+
+        # reading file
+        print("Reading file '{0}'.".format(first_h5_file))
+        disch_dict = H5FileReader.read_h5_file(first_h5_file)
+
+        print("...at '{0}'.".format(datetime.datetime.now()))
+
+        # find proportion particles/storage
+        if max_particles is None:
+            min_dich = math.inf
+            min_linkid = None
+            for cur_linkid in disch_dict.keys():
+                if disch_dict[cur_linkid] < min_dich:
+                    min_linkid, min_dich = cur_linkid, disch_dict[cur_linkid]
+            vol_disch2 = OutputTracer.calculate_volume_in_link(topo, disch_dict, min_linkid)
+            particle_ratio = 1 / vol_disch2
+        else:
+            min_dich = disch_dict[outlet_link_id]
+            vol_disch2 = OutputTracer.calculate_volume_in_link(topo, min_dich, outlet_link_id)
+            particle_ratio = max_particles / vol_disch2
+        print("Ref. disch.: {0}, ref. volum.:{1}.".format(min_dich, vol_disch2))
+        print("Part. ratio: {0}".format(particle_ratio))
+
+        print("...at '{0}'.".format(datetime.datetime.now()))
+
+        # distribute particles through network
+        for cur_link_id in disch_dict.keys():
+            cur_vol = OutputTracer.calculate_volume_in_link(topo, disch_dict, cur_link_id)
+            cur_parts = int(particle_ratio * cur_vol)
+            ret_dict[cur_link_id] = []
+            for count_p in range(0, cur_parts):
+                ret_dict[cur_link_id].append(Particle(cur_link_id))
+
+        print("...at '{0}'.".format(datetime.datetime.now()))
+
+        # debug
+        for count_i in range(0, 5):
+            cur_link_id = list(disch_dict.keys())[count_i]
+            print("Link {0}: {1} ({2} m3/s).".format(cur_link_id, len(ret_dict[cur_link_id]), disch_dict[cur_link_id]))
+        print("Link {0}: {1} ({2} m3/s).".format(outlet_link_id, len(ret_dict[outlet_link_id]),
+                                                 disch_dict[outlet_link_id]))
+
+        print("Created {0} particles.".format(ParticleManager.particles_created()))
+        print("...at '{0}'.".format(datetime.datetime.now()))
+
+        return ret_dict
+
+    @staticmethod
+    def distribute_particles_equally(timestamp=None, parts_in_pounds=0, parts_in_toplayer=0, parts_in_subsurface=0,
+                                     parts_in_channel=0, particle_store=False, particle_buckets=False):
+        """
+        Creates a snapshot with initial particles distributed proportionally to the outlet channel discharge
+        :param timestamp:
+        :param parts_in_pounds:
+        :param parts_in_toplayer:
+        :param parts_in_subsurface:
+        :param parts_in_channel:
+        :param particle_store: If True, particles are held in a ParticleStore instead of Particle objects
+        :param particle_buckets: If True, particles are counted in a ParticleBuckets instead of Particle objects
+        :return: A new DomainSnapshot object filled with new Particle objects
+        """
+
+        if particle_store or particle_buckets:
+            return OutputTracer._distribute_particles_equally_in_store(timestamp, parts_in_pounds, parts_in_toplayer,
+                                                                       parts_in_subsurface, parts_in_channel,
+                                                                       ParticleBuckets if particle_buckets else
+                                                                       ParticleStore)
+
+        ret_obj = DomainSnapshot(the_timestamp=timestamp)
+
+        # print("...at '{0}'.".format(datetime.datetime.now()))
+
+        # distribute particles through network
+        for cur_link_id in GblVars.network_index.link_ids.tolist():
+
+            cur_state_obj = HillslopeLinkState()
+            for i in range(0, parts_in_pounds):
+                cur_state_obj.parts_pond_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_POND))
+            for i in range(0, parts_in_toplayer):
+                cur_state_obj.parts_topl_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_TOPLAYER))
+            for i in range(0, parts_in_subsurface):
+                cur_state_obj.parts_subs_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_SUBSURFACE))
+            for i in range(0, parts_in_channel):
+                cur_state_obj.parts_chnl_frnt.append(Particle(cur_link_id, ParticleManager.LAYER_CHANNEL))
+            ret_obj.hl_states[cur_link_id] = cur_state_obj
+
+        # each link is the source of its own particles
+        all_links_idx = np.arange(GblVars.network_index.num_links)
+        ret_obj.layer_counters = LayerCounters(GblVars.network_index.num_links)
+        for cur_layer, cur_parts in ((ParticleManager.LAYER_POND, parts_in_pounds),
+                                     (ParticleManager.LAYER_TOPLAYER, parts_in_toplayer),
+                                     (ParticleManager.LAYER_SUBSURFACE, parts_in_subsurface),
+                                     (ParticleManager.LAYER_CHANNEL, parts_in_channel)):
+            ret_obj.layer_counters.add(all_links_idx, cur_layer, cur_parts)
+
+        return ret_obj
+
+    @staticmethod
+    def _distribute_particles_equally_in_store(timestamp, parts_in_pounds, parts_in_toplayer, parts_in_subsurface,
+                                               parts_in_channel, store_class):
+        """
+        Same as 'distribute_particles_equally', but filling a ParticleStore or a ParticleBuckets
+        :param timestamp:
+        :param parts_in_pounds:
+        :param parts_in_toplayer:
+        :param parts_in_subsurface:
+        :param parts_in_channel:
+        :param store_class: ParticleStore or ParticleBuckets
+        :return: A new DomainSnapshot object with its 'particles' store filled
+        """
+
+        all_link_ids = GblVars.network_index.link_ids.tolist()
+        parts_store = store_class(GblVars.network_index)
+        ret_obj = DomainSnapshot(hillslopelink_ids=all_link_ids, the_timestamp=timestamp, particles=parts_store)
+        ret_obj.layer_counters = LayerCounters(len(all_link_ids))
+
+        # one block of particles for each compartment, each block sorted by link
+        all_links_idx = np.arange(len(all_link_ids), dtype=np.int32)
+        for cur_comp, cur_layer, cur_parts in ((ParticleStore.COMP_POND, ParticleManager.LAYER_POND, parts_in_pounds),
+                                               (ParticleStore.COMP_TOPLAYER, ParticleManager.LAYER_TOPLAYER,
+                                                parts_in_toplayer),
+                                               (ParticleStore.COMP_SUBSURFACE, ParticleManager.LAYER_SUBSURFACE,
+                                                parts_in_subsurface),
+                                               (ParticleStore.COMP_CHANNEL, ParticleManager.LAYER_CHANNEL,
+                                                parts_in_channel)):
+            parts_store.add_buckets(all_links_idx, cur_comp, all_links_idx, cur_layer,
+                                    np.full(len(all_links_idx), cur_parts, dtype=np.int64))
+            ret_obj.layer_counters.add(all_links_idx, cur_layer, cur_parts)
+
+        return ret_obj
+
+    @staticmethod
+    def calculate_volume_in_link(topo, disch_dict, link_id):
+        """
+
+        :param topo:
+        :param disch_dict:
+        :param link_id:
+        :return:
+        """
+
+        # print("{0} of {1} ?".format(link_id, topo[link_id]))
+        chan_len = topo[link_id].get_link_length()
+        chan_aup = topo[link_id].get_upstream_area()
+        chan_ahl = topo[link_id].get_hillslope_area()
+        chan_dsc = disch_dict[link_id]
+
+        # print("Link length: {0}".format(chan_len))
+
+        tau = ((1 - GblVars.lambda_1) * chan_len * 1000)/(GblVars.vel_ref * (chan_aup**GblVars.lambda_2))
+        vol_disch = tau * ((chan_dsc**(1 - GblVars.lambda_1))/(1 - GblVars.lambda_1))
+
+        return vol_disch
+
+    def __init__(self):
+        return
+
+
+# Static Class - Library of functions (its methods) for reading Asynch files (.rvr, .prm, ...)
+class AsynchFilesReader:
+
+    @staticmethod
+    def build_topology(rvr_fpath):
+        """
+
+        :param rvr_fpath:
+        :return: Dictionary of HillslopeLinkPrm objects with link ids as keys.
+        """
+
+        # basic check
+        if not os.path.exists(rvr_fpath):
+            print("File not found: '{0}'.".format(rvr_fpath))
+            return None
+
+        print("Building topology:")
+        rvr_content = AsynchFilesReader.read_rvr_file(rvr_fpath)
+        if rvr_content is None:
+            return None
+        domain_link_ids, downstream_ids, upstream_ptr, upstream_ids = rvr_content
+
+        # create objects in bulk, links in the same order they are first mentioned in the file
+        all_hillslopelinks = {}
+        for cur_link_id, cur_downstream_id in zip(domain_link_ids.tolist(), downstream_ids.tolist()):
+            cur_hl = HillslopeLinkPrm(cur_link_id)
+            if cur_downstream_id >= 0:
+                cur_hl.set_downstream_hl_id(cur_downstream_id)
+            all_hillslopelinks[cur_link_id] = cur_hl
+        upstream_ptr = upstream_ptr.tolist()
+        upstream_ids = upstream_ids.tolist()
+        for cur_link_idx, cur_link_id in enumerate(domain_link_ids.tolist()):
+            all_hillslopelinks[cur_link_id].upstream_hl_ids = \
+                upstream_ids[upstream_ptr[cur_link_idx]:upstream_ptr[cur_link_idx + 1]]
+
+        print("Created topology with {0} links.".format(len(all_hillslopelinks.keys())))
+        return all_hillslopelinks
+
+    @staticmethod
+    def fill_parameters(topology, prm_fpath):
+        """
+
+        :param topology:
+        :param prm_fpath:
+        :return: Boolean. True if it was possible to perform the changes in 'prm_fpath' var, False otherwise
+        """
 
         # basic checks
         if topology is None:
@@ -632,53 +1720,246 @@ class AsynchFilesReader:
             print("fill_parameters: provided prm file ({0}) does not exist.".format(prm_fpath))
             return False
 
-        num_params = None
-        last_link_id = None
+        prm_content = AsynchFilesReader.read_prm_file(prm_fpath)
+        if prm_content is None:
+            return False
+        prm_link_ids, prm_values = prm_content
+
         attributes_set = 0
-        all_topo_linkids = topology.keys()
-        with open(prm_fpath, "r+") as rfile:
-            for cur_line in rfile:
-                cur_line = cur_line.strip()
-
-                # read header
-                if num_params is None:
-                    num_params = int(cur_line)
-                    continue
-
-                # ignore blank lines
-                if cur_line == "":
-                    continue
-
-                # process linkid line
-                if last_link_id is None:
-                    last_link_id = int(cur_line)
-                    continue
-
-                # process attributes line
-                if last_link_id is not None:
-                    slp_line = [float(v) for v in cur_line.split(" ")]
-                    if last_link_id in all_topo_linkids:
-                        topology[last_link_id].set_attributes(slp_line[0], slp_line[1], slp_line[2])
-                        attributes_set += 1
-                    last_link_id = None
-                    continue
-
-                print("fill_parameters: Unexpected end of loop.")
+        for cur_link_id, cur_values in zip(prm_link_ids.tolist(), prm_values[:, 0:3].tolist()):
+            if cur_link_id in topology:
+                topology[cur_link_id].set_attributes(cur_values[0], cur_values[1], cur_values[2])
+                attributes_set += 1
 
         # farewell check
-        if attributes_set != len(all_topo_linkids):
-            print("Set attributes for {0} out of {1} hillslope-links.".format(attributes_set, len(all_topo_linkids)))
+        return AsynchFilesReader._check_attributes_set(attributes_set, len(topology))
+
+    @staticmethod
+    def build_network_index_from_files(rvr_fpath, prm_fpath, renumber=False):
+        """
+        Same as 'build_topology' + 'fill_parameters' + 'build_network_index', without creating HillslopeLinkPrm objects
+        :param rvr_fpath:
+        :param prm_fpath:
+        :param renumber: If True, links are renumbered so that the links of each sub-basin are contiguous
+        :return: NetworkIndex object, None if it was not possible to build it
+        """
+
+        # basic checks
+        if not os.path.exists(rvr_fpath):
+            print("File not found: '{0}'.".format(rvr_fpath))
+            return None
+        if (prm_fpath is None) or (not os.path.exists(prm_fpath)):
+            print("fill_parameters: provided prm file ({0}) does not exist.".format(prm_fpath))
+            return None
+
+        # topology
+        print("Building topology:")
+        rvr_content = AsynchFilesReader.read_rvr_file(rvr_fpath)
+        if rvr_content is None:
+            return None
+        domain_link_ids, downstream_ids, upstream_ptr, upstream_ids = rvr_content
+        print("Created topology with {0} links.".format(len(domain_link_ids)))
+        downstream_idx = AsynchFilesReader._ids_to_indices(domain_link_ids, downstream_ids)
+
+        # parameters
+        prm_content = AsynchFilesReader.read_prm_file(prm_fpath)
+        if prm_content is None:
+            return None
+        prm_link_ids, prm_values = prm_content
+        prm_links_idx = AsynchFilesReader._ids_to_indices(domain_link_ids, prm_link_ids)
+        in_domain = prm_links_idx >= 0
+        links_attributes = np.full((len(domain_link_ids), 3), np.nan, dtype=np.float64)
+        links_attributes[prm_links_idx[in_domain]] = prm_values[in_domain, 0:3]
+        if not AsynchFilesReader._check_attributes_set(int(np.count_nonzero(in_domain)), len(domain_link_ids)):
+            return None
+
+        network_index = NetworkIndex(domain_link_ids, downstream_idx, links_attributes[:, 0], links_attributes[:, 1],
+                                     links_attributes[:, 2])
+        if renumber:
+            network_index = network_index.renumbered()
+        print("Indexed {0} hillslope-links.".format(network_index.num_links))
+        return network_index
+
+    @staticmethod
+    def read_rvr_file(rvr_fpath):
+        """
+        Reads a whole .rvr file at once and tokenizes it with NumPy
+        :param rvr_fpath:
+        :return: Tuple with arrays (domain link ids in order of first mention, downstream link id of each domain link
+                 or -1, CSR pointers of upstream links per domain link, upstream link ids). None if file is malformed.
+        """
+
+        all_lines = AsynchFilesReader._read_non_blank_lines(rvr_fpath)
+        if len(all_lines) < 1:
+            print("Empty file: '{0}'.".format(rvr_fpath))
+            return None
+        num_links = int(all_lines[0])
+
+        # lines alternate between a link id and its parents ('<number of parents> <parent 1> <parent 2> ...')
+        if (len(all_lines) - 1) % 2 != 0:
+            print("Unexpected number of lines in '{0}'.".format(rvr_fpath))
+            return None
+        record_ids = np.array(all_lines[1::2], dtype=np.int64)
+        parent_lines = np.array(all_lines[2::2])
+        tokens_per_line = np.char.count(parent_lines, " ") + 1
+        all_tokens = np.array(" ".join(all_lines[2::2]).split(" "), dtype=np.int64)
+        line_starts = np.cumsum(tokens_per_line) - tokens_per_line
+        parents_per_line = tokens_per_line - 1
+        if np.any(all_tokens[line_starts] != parents_per_line):
+            print("Inconsistent number of parents in '{0}'.".format(rvr_fpath))
+        is_parent = np.ones(len(all_tokens), dtype=bool)
+        is_parent[line_starts] = False
+        parent_ids = all_tokens[is_parent]
+        parent_owner = np.repeat(record_ids, parents_per_line)
+        if len(record_ids) != num_links:
+            print("Expected {0} links, found {1}.".format(num_links, len(record_ids)))
+
+        # domain links: each record and its parents, in order of first mention
+        mentions = np.empty(len(record_ids) + len(parent_ids), dtype=np.int64)
+        mention_order = np.empty(len(mentions), dtype=np.int64)
+        record_pos = np.arange(len(record_ids)) + np.cumsum(parents_per_line) - parents_per_line
+        mentions[record_pos] = record_ids
+        mention_order[record_pos] = record_pos
+        parent_pos = np.ones(len(mentions), dtype=bool)
+        parent_pos[record_pos] = False
+        mentions[parent_pos] = parent_ids
+        unique_ids, first_mention = np.unique(mentions, return_index=True)
+        domain_link_ids = unique_ids[np.argsort(first_mention, kind='stable')]
+
+        # downstream and upstream links in domain order
+        parents_idx = AsynchFilesReader._ids_to_indices(domain_link_ids, parent_ids)
+        owners_idx = AsynchFilesReader._ids_to_indices(domain_link_ids, parent_owner)
+        downstream_ids = np.full(len(domain_link_ids), -1, dtype=np.int64)
+        downstream_ids[parents_idx] = parent_owner
+        parents_sorter = np.argsort(owners_idx, kind='stable')
+        upstream_ptr = np.zeros(len(domain_link_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owners_idx, minlength=len(domain_link_ids)), out=upstream_ptr[1:])
+        return domain_link_ids, downstream_ids, upstream_ptr, parent_ids[parents_sorter]
+
+    @staticmethod
+    def read_prm_file(prm_fpath):
+        """
+        Reads a whole .prm file at once and tokenizes it with NumPy
+        :param prm_fpath:
+        :return: Tuple with arrays (link ids, 2D array of parameters with one row per link). None if file is malformed.
+        """
+
+        all_lines = AsynchFilesReader._read_non_blank_lines(prm_fpath)
+        if (len(all_lines) < 1) or ((len(all_lines) - 1) % 2 != 0):
+            print("fill_parameters: Unexpected end of loop.")
+            return None
+
+        prm_link_ids = np.array(all_lines[1::2], dtype=np.int64)
+        all_values = np.array(" ".join(all_lines[2::2]).split(" "), dtype=np.float64)
+        if (len(prm_link_ids) == 0) or (len(all_values) % len(prm_link_ids) != 0):
+            print("fill_parameters: Inconsistent number of parameters in '{0}'.".format(prm_fpath))
+            return None
+        return prm_link_ids, all_values.reshape(len(prm_link_ids), -1)
+
+    @staticmethod
+    def _ids_to_indices(domain_link_ids, link_ids):
+        """
+
+        :param domain_link_ids: Array of unique link ids
+        :param link_ids: Array of link ids to be located in 'domain_link_ids'
+        :return: Array with the position of each link id in 'domain_link_ids', -1 for the ones not found
+        """
+        domain_sorter = np.argsort(domain_link_ids, kind='stable')
+        sorted_ids = domain_link_ids[domain_sorter]
+        sorted_pos = np.minimum(np.searchsorted(sorted_ids, link_ids), max(len(sorted_ids) - 1, 0))
+        if len(sorted_ids) == 0:
+            return np.full(len(link_ids), -1, dtype=np.int32)
+        found = sorted_ids[sorted_pos] == link_ids
+        return np.where(found, domain_sorter[sorted_pos], -1).astype(np.int32)
+
+    @staticmethod
+    def _read_non_blank_lines(file_path):
+        """
+
+        :param file_path:
+        :return: List of stripped lines that are not blank
+        """
+        with open(file_path, "r") as rfile:
+            return [cur_line for cur_line in (cur_line.strip() for cur_line in rfile.read().splitlines()) if cur_line]
+
+    @staticmethod
+    def _check_attributes_set(attributes_set, total_links):
+        """
+
+        :param attributes_set:
+        :param total_links:
+        :return: Boolean. True if all links got their attributes, False otherwise
+        """
+        if attributes_set != total_links:
+            print("Set attributes for {0} out of {1} hillslope-links.".format(attributes_set, total_links))
             return False
         else:
             print("Set attributes for all {0} hillslope-links.".format(attributes_set))
             return True
 
+    @staticmethod
+    def build_network_index(topology, renumber=False):
+        """
+        Builds the dense integer indexing of a topology whose parameters were already filled
+        :param topology: Dictionary of HillslopeLinkPrm objects with link ids as keys
+        :param renumber: If True, links are renumbered so that the links of each sub-basin are contiguous
+        :return: NetworkIndex object with link indexes following the order of 'topology' (if not renumbered)
+        """
+
+        if topology is None:
+            print("build_network_index: provided topology is None.")
+            return None
+
+        network_index = NetworkIndex.from_topology(topology)
+        if renumber:
+            network_index = network_index.renumbered()
+        print("Indexed {0} hillslope-links.".format(network_index.num_links))
+        return network_index
+
+    @staticmethod
+    def load_network_index(rvr_fpath, prm_fpath, renumber=False, use_cache=True):
+        """
+        Gets the network index of a domain from its compiled cache or, if there is no valid cache, by parsing the
+        .rvr and .prm files (and then writing the cache)
+        :param rvr_fpath:
+        :param prm_fpath:
+        :param renumber: If True, links are renumbered so that the links of each sub-basin are contiguous
+        :param use_cache: If False, files are always parsed and no cache is written
+        :return: NetworkIndex object, None if it was not possible to build it
+        """
+
+        if use_cache:
+            network_index = NetworkIndexCache.load(rvr_fpath, prm_fpath, renumbered=renumber)
+            if network_index is not None:
+                return network_index
+
+        network_index = AsynchFilesReader.build_network_index_from_files(rvr_fpath, prm_fpath, renumber=renumber)
+        if network_index is None:
+            return None
+
+        if use_cache:
+            NetworkIndexCache.save(network_index, rvr_fpath, prm_fpath, renumbered=renumber)
+        return network_index
+
     def __init__(self):
         return
 
 
 # Static Class - Library of functions (its methods) for reading HDF5 files
 class H5FileReader:
+    COL_LINK_ID = "link_id"           # column names given to the fields of the 'snapshot' dataset, in order
+    COL_DISCH_CHNL = "disch_chnl"     # channel discharge (m3/s)
+    COL_WC_POND = "wc_pond"           # water column in ponds (m)
+    COL_WC_TOPL = "wc_topl"           # water column in top layer (m)
+    COL_WC_SUBS = "wc_subs"           # water column in subsurface (m)
+    COL_ACC_RAIN_WC = "acc_rain_wc"   # accumulated rainfall water column (m)
+    COLUMNS = (COL_LINK_ID, COL_DISCH_CHNL, COL_WC_POND, COL_WC_TOPL, COL_WC_SUBS, COL_ACC_RAIN_WC)
+
+    _snapshot_buffer = None           # structured array reused between reads of same-shaped datasets
+    _rows_link_ids = None             # link id of each row of the last dataset read
+    _rows_link_idx = None             # network index of each row of the last dataset read
+    _rows_network_index = None        # network index for which '_rows_link_idx' was computed
+    _rows_in_domain = None            # positions of the rows of the last dataset read with links in the domain
 
     @staticmethod
     def list_h5_files(input_fpath_arg):
@@ -705,7 +1986,46 @@ class H5FileReader:
             cur_file_path = os.path.join(base_folder, cur_file_name)
             return_list.append(cur_file_path)
 
-        return return_list
+        # names sort as their timestamps only if these have the same number of digits
+        return sorted(return_list, key=H5FileReader.get_h5_file_timestamp)
+
+    @staticmethod
+    def get_time_steps(h5_file_paths):
+        """
+        Gets the time step of each file from the spacing of the timestamps in their names
+        :param h5_file_paths: List of h5 file paths, as given by 'list_h5_files'
+        :return: Array with the seconds from the previous file to each file (the first file gets the same step as the
+                 second one), None if there are less than two files
+        """
+
+        if len(h5_file_paths) < 2:
+            return None
+        timestamps = np.array([H5FileReader.get_h5_file_timestamp(p) for p in h5_file_paths], dtype=np.int64)
+        steps = np.diff(timestamps)
+        if np.any(steps <= 0):
+            print("Files with repeated timestamps in '{0}'.".format(os.path.dirname(h5_file_paths[0])))
+            return None
+        if len(np.unique(steps)) > 1:
+            print("Irregular spacing of h5 files: from {0} to {1} seconds.".format(steps.min(), steps.max()))
+        return np.concatenate((steps[:1], steps))
+
+    @staticmethod
+    def interpolate_snapshot_content(prev_content, next_content, weight):
+        """
+        Linearly interpolates the states of two snapshot datasets with the same rows
+        :param prev_content: Structured array as returned by 'read_snapshot_dataset', at the beginning of the interval
+        :param next_content: Structured array as returned by 'read_snapshot_dataset', at the end of the interval
+        :param weight: Position in the interval, from 0 (prev_content) to 1 (next_content)
+        :return: New structured array. A copy of 'next_content' if the rows of both do not match.
+        """
+
+        ret_content = np.array(next_content, copy=True)
+        if (prev_content is None) or (weight >= 1) or \
+                (not np.array_equal(prev_content[H5FileReader.COL_LINK_ID], next_content[H5FileReader.COL_LINK_ID])):
+            return ret_content
+        for cur_col in H5FileReader.COLUMNS[1:]:
+            ret_content[cur_col] = prev_content[cur_col] + (next_content[cur_col] - prev_content[cur_col]) * weight
+        return ret_content
 
     @staticmethod
     def read_h5_file(h5_file_path):
@@ -715,40 +2035,98 @@ class H5FileReader:
         :return:
         """
 
-        ret_dict = {}
-
-        # get outlet's discharge
-        with h5py.File(h5_file_path, "r") as hdf_file:
-            hdf_file_content = hdf_file.get('snapshot')
-            for i in range(len(hdf_file_content)):
-                ret_dict[int(hdf_file_content[i][0])] = hdf_file_content[i][1]
-
-        return ret_dict
+        snapshot_content = H5FileReader.read_snapshot_dataset(h5_file_path)
+        all_link_ids = snapshot_content[H5FileReader.COL_LINK_ID].tolist()
+        all_dischs = snapshot_content[H5FileReader.COL_DISCH_CHNL].tolist()
+        return dict(zip(all_link_ids, all_dischs))
 
     @staticmethod
-    def read_h5_file_and_fill_snapshot(h5_file_path, snapshot):
+    def read_h5_file_and_fill_snapshot(h5_file_path, snapshot, snapshot_content=None):
         """
         Translate discharge content from h5 file into a dictionary of [link_id]->discharge
         :param h5_file_path:
         :param snapshot:
+        :param snapshot_content: Content of the file already read by 'read_snapshot_dataset' (e.g. by a H5Prefetcher).
+                                 If None, the file is read.
         :return:
         """
 
-        # get outlet's discharge
+        if snapshot_content is None:
+            snapshot_content = H5FileReader.read_snapshot_dataset(h5_file_path)
+        all_links_idx = H5FileReader.get_rows_link_indices(snapshot_content[H5FileReader.COL_LINK_ID])
+        if len(H5FileReader._rows_in_domain) < len(all_links_idx):
+            all_links_idx = all_links_idx[H5FileReader._rows_in_domain]
+            snapshot_content = snapshot_content[H5FileReader._rows_in_domain]
+
+        # hydraulics
+        if snapshot.hydraulics is None:
+            snapshot.hydraulics = DomainHydraulics(GblVars.network_index)
+        snapshot.hydraulics.set_dischs_and_volumes(all_links_idx,
+                                                   snapshot_content[H5FileReader.COL_DISCH_CHNL],
+                                                   snapshot_content[H5FileReader.COL_WC_POND],
+                                                   snapshot_content[H5FileReader.COL_WC_TOPL],
+                                                   snapshot_content[H5FileReader.COL_WC_SUBS])
+
+        # rainfall
+        snapshot.add_particles_from_rainfall_columns(all_links_idx, snapshot_content[H5FileReader.COL_ACC_RAIN_WC])
+
+    @staticmethod
+    def read_snapshot_dataset(h5_file_path, buffer=None, shared_buffer=True):
+        """
+        Reads the whole 'snapshot' dataset of an h5 file with a single call into a reused buffer
+        :param h5_file_path:
+        :param buffer: Structured array to be filled. If None, see 'shared_buffer'.
+        :param shared_buffer: If True and no buffer is given, a buffer shared by all calls is used. If False, a new one
+                              is allocated.
+        :return: Structured array with columns named as the COL_* constants. If it is the shared buffer or the given
+                 one, it is overwritten in the next call. A new one is allocated if the given buffer does not fit.
+        """
+
+        use_shared = (buffer is None) and shared_buffer
         with h5py.File(h5_file_path, "r") as hdf_file:
-            hdf_file_content = hdf_file.get('snapshot')
-            for i in range(len(hdf_file_content)):
-                cur_link_id = int(hdf_file_content[i][0])
-                cur_channel_disc = hdf_file_content[i][1]
-                cur_pond_wc = hdf_file_content[i][2]
-                cur_tplr_wc = hdf_file_content[i][3]
-                cur_subs_wc = hdf_file_content[i][4]
-                cur_acc_rain_wc = hdf_file_content[i][5]
+            hdf_dataset = hdf_file['snapshot']
+            cur_buffer = H5FileReader._snapshot_buffer if use_shared else buffer
+            if (cur_buffer is None) or (cur_buffer.shape != hdf_dataset.shape) or \
+                    (cur_buffer.dtype != H5FileReader._get_buffer_dtype(hdf_dataset.dtype)):
+                cur_buffer = np.empty(hdf_dataset.shape, dtype=H5FileReader._get_buffer_dtype(hdf_dataset.dtype))
+                if use_shared:
+                    H5FileReader._snapshot_buffer = cur_buffer
+            if len(cur_buffer) > 0:
+                hdf_dataset.read_direct(cur_buffer.view(hdf_dataset.dtype))
+        return cur_buffer
+
+    @staticmethod
+    def get_rows_link_indices(rows_link_ids):
+        """
+        Maps the link ids of the rows of a snapshot dataset into indices of GblVars.network_index. The mapping is
+        computed once and reused while the following files keep the same row order.
+        :param rows_link_ids: Array of link ids, one per row
+        :return: Array of link indices, one per row (-1 for links out of the domain)
+        """
 
-                snapshot.hl_states[cur_link_id].set_dischs_and_volume(cur_link_id, cur_channel_disc, cur_pond_wc,
-                                                                      cur_tplr_wc, cur_subs_wc)
+        if (H5FileReader._rows_link_ids is None) or (H5FileReader._rows_network_index is not GblVars.network_index) \
+                or (not np.array_equal(H5FileReader._rows_link_ids, rows_link_ids)):
+            H5FileReader._rows_link_ids = np.array(rows_link_ids, copy=True)
+            H5FileReader._rows_link_idx = GblVars.network_index.get_indices(rows_link_ids)
+            H5FileReader._rows_network_index = GblVars.network_index
+            H5FileReader._rows_in_domain = np.flatnonzero(H5FileReader._rows_link_idx >= 0)
+        return H5FileReader._rows_link_idx
 
-                snapshot.add_particles_from_rainfall(cur_link_id, cur_acc_rain_wc)
+    @staticmethod
+    def _get_buffer_dtype(dataset_dtype):
+        """
+        Same memory layout of the dataset compound type, but with columns renamed as the COL_* constants
+        :param dataset_dtype:
+        :return:
+        """
+        col_names = list(dataset_dtype.names)
+        for cur_col_idx, cur_col_name in enumerate(H5FileReader.COLUMNS):
+            if cur_col_idx < len(col_names):
+                col_names[cur_col_idx] = cur_col_name
+        return np.dtype({'names': col_names,
+                         'formats': [dataset_dtype.fields[n][0] for n in dataset_dtype.names],
+                         'offsets': [dataset_dtype.fields[n][1] for n in dataset_dtype.names],
+                         'itemsize': dataset_dtype.itemsize})
 
     @staticmethod
     def get_h5_file_timestamp(file_path):
@@ -766,124 +2144,216 @@ class H5FileReader:
         return
 
 
-# Static Class - Library of functions (its methods) for dealing with multi-threading
-class ThreadManager:
+# Dynamic Class - Reads the snapshot datasets of upcoming h5 files in background threads
+class H5Prefetcher:
+    _h5_file_paths = None         # list of h5 file paths, in the order they are going to be requested
+    _depth = None                 # maximum number of files read ahead of the one being used
+    _executor = None              # ThreadPoolExecutor, None if prefetching is disabled
+    _pending = None               # dictionary of [file position]->Future of 'read_snapshot_dataset'
+    _free_buffers = None          # queue of structured arrays whose content was already used
+    _next_position = None         # position of the next file to be submitted for reading
+    _last_buffer = None           # buffer given in the last call of 'get_snapshot_content'
+
+    def get_snapshot_content(self, h5_file_position):
+        """
+        Gets the content of the 'snapshot' dataset of a file, waiting for it to be read if needed. The content given in
+        the previous call is released and may be overwritten.
+        :param h5_file_position: Position of the file in the list given in the constructor
+        :return: Structured array as returned by H5FileReader.read_snapshot_dataset()
+        """
 
-    __max_threads = 50        # number - constant
-    _links = None             # array
-    _threads_opened = None    # number - count
-    _threads_closed = None    #
-    _threads_finished = None  # number - count
-    _topo = None              # constant_ref
-    _parts_dict = None        # constant_ref
-    _disch_dict = None
-    _ret_dict = None
-    _lock = _thread.allocate_lock()
-    _count_seen_particles = None
-    _count_seen_hilllinks = None
+        # give back the buffer used in previous step
+        if self._last_buffer is not None:
+            self._free_buffers.put(self._last_buffer)
+            self._last_buffer = None
 
-    @staticmethod
-    def thread_call(sub_links_id, aThreadManager):
+        # no background reading
+        if self._executor is None:
+            return H5FileReader.read_snapshot_dataset(self._h5_file_paths[h5_file_position])
+
+        # files requested out of order are read right now
+        if h5_file_position not in self._pending:
+            self._cancel_pending()
+            self._next_position = h5_file_position + 1
+            self._fill_queue()
+            return H5FileReader.read_snapshot_dataset(self._h5_file_paths[h5_file_position])
+
+        self._last_buffer = self._pending.pop(h5_file_position).result()
+        self._fill_queue()
+        return self._last_buffer
+
+    def close(self):
+        """
+        Cancels pending readings and stops background threads
+        :return:
         """
+        if self._executor is None:
+            return
+        self._cancel_pending()
+        self._executor.shutdown(wait=True)
+        self._executor = None
 
-        :param aThreadManager:
+    def _fill_queue(self):
+        """
+        Submits the reading of the next files until 'depth' of them are pending
         :return:
         """
+        while (len(self._pending) < self._depth) and (self._next_position < len(self._h5_file_paths)):
+            self._pending[self._next_position] = self._executor.submit(self._read, self._next_position)
+            self._next_position += 1
 
-        while len(sub_links_id) > 0:
-            a = sub_links_id.pop()
-            # print("Going for {0} & {1}.".format(a, aThreadManager))
-            ThreadManager.track_particles_in_link(a, aThreadManager)
+    def _cancel_pending(self):
+        """
 
-    @staticmethod
-    def track_particles_in_link(link_id, aThreadManager):
+        :return:
         """
+        for cur_future in self._pending.values():
+            if not cur_future.cancel():
+                self._free_buffers.put(cur_future.result())
+        self._pending = {}
 
-        :param link_id:
-        :param aThreadManager:
+    def _read(self, h5_file_position):
+        """
+        Reads a file into a recycled buffer, if any is available
+        :param h5_file_position:
         :return:
         """
+        try:
+            cur_buffer = self._free_buffers.get_nowait()
+        except queue.Empty:
+            cur_buffer = None
+        return H5FileReader.read_snapshot_dataset(self._h5_file_paths[h5_file_position], buffer=cur_buffer,
+                                                  shared_buffer=False)
+
+    def __init__(self, h5_file_paths, depth=2):
+        """
+
+        :param h5_file_paths: List of h5 file paths, in the order they are going to be requested
+        :param depth: Maximum number of files read ahead. If 0 or None, files are read only when requested.
+        """
+        self._h5_file_paths = list(h5_file_paths)
+        self._depth = 0 if depth is None else max(int(depth), 0)
+        self._pending = {}
+        self._free_buffers = queue.Queue()
+        self._next_position = 0
+        if self._depth > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._depth)
+            self._fill_queue()
 
-        cur_link_vol = OutputTracer.calculate_volume_in_link(aThreadManager._topo, aThreadManager._disch_dict, link_id)
-        aThreadManager._count_seen_hilllinks += 1
+    def __enter__(self):
+        return self
 
-        # print("aThreadManager._disch_dict: {0} / {1}".format(aThreadManager._disch_dict[link_id], cur_link_vol))
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-        prob_leave = aThreadManager._disch_dict[link_id] / cur_link_vol
 
-        for cur_particle_idx in range(0, len(aThreadManager._parts_dict[link_id])):
-            aThreadManager._count_seen_particles += 1
-            count_times = GblVars.delta_t
-            while count_times > 0:
-                cur_rdm_val = np.random.uniform(0, 1)                                                     # limit tries
-                if cur_rdm_val <= prob_leave:
-                    cur_downlink_id = aThreadManager._topo[link_id].get_downstream_hl_id()
-                    if (cur_downlink_id is not None) and (cur_downlink_id in aThreadManager._ret_dict.keys()):
-                        aThreadManager._ret_dict[cur_downlink_id].append(aThreadManager._parts_dict[link_id][cur_particle_idx])  # got to flow
-                    break
-                count_times -= 1
-            if count_times <= 0:
-                aThreadManager._ret_dict[link_id].append(aThreadManager._parts_dict[link_id][cur_particle_idx])  # got stuck
+# Dynamic Class - Pool of threads moving the particles of contiguous chunks of links in parallel
+class ThreadManager:
+    _executor = None              # ThreadPoolExecutor
+    _num_workers = None           # number of threads, each one taking a chunk of links per step
 
-        aThreadManager._threads_closed += 1
+    def get_num_workers(self):
+        return self._num_workers
 
-    def process_it(self, links):
+    def move(self, link_idx, comp, rdm_values, links_probs, links_down, num_trials):
         """
-
-        :param links: []
-        :return:
+        Same as TransferKernel.step_probabilities() followed by TransferKernel.move(), with the links split in chunks
+        of similar number of particles that are processed by different threads. Results are the same as the serial
+        functions for the same random values.
+        :param link_idx: Array of current link indexes of the particles
+        :param comp: Array of current compartments (ParticleStore.COMP_...) of the particles
+        :param rdm_values: Array of uniform random values in [0, 1), one per particle
+        :param links_probs: Tuple of single-trial probabilities arrays, as by DomainHydraulics.get_leave_probabilities()
+        :param links_down: Array with the downstream link index of each link (-1 if leaving the domain)
+        :param num_trials: Number of trials in a step (usually GblVars.delta_t)
+        :return: Arrays of new link indexes, new compartments and a boolean mask of particles still in the domain
         """
 
-        self._links = list(links)
-        link_step = int(len(self._links) / ThreadManager.__max_threads)
+        num_links = len(links_down)
+        links_ptr = np.zeros(num_links + 1, dtype=np.int64)
+        np.cumsum(np.bincount(link_idx, minlength=num_links), out=links_ptr[1:])
+        chunks_bounds = self._get_chunks_bounds(links_ptr)
+        all_chunks = list(zip(chunks_bounds[:-1], chunks_bounds[1:]))
+
+        # 1st: transfer probabilities of each chunk of links into a shared array (disjoint columns)
+        step_probs = np.empty((5, num_links), dtype=np.float64)
+        list(self._executor.map(lambda c: ThreadManager._chunk_step_probabilities(step_probs, links_probs, num_trials,
+                                                                                  *c), all_chunks))
+
+        # 2nd: move the particles of each chunk into its own buffers, then merge them. Particles are grouped by chunk
+        # once (a stable radix sort of the small chunk numbers), so that each chunk takes a contiguous slice of their
+        # positions instead of scanning all particles.
+        new_link = np.empty(len(link_idx), dtype=np.int32)
+        new_comp = np.empty(len(link_idx), dtype=np.int8)
+        still_in = np.empty(len(link_idx), dtype=bool)
+        if len(all_chunks) > 1:
+            links_chunk = np.repeat(np.arange(len(all_chunks), dtype=np.uint8 if len(all_chunks) <= 256 else
+                                              np.uint16), np.diff(chunks_bounds))
+            by_chunk = np.argsort(links_chunk[link_idx], kind='stable')
+        else:
+            by_chunk = np.arange(len(link_idx))
+        chunks_ptr = links_ptr[chunks_bounds]
+        all_positions = [by_chunk[chunks_ptr[i]:chunks_ptr[i + 1]] for i in range(len(all_chunks))]
+        all_moved = self._executor.map(lambda p: ThreadManager._chunk_move(link_idx, comp, rdm_values, step_probs,
+                                                                           links_down, p), all_positions)
+        for cur_positions, cur_new_link, cur_new_comp, cur_still_in in all_moved:
+            new_link[cur_positions] = cur_new_link
+            new_comp[cur_positions] = cur_new_comp
+            still_in[cur_positions] = cur_still_in
+
+        return new_link, new_comp, still_in
+
+    def close(self):
+        """
 
-        while (len(self._links) > 0) and (self._threads_opened < ThreadManager.__max_threads):
+        :return:
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
-            _thread.start_new_thread(ThreadManager.thread_call, (self._links[link_step*self._threads_opened:
-                                                                             link_step*(self._threads_opened+1)], self))
-            self._threads_opened += 1
+    def _get_chunks_bounds(self, links_ptr):
+        """
+        Splits the links in contiguous chunks holding similar numbers of particles
+        :param links_ptr: Array with the number of particles before each link, plus the total number of particles
+        :return: Array with the first link of each chunk followed by the number of links
+        """
+        num_links = len(links_ptr) - 1
+        chunks_targets = links_ptr[-1] * np.arange(1, self._num_workers) / self._num_workers
+        inner_bounds = np.searchsorted(links_ptr[1:], chunks_targets, side='right')
+        return np.unique(np.concatenate(([0], inner_bounds, [num_links])))
 
-        while self._threads_closed < len(self._links):
-            pass
+    @staticmethod
+    def _chunk_step_probabilities(step_probs, links_probs, num_trials, first_link, end_link):
+        """
 
-        '''
-        while (len(self._links) > 0) and (self._threads_opened < ThreadManager.__max_threads):
-            ThreadManager._lock.acquire()
-            self._threads_opened += 1
-            _thread.start_new_thread(ThreadManager.track_particles_in_link, (self._links.pop(), self))
-            ThreadManager._lock.release()
+        :return:
+        """
+        step_probs[:, first_link:end_link] = TransferKernel.step_probabilities(
+            *[cur_probs[first_link:end_link] for cur_probs in links_probs], num_trials=num_trials)
 
-        while self._threads_finished < len(self._links):
-            if (self._threads_closed > 0) and (len(self._links) > 0):
-                ThreadManager._lock.acquire()
-                self._threads_closed -= 1
-                _thread.start_new_thread(ThreadManager.track_particles_in_link, (self._links.pop(), self))
-                ThreadManager._lock.release()
-            pass
-        '''
+    @staticmethod
+    def _chunk_move(link_idx, comp, rdm_values, step_probs, links_down, positions):
+        """
 
-        return self._ret_dict
+        :param positions: Array with the positions of the particles of the chunk
+        :return: Tuple with the positions of the particles of the chunk and their TransferKernel.move() results
+        """
+        return (positions, ) + TransferKernel.move(link_idx[positions], comp[positions], rdm_values[positions],
+                                                   step_probs, links_down)
 
-    def set_args(self, topology, particles_dict, disch_dict):
+    def __init__(self, num_workers=None):
         """
 
-        :param topology:
-        :param particles_dict:
-        :param disch_dict: Discharge dictionary
-        :return:
+        :param num_workers: Number of threads. If None, the number of CPUs is used.
         """
+        self._num_workers = max(int(os.cpu_count() if num_workers is None else num_workers), 1)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._num_workers)
 
-        self._topo = topology
-        self._parts_dict = particles_dict
-        self._disch_dict = disch_dict
-        self._ret_dict = {}
-        for cur_link_id in self._topo.keys():
-            self._ret_dict[cur_link_id] = []
+    def __enter__(self):
+        return self
 
-    def __init__(self):
-        self._threads_opened = 0
-        self._threads_closed = 0
-        self._threads_finished = 0
-        self._count_seen_particles = 0
-        self._count_seen_hilllinks = 0
-        return
\ No newline at end of file
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
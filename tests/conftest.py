@@ -0,0 +1,27 @@
+import pytest
+import os
+import sys
+
+# the libraries are imported the way the scripts of 'src' import them
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_PATH = os.path.join(ROOT_PATH, "src")
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+CASE01_PATH = os.path.join(ROOT_PATH, "example", "case01")
+
+
+@pytest.fixture(scope="session")
+def rvr_fpath():
+    return os.path.join(CASE01_PATH, "asynch_inputs", "wolfCreek.rvr")
+
+
+@pytest.fixture(scope="session")
+def prm_fpath():
+    return os.path.join(CASE01_PATH, "asynch_inputs", "wolfCreek.prm")
+
+
+@pytest.fixture(scope="session")
+def network_index(rvr_fpath, prm_fpath):
+    from traceOutputs_lib import AsynchFilesReader
+    return AsynchFilesReader.build_network_index_from_files(rvr_fpath, prm_fpath)
@@ -0,0 +1,87 @@
+from traceOutputs_lib import AsynchFilesReader
+from networkIndex_lib import NetworkIndex
+import numpy as np
+
+
+def legacy_topology(rvr_fpath):
+    """
+    Parses a .rvr file line by line, as the topology builder did before the bulk parser
+    :param rvr_fpath:
+    :return: Dictionary of [link_id]->[downstream link id or None, list of upstream link ids], links in order of first
+             mention
+    """
+
+    all_links = {}
+    num_links, last_link_id = None, None
+    with open(rvr_fpath, "r") as rfile:
+        for cur_line in rfile:
+            cur_line_split = cur_line.strip().split(" ")
+            if cur_line_split == [""]:
+                continue
+            if num_links is None:
+                num_links = int(cur_line_split[0])
+            elif last_link_id is None:
+                last_link_id = int(cur_line_split[0])
+            else:
+                cur_link = all_links.setdefault(last_link_id, [None, []])
+                for cur_up_id in [int(s) for s in cur_line_split[1:]]:
+                    if cur_up_id not in cur_link[1]:
+                        cur_link[1].append(cur_up_id)
+                    all_links.setdefault(cur_up_id, [None, []])[0] = last_link_id
+                last_link_id = None
+    return all_links
+
+
+def legacy_parameters(prm_fpath):
+    """
+    Parses a .prm file line by line, as the parameters filler did before the bulk parser
+    :param prm_fpath:
+    :return: Dictionary of [link_id]->[upstream area, hillslope area, link length]
+    """
+
+    all_params = {}
+    num_params, last_link_id = None, None
+    with open(prm_fpath, "r") as rfile:
+        for cur_line in rfile:
+            cur_line = cur_line.strip()
+            if num_params is None:
+                num_params = int(cur_line)
+            elif cur_line == "":
+                continue
+            elif last_link_id is None:
+                last_link_id = int(cur_line)
+            else:
+                all_params[last_link_id] = [float(v) for v in cur_line.split(" ")][0:3]
+                last_link_id = None
+    return all_params
+
+
+def test_read_rvr_file_matches_legacy_builder(rvr_fpath):
+    domain_link_ids, downstream_ids, upstream_ptr, upstream_ids = AsynchFilesReader.read_rvr_file(rvr_fpath)
+    expected = legacy_topology(rvr_fpath)
+
+    assert domain_link_ids.tolist() == list(expected.keys())
+    assert downstream_ids.tolist() == [-1 if v[0] is None else v[0] for v in expected.values()]
+    assert len(upstream_ptr) == len(domain_link_ids) + 1
+    for cur_link_idx, cur_link_id in enumerate(domain_link_ids.tolist()):
+        assert upstream_ids[upstream_ptr[cur_link_idx]:upstream_ptr[cur_link_idx + 1]].tolist() == \
+            expected[cur_link_id][1]
+
+
+def test_read_prm_file_matches_legacy_filler(prm_fpath):
+    prm_link_ids, prm_values = AsynchFilesReader.read_prm_file(prm_fpath)
+    expected = legacy_parameters(prm_fpath)
+
+    assert prm_link_ids.tolist() == list(expected.keys())
+    assert prm_values[:, 0:3].tolist() == list(expected.values())
+
+
+def test_bulk_index_matches_topology_objects(rvr_fpath, prm_fpath):
+    topology = AsynchFilesReader.build_topology(rvr_fpath)
+    assert AsynchFilesReader.fill_parameters(topology, prm_fpath)
+    from_objects = AsynchFilesReader.build_network_index(topology)
+    from_files = AsynchFilesReader.build_network_index_from_files(rvr_fpath, prm_fpath)
+
+    for cur_array in NetworkIndex.ARRAYS:
+        assert np.array_equal(getattr(from_objects, cur_array), getattr(from_files, cur_array), equal_nan=True), \
+            cur_array
@@ -0,0 +1,94 @@
+from contribFile_lib import ContribFileReader
+from checkpoint_lib import CheckpointFile
+import numpy as np
+import subprocess
+import pytest
+import pickle
+import glob
+import sys
+import os
+
+SCRIPT_FPATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src",
+                            "traceOutputs_layers_rain.py")
+H5_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example", "case01",
+                         "asynch_outputs")
+NUM_FILES = 20                    # first h5 files of the example used in the runs
+BROKEN_FILE = 13                  # position of the file unreadable in the interrupted run
+CHECKPOINT_EVERY = 5
+RUN_TIMEOUT = 300                 # seconds before a run is considered stuck
+
+
+def link_h5_files(folder_path, broken_file=None):
+    """
+    Links the first h5 files of the example into a folder, the one at 'broken_file' replaced by an unreadable file
+    :return: Path of the first h5 file
+    """
+
+    all_h5_fpaths = sorted(glob.glob(os.path.join(H5_FOLDER, "*.h5")))[0:NUM_FILES]
+    for i, cur_h5_fpath in enumerate(all_h5_fpaths):
+        cur_link_fpath = os.path.join(folder_path, os.path.basename(cur_h5_fpath))
+        if os.path.lexists(cur_link_fpath):
+            os.remove(cur_link_fpath)
+        if i == broken_file:
+            with open(cur_link_fpath, "w") as w_file:
+                w_file.write("not an h5 file")
+        else:
+            os.symlink(cur_h5_fpath, cur_link_fpath)
+    return os.path.join(folder_path, os.path.basename(all_h5_fpaths[0]))
+
+
+def run_tracking(first_h5_fpath, rvr_fpath, prm_fpath, out_fpath, engine, *extra_args):
+    """
+    Calls the tracking script as users do
+    :return: CompletedProcess object
+    """
+    return subprocess.run([sys.executable, SCRIPT_FPATH, "-in_first_h5", first_h5_fpath, "-in_rvr", rvr_fpath,
+                           "-in_prm", prm_fpath, "-link_id", "309414,304557", "-out_hyd", out_fpath,
+                           "-all_parts", "1", "-vol_per_parts", "50000", "-engine", engine, "-seed", "5",
+                           "-workers", "2", "-no_jit", "-no_cache", "-checkpoint_every", str(CHECKPOINT_EVERY)]
+                          + list(extra_args), capture_output=True, text=True, cwd=os.path.dirname(first_h5_fpath),
+                          timeout=RUN_TIMEOUT)
+
+
+def read_output(out_fpath):
+    if out_fpath.endswith(".h5"):
+        return dict([(cur_outlet_id, ContribFileReader.read_as_dict(out_fpath, outlet_link_id=cur_outlet_id))
+                     for cur_outlet_id in (309414, 304557)])
+    with open(out_fpath, "rb") as r_file:
+        return pickle.load(r_file)
+
+
+@pytest.mark.parametrize("engine, out_ext, extra_args", [("vectorized", ".p", ()),
+                                                         ("vectorized", ".h5", ()),
+                                                         ("objects", ".p", ("-substeps", "2")),
+                                                         ("subbasins", ".h5", ("-age_bins", "10"))])
+def test_resumed_run_gives_the_same_output(tmp_path, rvr_fpath, prm_fpath, engine, out_ext, extra_args):
+    full_folder, resumed_folder = tmp_path / "full", tmp_path / "resumed"
+    full_folder.mkdir()
+    resumed_folder.mkdir()
+    full_out_fpath, resumed_out_fpath = str(full_folder / ("hyd" + out_ext)), str(resumed_folder / ("hyd" + out_ext))
+    checkpoint_fpath = CheckpointFile.get_file_path(resumed_out_fpath)
+
+    # uninterrupted run
+    first_h5_fpath = link_h5_files(str(full_folder))
+    assert run_tracking(first_h5_fpath, rvr_fpath, prm_fpath, full_out_fpath, engine, *extra_args).returncode == 0
+    assert not os.path.exists(CheckpointFile.get_file_path(full_out_fpath))
+
+    # run interrupted while reading a file, after its last checkpoint
+    first_h5_fpath = link_h5_files(str(resumed_folder), broken_file=BROKEN_FILE)
+    assert run_tracking(first_h5_fpath, rvr_fpath, prm_fpath, resumed_out_fpath, engine, *extra_args).returncode != 0
+    with np.load(checkpoint_fpath) as checkpoint:
+        last_file_position = int(checkpoint["last_file_position"])
+    assert last_file_position == (BROKEN_FILE // CHECKPOINT_EVERY) * CHECKPOINT_EVERY - 1
+
+    # resumed run, with the file fixed
+    link_h5_files(str(resumed_folder))
+    resumed_run = run_tracking(first_h5_fpath, rvr_fpath, prm_fpath, resumed_out_fpath, engine, "-resume",
+                               *extra_args)
+    assert resumed_run.returncode == 0, resumed_run.stdout + resumed_run.stderr
+    assert "Resuming from file {0}".format(last_file_position + 1) in resumed_run.stdout
+    assert not os.path.exists(checkpoint_fpath)
+
+    full_output, resumed_output = read_output(full_out_fpath), read_output(resumed_out_fpath)
+    assert len(full_output[309414]) == NUM_FILES
+    assert resumed_output == full_output
@@ -0,0 +1,105 @@
+from contribFile_lib import ContribFileWriter, ContribFileReader
+from traceOutputs_lib import LayerCounters, OutletContributions, OutletAges
+from linkGroups_lib import GroupContributions
+import numpy as np
+import pytest
+
+OUTLET_LINK_IDS = (309414, 304557)
+TIMESTAMPS = list(range(1483228800, 1483228800 + 6 * 3600, 3600))
+AGE_BINS = 4
+
+
+def build_steps(with_extras, seed=0):
+    """
+    Random contributions of each outlet at each time step
+    :param with_extras: If True, ages and groups are built too
+    :param seed:
+    :return: List of (timestamp, outlet link id, OutletContributions, OutletAges, list of GroupContributions)
+    """
+
+    rdm_state = np.random.RandomState(seed)
+    ret_list = []
+    for cur_timestamp in TIMESTAMPS:
+        for cur_outlet_id in OUTLET_LINK_IDS:
+            num_parts = rdm_state.randint(1, 50)
+            contribs = OutletContributions.count(cur_outlet_id, rdm_state.randint(1000, 1010, size=num_parts),
+                                                 rdm_state.choice(LayerCounters.LAYERS, size=num_parts))
+            contribs.discharge = float(rdm_state.uniform(0, 10))
+            ages, groups = None, None
+            if with_extras:
+                ages = OutletAges(cur_outlet_id, 3600,
+                                  rdm_state.randint(0, 9, size=(len(LayerCounters.LAYERS), AGE_BINS)))
+                groups = [GroupContributions("distance", ["1", "2", "3"],
+                                             rdm_state.randint(0, 9, size=(3, len(LayerCounters.LAYERS)))),
+                          GroupContributions("counties", ["a", "b"],
+                                             rdm_state.randint(0, 9, size=(2, len(LayerCounters.LAYERS))))]
+            ret_list.append((cur_timestamp, cur_outlet_id, contribs, ages, groups))
+    return ret_list
+
+
+def build_expected(all_steps, outlet_link_id):
+    """
+    Pickled version of the contributions of an outlet, as written by the tracking script
+    """
+
+    ret_dict = {}
+    for cur_timestamp, cur_outlet_id, contribs, ages, groups in all_steps:
+        if cur_outlet_id != outlet_link_id:
+            continue
+        ret_dict[cur_timestamp] = contribs.to_dict(with_header=True)
+        if ages is not None:
+            ret_dict[cur_timestamp]["ages"] = ages.to_dict()
+        if groups:
+            ret_dict[cur_timestamp]["groups"] = dict([(g.name, g.to_dict()) for g in groups])
+    return ret_dict
+
+
+def write_steps(file_path, all_steps, resume_steps=None):
+    with ContribFileWriter(file_path, resume_steps=resume_steps) as contrib_writer:
+        for cur_timestamp, _, contribs, ages, groups in all_steps:
+            contrib_writer.append(cur_timestamp, contribs, ages=ages, groups=groups)
+
+
+@pytest.mark.parametrize("with_extras", [False, True])
+def test_read_as_dict_round_trip(tmp_path, with_extras):
+    file_path = str(tmp_path / "contrib.h5")
+    all_steps = build_steps(with_extras)
+    write_steps(file_path, all_steps)
+
+    for cur_outlet_id in OUTLET_LINK_IDS:
+        assert ContribFileReader.read_as_dict(file_path, outlet_link_id=cur_outlet_id) == \
+            build_expected(all_steps, cur_outlet_id)
+    assert ContribFileReader.read_as_dict(file_path) == build_expected(all_steps, OUTLET_LINK_IDS[0])
+    assert ContribFileReader.read_as_dict(file_path, outlet_link_id=1) is None
+
+
+def test_open_reads_a_time_range(tmp_path):
+    file_path = str(tmp_path / "contrib.h5")
+    all_steps = build_steps(True)
+    write_steps(file_path, all_steps)
+    expected = build_expected(all_steps, OUTLET_LINK_IDS[1])
+
+    contrib_file = ContribFileReader.open(file_path, outlet_link_id=OUTLET_LINK_IDS[1], ini_timestamp=TIMESTAMPS[2],
+                                          end_timestamp=TIMESTAMPS[4])
+    with contrib_file:
+        assert contrib_file.timestamps.tolist() == TIMESTAMPS[2:5]
+        for cur_step, cur_timestamp in enumerate(TIMESTAMPS[2:5]):
+            assert contrib_file.get_step_dict(cur_step) == expected[cur_timestamp]
+        assert contrib_file.get_age_counts().shape == (3, len(LayerCounters.LAYERS), AGE_BINS)
+        labels, group_counts = contrib_file.get_group_counts("counties")
+        assert list(labels) == ["a", "b"]
+        assert group_counts.shape == (3, 2, len(LayerCounters.LAYERS))
+
+
+def test_resumed_writer_drops_steps_after_the_checkpoint(tmp_path):
+    file_path = str(tmp_path / "contrib.h5")
+    all_steps = build_steps(True)
+    resumed_steps = build_steps(True, seed=1)
+    write_steps(file_path, all_steps)
+
+    # steps written after the checkpoint (at the third step) are replaced by the ones of the resumed run
+    num_kept = 3 * len(OUTLET_LINK_IDS)
+    write_steps(file_path, resumed_steps[num_kept:], resume_steps=3)
+    for cur_outlet_id in OUTLET_LINK_IDS:
+        assert ContribFileReader.read_as_dict(file_path, outlet_link_id=cur_outlet_id) == \
+            build_expected(all_steps[:num_kept] + resumed_steps[num_kept:], cur_outlet_id)
@@ -0,0 +1,89 @@
+import numpy as np
+
+OUTLET_LINK_ID = 309414
+
+
+def naive_upstream(network_index):
+    """
+
+    :return: List with, for each link index, the sorted list of the indexes of the links draining into it
+    """
+    ret_list = [[] for _ in range(network_index.num_links)]
+    for cur_link_idx, cur_down_idx in enumerate(network_index.downstream_idx.tolist()):
+        if cur_down_idx >= 0:
+            ret_list[cur_down_idx].append(cur_link_idx)
+    return ret_list
+
+
+def naive_path_sum(network_index, link_idx, outlet_idx, values):
+    """
+
+    :return: Sum of the values of the links from 'link_idx' down to 'outlet_idx', None if it does not drain into it
+    """
+    ret_sum = 0.0
+    while link_idx >= 0:
+        ret_sum += values[link_idx]
+        if link_idx == outlet_idx:
+            return ret_sum
+        link_idx = network_index.downstream_idx[link_idx]
+    return None
+
+
+def sorted_upstream_dict(network_index):
+    """
+
+    :return: Dictionary of [link_id]->sorted list of upstream link ids
+    """
+    return dict([(k, sorted(v or [])) for k, v in network_index.to_upstream_dict().items()])
+
+
+def test_upstream_adjacency_inverts_downstream_links(network_index):
+    expected = naive_upstream(network_index)
+    for cur_link_idx in range(network_index.num_links):
+        assert sorted(network_index.get_upstream_links(cur_link_idx).tolist()) == expected[cur_link_idx]
+
+
+def test_topological_and_post_orders(network_index):
+    for cur_order in (network_index.topo_order, network_index.get_postorder()):
+        assert sorted(cur_order.tolist()) == list(range(network_index.num_links))
+        position = np.empty(network_index.num_links, dtype=np.int64)
+        position[cur_order] = np.arange(network_index.num_links)
+        has_down = network_index.downstream_idx >= 0
+        assert np.all(position[network_index.downstream_idx[has_down]] > position[has_down])
+
+    # in post-order, each sub-basin is a contiguous block ending at its outlet
+    postorder = network_index.get_postorder().tolist()
+    outlet_idx = network_index.get_index(OUTLET_LINK_ID)
+    subbasin = set(network_index.get_subbasin(outlet_idx).tolist())
+    end_pos = postorder.index(outlet_idx)
+    assert set(postorder[end_pos - len(subbasin) + 1:end_pos + 1]) == subbasin
+
+
+def test_subbasin_and_accumulation(network_index):
+    outlet_idx = network_index.get_index(OUTLET_LINK_ID)
+    values = np.random.RandomState(0).uniform(0, 1, size=network_index.num_links)
+    accumulated = network_index.accumulate_upstream(outlet_idx, values)
+    subbasin = set(network_index.get_subbasin(outlet_idx).tolist())
+
+    for cur_link_idx in range(network_index.num_links):
+        expected = naive_path_sum(network_index, cur_link_idx, outlet_idx, values)
+        assert (cur_link_idx in subbasin) == (expected is not None)
+        if expected is None:
+            assert np.isnan(accumulated[cur_link_idx])
+        else:
+            assert np.isclose(accumulated[cur_link_idx], expected)
+
+
+def test_renumbered_and_pruned_keep_the_topology(network_index):
+    upstream_dict = sorted_upstream_dict(network_index)
+    renumbered = network_index.renumbered()
+    assert sorted_upstream_dict(renumbered) == upstream_dict
+    assert np.array_equal(renumbered.link_ids, network_index.link_ids[network_index.get_postorder()])
+
+    outlet_idx = network_index.get_index(OUTLET_LINK_ID)
+    pruned = network_index.pruned(outlet_idx)
+    subbasin_ids = set(network_index.link_ids[network_index.get_subbasin(outlet_idx)].tolist())
+    assert set(pruned.link_ids.tolist()) == subbasin_ids
+    assert pruned.get_outlets().tolist() == [pruned.get_index(OUTLET_LINK_ID)]
+    for cur_link_id, cur_up_ids in sorted_upstream_dict(pruned).items():
+        assert cur_up_ids == upstream_dict[cur_link_id]
@@ -0,0 +1,73 @@
+from networkIndex_lib import NetworkIndex, NetworkIndexCache
+from traceOutputs_lib import AsynchFilesReader
+import numpy as np
+import pytest
+import shutil
+import os
+
+
+@pytest.fixture
+def domain_files(tmp_path, rvr_fpath, prm_fpath):
+    """
+    Copies of the example .rvr and .prm files, so that caches are written and files changed in a temporary folder
+    """
+    tmp_rvr_fpath, tmp_prm_fpath = str(tmp_path / "domain.rvr"), str(tmp_path / "domain.prm")
+    shutil.copyfile(rvr_fpath, tmp_rvr_fpath)
+    shutil.copyfile(prm_fpath, tmp_prm_fpath)
+    return tmp_rvr_fpath, tmp_prm_fpath
+
+
+def assert_same_index(network_index, other_index):
+    for cur_array in NetworkIndex.ARRAYS:
+        assert np.array_equal(getattr(network_index, cur_array), getattr(other_index, cur_array), equal_nan=True), \
+            cur_array
+
+
+@pytest.mark.parametrize("renumbered", [False, True])
+def test_cache_round_trip(domain_files, network_index, renumbered):
+    rvr_fpath, prm_fpath = domain_files
+    cur_index = network_index.renumbered() if renumbered else network_index
+    assert NetworkIndexCache.load(rvr_fpath, prm_fpath, renumbered=renumbered) is None
+    assert NetworkIndexCache.save(cur_index, rvr_fpath, prm_fpath, renumbered=renumbered)
+    assert_same_index(NetworkIndexCache.load(rvr_fpath, prm_fpath, renumbered=renumbered), cur_index)
+    assert NetworkIndexCache.load(rvr_fpath, prm_fpath, renumbered=not renumbered) is None
+
+
+def test_cache_is_stale_when_rvr_modification_time_changes(domain_files, network_index):
+    rvr_fpath, prm_fpath = domain_files
+    NetworkIndexCache.save(network_index, rvr_fpath, prm_fpath)
+    rvr_stat = os.stat(rvr_fpath)
+    os.utime(rvr_fpath, ns=(rvr_stat.st_atime_ns, rvr_stat.st_mtime_ns + 1000000000))
+    assert NetworkIndexCache.load(rvr_fpath, prm_fpath) is None
+    assert NetworkIndexCache.load(rvr_fpath) is None
+
+
+def test_cache_is_stale_when_file_size_changes(domain_files, network_index):
+    rvr_fpath, prm_fpath = domain_files
+    NetworkIndexCache.save(network_index, rvr_fpath, prm_fpath)
+    rvr_stat = os.stat(rvr_fpath)
+    with open(rvr_fpath, "a") as a_file:
+        a_file.write("\n")
+    os.utime(rvr_fpath, ns=(rvr_stat.st_atime_ns, rvr_stat.st_mtime_ns))
+    assert NetworkIndexCache.load(rvr_fpath, prm_fpath) is None
+
+
+def test_cache_is_stale_when_prm_changes(domain_files, network_index):
+    rvr_fpath, prm_fpath = domain_files
+    NetworkIndexCache.save(network_index, rvr_fpath, prm_fpath)
+    with open(prm_fpath, "a") as a_file:
+        a_file.write("\n")
+    assert NetworkIndexCache.load(rvr_fpath, prm_fpath) is None
+
+    # topology-only uses do not depend on the .prm file
+    assert NetworkIndexCache.load(rvr_fpath) is not None
+
+
+def test_load_network_index_rebuilds_stale_cache(domain_files, network_index):
+    rvr_fpath, prm_fpath = domain_files
+    NetworkIndexCache.save(network_index.pruned(network_index.get_index(309414)), rvr_fpath, prm_fpath)
+    with open(rvr_fpath, "a") as a_file:
+        a_file.write("\n")
+
+    assert_same_index(AsynchFilesReader.load_network_index(rvr_fpath, prm_fpath), network_index)
+    assert_same_index(NetworkIndexCache.load(rvr_fpath, prm_fpath), network_index)
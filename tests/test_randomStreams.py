@@ -0,0 +1,111 @@
+from traceOutputs_lib import RandomStreams, ParticleStore
+import numpy as np
+import subprocess
+import pickle
+import glob
+import sys
+import os
+
+SCRIPT_FPATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src",
+                            "traceOutputs_layers_rain.py")
+H5_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example", "case01",
+                         "asynch_outputs")
+STEP_KEY = 1483228800
+RUN_TIMEOUT = 300                 # seconds before a run is considered stuck
+
+
+def build_particles(seed=0, num_parts=5000):
+    """
+    Random particle attributes, with many identical particles
+    :return: Tuple of arrays (link id, compartment, source link id, source layer)
+    """
+
+    rdm_state = np.random.RandomState(seed)
+    return (rdm_state.randint(1000, 1020, size=num_parts), rdm_state.randint(0, 4, size=num_parts),
+            rdm_state.randint(1000, 1005, size=num_parts), rdm_state.choice([-1, -2, -3, -4], size=num_parts))
+
+
+def run_tracking(out_fpath, engine, num_workers):
+    """
+    Calls the tracking script over the whole example with a fixed seed
+    :return: Content of the pickled output
+    """
+
+    first_h5_fpath = sorted(glob.glob(os.path.join(H5_FOLDER, "*.h5")))[0]
+    inputs_folder = os.path.join(os.path.dirname(H5_FOLDER), "asynch_inputs")
+    completed = subprocess.run([sys.executable, SCRIPT_FPATH, "-in_first_h5", first_h5_fpath,
+                                "-in_rvr", os.path.join(inputs_folder, "wolfCreek.rvr"),
+                                "-in_prm", os.path.join(inputs_folder, "wolfCreek.prm"),
+                                "-link_id", "309414,304557", "-out_hyd", out_fpath, "-all_parts", "1",
+                                "-vol_per_parts", "50000", "-engine", engine, "-workers", str(num_workers),
+                                "-seed", "5", "-no_jit", "-no_cache"],
+                               capture_output=True, text=True, timeout=RUN_TIMEOUT)
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+    with open(out_fpath, "rb") as r_file:
+        return pickle.load(r_file)
+
+
+def test_uniforms_do_not_depend_on_particles_order():
+    random_streams = RandomStreams(5)
+    all_columns = build_particles()
+    values = random_streams.uniforms(STEP_KEY, *all_columns)
+    assert np.all((values >= 0) & (values < 1))
+    assert np.array_equal(RandomStreams(5).uniforms(STEP_KEY, *all_columns), values)
+
+    # identical particles get different values, handed out in their order in the arrays
+    assert len(np.unique(values)) == len(values)
+    order = np.random.RandomState(1).permutation(len(values))
+    shuffled = random_streams.uniforms(STEP_KEY, *[c[order] for c in all_columns])
+    assert np.array_equal(np.sort(shuffled), np.sort(values))
+    for cur_particle in range(0, len(values), 97):
+        same = np.flatnonzero(np.all([c == c[cur_particle] for c in all_columns], axis=0))
+        assert np.array_equal(np.sort(shuffled[np.isin(order, same)]), np.sort(values[same]))
+
+    # splitting the particles between workers does not change their values if identical ones stay together
+    by_link = all_columns[0] < 1010
+    split_values = np.empty(len(values))
+    for cur_part in (by_link, ~by_link):
+        split_values[cur_part] = random_streams.uniforms(STEP_KEY, *[c[cur_part] for c in all_columns])
+    assert np.array_equal(split_values, values)
+
+
+def test_uniforms_change_with_seed_and_step():
+    all_columns = build_particles()
+    values = RandomStreams(5).uniforms(STEP_KEY, *all_columns)
+    assert abs(values.mean() - 0.5) < 0.02
+    for other_values in (RandomStreams(6).uniforms(STEP_KEY, *all_columns),
+                         RandomStreams(5).uniforms(STEP_KEY + 3600, *all_columns)):
+        assert np.mean(values == other_values) < 0.01
+        assert abs(np.corrcoef(values, other_values)[0, 1]) < 0.05
+
+
+def test_particles_uniforms_match_uniforms(network_index):
+    store = ParticleStore(network_index)
+    link_idx = np.arange(0, network_index.num_links, 7, dtype=np.int32)
+    store.add_particles(link_idx, np.full(len(link_idx), ParticleStore.COMP_TOPLAYER, dtype=np.int8), link_idx,
+                        np.full(len(link_idx), -3, dtype=np.int64), count=len(link_idx))
+    random_streams = RandomStreams(5)
+    assert np.array_equal(random_streams.particles_uniforms(STEP_KEY, store),
+                          random_streams.uniforms(STEP_KEY, network_index.link_ids[link_idx], store.comp,
+                                                  network_index.link_ids[link_idx], store.src_layer))
+
+
+def test_generator_depends_on_seed_and_step():
+    assert RandomStreams(5).get_generator(STEP_KEY).integers(0, 2**62) == \
+        RandomStreams(5).get_generator(STEP_KEY).integers(0, 2**62)
+    assert RandomStreams(5).get_generator(STEP_KEY).integers(0, 2**62) != \
+        RandomStreams(5).get_generator(STEP_KEY + 3600).integers(0, 2**62)
+
+
+def test_seeded_runs_do_not_depend_on_engine_nor_workers(tmp_path):
+    reference = run_tracking(str(tmp_path / "vectorized.p"), "vectorized", 1)
+    assert len(reference[309414]) > 0
+    for engine, num_workers in (("objects", 1), ("store", 1), ("threads", 1), ("threads", 3), ("subbasins", 1),
+                                ("subbasins", 3)):
+        out_fpath = str(tmp_path / "{0}_{1}.p".format(engine, num_workers))
+        assert run_tracking(out_fpath, engine, num_workers) == reference, (engine, num_workers)
+
+
+def test_seeded_bucket_runs_are_reproducible(tmp_path):
+    assert run_tracking(str(tmp_path / "bucket_a.p"), "bucket", 1) == run_tracking(str(tmp_path / "bucket_b.p"),
+                                                                                   "bucket", 1)
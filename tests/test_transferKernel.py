@@ -0,0 +1,109 @@
+from traceOutputs_lib import ParticleStore, TransferKernel
+import numpy as np
+import pytest
+
+NUM_TRIALS = 20
+NUM_PARTICLES = 40000
+
+# single-trial probabilities (channel, subsurface, top layer, ponds->channel, ponds->channel or top layer) of 4 links
+LINKS_PROBS = (np.array([0.05, 0.001, np.nan, 0.3]),
+               np.array([0.02, 0.2, 0.0, 1.0]),
+               np.array([0.1, 0.01, 0.5, np.nan]),
+               np.array([0.01, 0.05, 0.0, 0.2]),
+               np.array([0.03, 0.05, np.nan, 0.6]))
+LINKS_DOWN = np.array([1, 3, 3, -1], dtype=np.int32)
+
+
+def legacy_trials(link_idx, comp, num_trials, rdm_state):
+    """
+    Moves particles as the trial-by-trial loop did: up to 'num_trials' uniform values per particle, until one of them
+    falls under the single-trial threshold of its compartment
+    :param link_idx:
+    :param comp:
+    :param num_trials:
+    :param rdm_state: numpy RandomState
+    :return: Arrays of new link indexes and new compartments (link -1 for particles leaving the domain)
+    """
+
+    links_probs = list(zip(*[p.tolist() for p in LINKS_PROBS]))
+    new_link, new_comp = link_idx.copy(), comp.copy()
+    for i, (cur_link, cur_comp) in enumerate(zip(link_idx.tolist(), comp.tolist())):
+        prob_cc, prob_sc, prob_ts, prob_pc, prob_pt = links_probs[cur_link]
+        thresholds, exits = {
+            ParticleStore.COMP_CHANNEL: ((prob_cc, ), (ParticleStore.COMP_CHANNEL, )),
+            ParticleStore.COMP_SUBSURFACE: ((prob_sc, ), (ParticleStore.COMP_CHANNEL, )),
+            ParticleStore.COMP_TOPLAYER: ((prob_ts, ), (ParticleStore.COMP_SUBSURFACE, )),
+            ParticleStore.COMP_POND: ((prob_pc, prob_pt), (ParticleStore.COMP_CHANNEL, ParticleStore.COMP_TOPLAYER))
+        }[cur_comp]
+        for cur_rdm_val in rdm_state.uniform(0, 1, size=num_trials).tolist():
+            cur_exit = next((j for j, p in enumerate(thresholds) if cur_rdm_val <= p), None)
+            if cur_exit is not None:
+                new_comp[i] = exits[cur_exit]
+                if cur_comp == ParticleStore.COMP_CHANNEL:
+                    new_link[i] = LINKS_DOWN[cur_link]
+                break
+    return new_link, new_comp
+
+
+def count_outcomes(link_idx, comp, new_link, new_comp):
+    """
+
+    :return: Dictionary of (link, compartment, new link, new compartment)->number of particles
+    """
+    outcomes, counts = np.unique(np.stack((link_idx, comp, new_link, new_comp)), axis=1, return_counts=True)
+    return dict(zip(map(tuple, outcomes.T.tolist()), counts.tolist()))
+
+
+@pytest.mark.parametrize("use_jit", [False, True])
+def test_move_matches_legacy_trials(use_jit):
+    rdm_state = np.random.RandomState(1)
+    link_idx = np.repeat(np.arange(4, dtype=np.int32), NUM_PARTICLES // 4)
+    comp = np.tile(np.array([ParticleStore.COMP_CHANNEL, ParticleStore.COMP_SUBSURFACE, ParticleStore.COMP_TOPLAYER,
+                             ParticleStore.COMP_POND], dtype=np.int8), NUM_PARTICLES // 4)
+    step_probs = TransferKernel.step_probabilities(*LINKS_PROBS, num_trials=NUM_TRIALS)
+
+    TransferKernel.use_jit = use_jit
+    try:
+        new_link, new_comp, _ = TransferKernel.move(link_idx, comp, rdm_state.uniform(0, 1, size=len(link_idx)),
+                                                    step_probs, LINKS_DOWN)
+    finally:
+        TransferKernel.use_jit = True
+    kernel_counts = count_outcomes(link_idx, comp, new_link, new_comp)
+    legacy_counts = count_outcomes(link_idx, comp, *legacy_trials(link_idx, comp, NUM_TRIALS, rdm_state))
+
+    # each outcome is a binomial count: both must be within a few standard deviations of each other
+    num_each = NUM_PARTICLES // 16
+    for cur_outcome in set(kernel_counts) | set(legacy_counts):
+        kernel_count, legacy_count = kernel_counts.get(cur_outcome, 0), legacy_counts.get(cur_outcome, 0)
+        expected_p = (kernel_count + legacy_count) / (2 * num_each)
+        tolerance = 5 * np.sqrt(2 * num_each * expected_p * (1 - expected_p)) + 1
+        assert abs(kernel_count - legacy_count) <= tolerance, cur_outcome
+
+
+def test_move_never_uses_undefined_probabilities():
+    step_probs = TransferKernel.step_probabilities(*LINKS_PROBS, num_trials=NUM_TRIALS)
+    link_idx = np.array([2, 3, 2], dtype=np.int32)
+    comp = np.array([ParticleStore.COMP_CHANNEL, ParticleStore.COMP_TOPLAYER, ParticleStore.COMP_POND], dtype=np.int8)
+    new_link, new_comp, still_in = TransferKernel.move(link_idx, comp, np.zeros(3), step_probs, LINKS_DOWN)
+    assert new_link.tolist() == [2, 3, 2]
+    assert new_comp.tolist() == comp.tolist()
+    assert still_in.all()
+
+
+def test_jit_move_matches_numpy_move():
+    if TransferKernel.get_jit_move() is None:
+        pytest.skip("numba not installed")
+    rdm_state = np.random.RandomState(2)
+    link_idx = rdm_state.randint(0, 4, size=1000).astype(np.int32)
+    comp = rdm_state.randint(0, 4, size=1000).astype(np.int8)
+    rdm_values = rdm_state.uniform(0, 1, size=1000)
+    step_probs = TransferKernel.step_probabilities(*LINKS_PROBS, num_trials=NUM_TRIALS)
+
+    jit_result = TransferKernel.move(link_idx, comp, rdm_values, step_probs, LINKS_DOWN)
+    TransferKernel.use_jit = False
+    try:
+        numpy_result = TransferKernel.move(link_idx, comp, rdm_values, step_probs, LINKS_DOWN)
+    finally:
+        TransferKernel.use_jit = True
+    for cur_jit, cur_numpy in zip(jit_result, numpy_result):
+        assert np.array_equal(cur_jit, cur_numpy)